@@ -0,0 +1,107 @@
+#/usr/bin/env python
+""" Runs the slf programs in benchmarks/ on top of Python and prints the time
+they take.
+
+usage: bench.py [--pairs | --compare | --cost] [benchmark.slf ...]
+
+With --pairs, the bytecode interpreter counts how often every pair of
+adjacent opcodes is executed, and the most frequent pairs over all benchmarks
+are printed. These counts are what the superinstructions in compile.py were
+chosen from (see the notes there on which pairs are fused).
+
+With --compare, every benchmark is run with the stack and the register
+backend, and the number of executed instructions and the time of both are
+printed.
+
+With --cost, the average time per executed instruction of the stack backend
+is printed, e.g. to measure the cost of dispatching (benchmarks/dispatch.slf
+mostly consists of cheap instructions).
+"""
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'slflib'))
+
+from simpleparser import parse
+from interpreter import Interpreter
+import compile
+
+BACKENDS = ['stack', 'register']
+
+def run_benchmark(fname, pair_counts=None, backend='stack',
+                  count_instructions=False):
+    """ Runs the benchmark fname and returns the time it took and the number
+    of executed instructions (if count_instructions is set)."""
+    source = open(fname).read()
+    interpreter = Interpreter(open(os.path.join('slflib', 'builtins.slf')).read(),
+                              backend=backend)
+    interpreter.pair_counts = pair_counts
+    interpreter.count_instructions = count_instructions
+    w_module = interpreter.make_module()
+    ast = parse(source)
+    start = time.time()
+    interpreter.eval(ast, w_module)
+    return time.time() - start, interpreter.instructions_executed
+
+def compare_backends(fnames):
+    print '%-30s %-10s %14s %10s' % ('benchmark', 'backend', 'instructions',
+                                     'time')
+    for fname in fnames:
+        for backend in BACKENDS:
+            # the instructions are counted in a separate run, so that counting
+            # does not influence the time
+            _, instructions = run_benchmark(fname, backend=backend,
+                                            count_instructions=True)
+            seconds, _ = run_benchmark(fname, backend=backend)
+            print '%-30s %-10s %14d %9.3fs' % (fname, backend, instructions,
+                                               seconds)
+
+def print_costs(fnames):
+    print '%-30s %14s %10s %16s' % ('benchmark', 'instructions', 'time',
+                                    'per instruction')
+    for fname in fnames:
+        _, instructions = run_benchmark(fname, count_instructions=True)
+        seconds, _ = run_benchmark(fname)
+        print '%-30s %14d %9.3fs %14.3fus' % (fname, instructions, seconds,
+                                              1e6 * seconds / instructions)
+
+def print_pairs(pair_counts, limit=15):
+    total = sum(pair_counts.values())
+    pairs = sorted(pair_counts.items(), key=lambda item: -item[1])
+    for (first, second), count in pairs[:limit]:
+        print '%6.2f%%  %s %s' % (100.0 * count / total,
+                                  compile.opcode_names[first],
+                                  compile.opcode_names[second])
+
+def main(args):
+    compare = '--compare' in args
+    if compare:
+        args.remove('--compare')
+    cost = '--cost' in args
+    if cost:
+        args.remove('--cost')
+    pair_counts = None
+    if '--pairs' in args:
+        args.remove('--pairs')
+        pair_counts = {}
+    fnames = args or sorted(glob.glob(os.path.join('benchmarks', '*.slf')))
+    if compare:
+        compare_backends(fnames)
+        return 0
+    if cost:
+        print_costs(fnames)
+        return 0
+    for fname in fnames:
+        seconds, _ = run_benchmark(fname, pair_counts)
+        print '%-30s %.3fs' % (fname, seconds)
+    if pair_counts is not None:
+        print
+        print_pairs(pair_counts)
+    return 0
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main(sys.argv[1:]))
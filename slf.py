@@ -1,14 +1,23 @@
 #/usr/bin/env python
 
 from slflib.simpleparser import parse, ParseError
-from slflib.interpreter import Interpreter
+from slflib.interpreter import Interpreter, get_builtins_image
+from slflib import bytecodecache
 
 from pypy.rlib.streamio import open_file_as_stream
+import os
 import sys
 
+# evaluate the default builtins once, at translation time for slf-c
+get_builtins_image()
+
 def target(*args):
     return main, None
 
+def jitpolicy(driver):
+    from pypy.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
 def main(args):
     fname = ''
     try:
@@ -28,15 +37,22 @@ def main(args):
         print e
         return 1
 
-    ast = ''
-    try:
-        ast = parse(code)
-    except Exception, e:
-        print 'ERROR: parser', e
-        return 1
+    # the compiled bytecode is cached in fname + 'c', or in the directory
+    # named by SLF_CACHE_DIR
+    cache_dir = os.environ.get('SLF_CACHE_DIR')
+    bytecode = bytecodecache.load(fname, code, cache_dir)
+    if bytecode is None:
+        ast = ''
+        try:
+            ast = parse(code)
+        except Exception, e:
+            print 'ERROR: parser', e
+            return 1
+        bytecode = interpreter.compile_program(ast)
+        bytecodecache.store(fname, code, bytecode, cache_dir)
 
     try:
-        interpreter.eval(ast, w_module)
+        interpreter.run_bytecode(bytecode, w_module)
     except Exception, e:
         print 'ERROR: interpreter', e
         return 1
@@ -1,135 +1,531 @@
 from objmodel import W_Integer, W_NormalObject, W_Method
+from objmodel import new_method, new_object
+from pypy.rlib import jit
 import compile
 import primitives
 import struct
 import disass
 
+def get_printable_location(pc, code):
+    decoded = code.get_decoded()
+    if pc >= len(decoded.opcodes):
+        return '%s #%d <end>' % (code.name, pc)
+    return '%s #%d %s' % (code.name, pc,
+                          compile.opcode_names[decoded.get_opcode(pc)])
+
+# the position in the program is the green part; loops of slf programs are
+# traced starting from backward jumps
+jitdriver = jit.JitDriver(greens=['pc', 'code'], reds=['frame', 'self'],
+                          get_printable_location=get_printable_location)
+
+class Frame(object):
+    """ The activation record of one piece of bytecode.
+
+    Frames are kept on an explicit stack by the BytecodeInterpreter, so calls
+    do not nest calls of the host language. A frame with discard_result set
+    does not push its result on the stack of the calling frame when it is
+    finished (this is used for the bodies of objects).
+
+    If the first half of a superinstruction calls a method, the frame is
+    suspended with resuming set, and the superinstruction is executed again
+    after the call returns, continuing with its second half.
+
+    The frame of a method keeps its arguments and locals in slots (see
+    compile.Bytecode.slotnames), and context is None until the context object
+    is needed (see get_context).
+
+    The value stack is preallocated with the size computed by the compiler
+    (Bytecode.stackdepth), stackpointer is the number of values on it. The
+    stack operations do not check for overflows and underflows, as only code
+    that passed the verifier is run (see verifier.py).
+    """
+    def __init__(self, code, context, discard_result=False, slots=None):
+        self.code = code
+        self.decoded = code.get_decoded()
+        self.pc = 0
+        self.stack = [None] * code.stackdepth
+        self.stackpointer = 0
+        self.context = context
+        self.discard_result = discard_result
+        self.resuming = False
+        self.slots = slots
+
+    def push(self, w_value):
+        self.stack[self.stackpointer] = w_value
+        self.stackpointer += 1
+
+    def pop(self):
+        stackpointer = self.stackpointer - 1
+        assert stackpointer >= 0
+        w_value = self.stack[stackpointer]
+        self.stack[stackpointer] = None
+        self.stackpointer = stackpointer
+        return w_value
+
+    def top(self):
+        stackpointer = self.stackpointer - 1
+        assert stackpointer >= 0
+        return self.stack[stackpointer]
+
+    def peek(self, depth):
+        """ Returns the value below the depth topmost values."""
+        stackpointer = self.stackpointer - 1 - depth
+        assert stackpointer >= 0
+        return self.stack[stackpointer]
+
+    def rebind(self, receiver, args):
+        """ Reuses the frame for a new call of its code (see
+        TAIL_METHOD_CALL)."""
+        assert self.stackpointer == 0
+        self.context = None
+        self.slots = bind_slots(self.code, receiver, args)
+        self.pc = 0
+        self.resuming = False
+
+    def get_context(self):
+        """ Returns the context object, creating it from the slots if it does
+        not exist yet. From then on, all locals are stored in it."""
+        context = self.context
+        if context is None:
+            context = W_NormalObject()
+            slotnames = self.code.slotnames
+            for i in range(len(slotnames)):
+                w_value = self.slots[i]
+                if w_value is not None:
+                    context.setvalue(slotnames[i], w_value)
+            self.context = context
+            self.slots = None
+        return context
+
+def bind_slots(code, receiver, args):
+    """ Returns the slots of a call of the method with the given code."""
+    slots = [None] * len(code.slotnames)
+    for i in range(min(len(args), code.numargs)):
+        slots[code.argument_slots[i]] = args[i]
+    slots[code.self_slot] = receiver
+    slots[code.parent_slot] = receiver
+    return slots
+
 class BytecodeInterpreter(object):
+    _immutable_fields_ = ["interpreter", "debug", "debug_level", "pair_counts",
+                          "count_instructions"]
+
     def __init__(self, code, context, interpreter, debug_level=1):
         self.code = code
         self.context = context
         self.interpreter = interpreter
-        self.pc = 0
-        self.stack = []
+        self.frames = []
         self.debug = interpreter.debug
         self.debug_level = debug_level
-        if self.debug:
-            print '(%d) dbg: >>>>>>>>>>>>>>>>>>>>>>>>>>>>' % self.debug_level
+        self.pair_counts = interpreter.pair_counts
+        self.count_instructions = interpreter.count_instructions
 
     def run(self):
-        while self.pc < len(self.code.code):
-            op = self.next_instruction()
-
-            arg = 0
-            if compile.isjump(op):
-                arg = self.read_arg4()
-            elif compile.hasarg(op):
-                arg = self.read_smallarg()
+        self.push_frame(Frame(self.code, self.context))
+        while True:
+            frame = self.frames[-1]
+            code = frame.code
+            pc = frame.pc
+            jitdriver.jit_merge_point(pc=pc, code=code, frame=frame, self=self)
+            decoded = code.get_decoded()
+            if pc >= len(decoded.opcodes):
+                if self.pop_frame(frame):
+                    break
+                continue
+            # the quickened instruction, if the call at pc was quickened
+            op = decoded.get_opcode(pc)
+            arg = decoded.args[pc]
+            frame.pc = pc + 1
 
             if self.debug:
-                print '(%d) pc:%d op: %d (%s) args %d' % (self.debug_level, self.pc, op, disass.opcode2name[op], arg)
-                print disass.disassemble(self.code, '(%d)' % self.debug_level, pc = self.pc)
-
-            if op == compile.INT_LITERAL:
-                self.op_int_literal(arg)
-            elif op == compile.SET_LOCAL:
-                # TODO something is strange
-                t = self.stack.pop()
-                self.op_implicit_self()
-                self.stack.append(t)
-                self.op_assignment(arg)
-            elif op == compile.PRIMITIVE_METHOD_CALL:
-                self.op_primitive_method_call(arg)
-            elif op == compile.POP:
-                self.stack.pop()
-            elif op == compile.GET_LOCAL:
-                self.op_implicit_self()
-                self.op_method_lookup(arg)
-                self.op_method_call(0)
-            elif op == compile.JUMP_IF_FALSE:
-                self.op_jump_if_false(arg)
-            elif op == compile.JUMP:
-                self.op_jump(arg)
-            elif op == compile.MAKE_OBJECT:
-                self.op_make_object(arg)
-            elif op == compile.MAKE_OBJECT_CALL:
-                self.op_make_object_call(arg)
-            elif op == compile.ASSIGNMENT_APPEND_PARENT:
-                self.op_assignment_append_parrent(arg)
-            elif op == compile.METHOD_LOOKUP:
-                self.op_method_lookup(arg)
-            elif op == compile.METHOD_CALL:
-                self.op_method_call(arg)
-            elif op == compile.DUP:
-                self.op_dup()
-            elif op == compile.ASSIGNMENT:
-                self.op_assignment(arg)
-            elif op == compile.MAKE_FUNCTION:
-                self.op_make_function(arg)
-            elif op == compile.IMPLICIT_SELF:
-                self.op_implicit_self()
-            else:
-                raise NotImplementedError(compile.opcode_names[op])
+                level = self.debug_level + len(self.frames) - 1
+                print '(%d) pc:%d op: %d (%s) args %d' % (level, decoded.positions[pc], op, disass.opcode2name[op], arg)
+                print disass.disassemble(frame.code, '(%d)' % level, pc = decoded.positions[pc])
+            if self.pair_counts is not None:
+                self.count_pair(decoded, pc)
+            if self.count_instructions:
+                self.interpreter.instructions_executed += 1
+
+            # handlers return the pc of the target of a backward jump, at
+            # which a loop can be traced
+            target = handlers[op](self, frame, decoded, pc, arg)
+            if target >= 0:
+                jitdriver.can_enter_jit(pc=target, code=code, frame=frame,
+                                        self=self)
         return self.context
 
-    def op_assignment(self, arg):
-        name = self.lookup_symbol(arg)
-        value = self.stack.pop()
-        target = self.stack.pop()
+    # ---------- the handlers of the opcodes (see handlers below) ----------
+
+    def dispatch_INT_LITERAL(self, frame, decoded, pc, arg):
+        self.op_int_literal(frame, arg)
+        return -1
+
+    def dispatch_LOAD_CONST(self, frame, decoded, pc, arg):
+        self.op_load_const(frame, arg)
+        return -1
+
+    def dispatch_SET_LOCAL(self, frame, decoded, pc, arg):
+        self.op_set_local(frame, arg)
+        return -1
+
+    def dispatch_PRIMITIVE_METHOD_CALL(self, frame, decoded, pc, arg):
+        self.op_primitive_method_call(frame, arg)
+        return -1
+
+    def dispatch_POP(self, frame, decoded, pc, arg):
+        frame.pop()
+        return -1
+
+    def dispatch_GET_LOCAL(self, frame, decoded, pc, arg):
+        self.op_get_local(frame, decoded.caches[pc], arg)
+        return -1
+
+    def dispatch_LOAD_SLOT(self, frame, decoded, pc, arg):
+        self.op_load_slot(frame, decoded.caches[pc], arg)
+        return -1
+
+    def dispatch_STORE_SLOT(self, frame, decoded, pc, arg):
+        self.op_store_slot(frame, arg)
+        return -1
+
+    def dispatch_JUMP_IF_FALSE(self, frame, decoded, pc, arg):
+        self.op_jump_if_false(frame, arg)
+        return -1
+
+    def dispatch_JUMP_IF_TRUE(self, frame, decoded, pc, arg):
+        # emitted at the end of loops rotated by the peephole optimizer
+        if self.op_jump_if_true(frame, arg) and arg < pc:
+            return arg
+        return -1
+
+    def dispatch_JUMP(self, frame, decoded, pc, arg):
+        self.op_jump(frame, arg)
+        if arg < pc:
+            return arg
+        return -1
+
+    def dispatch_MAKE_OBJECT(self, frame, decoded, pc, arg):
+        self.op_make_object(frame, arg)
+        return -1
+
+    def dispatch_MAKE_OBJECT_CALL(self, frame, decoded, pc, arg):
+        self.op_make_object_call(frame, arg)
+        return -1
+
+    def dispatch_ASSIGNMENT_APPEND_PARENT(self, frame, decoded, pc, arg):
+        self.op_assignment_append_parrent(frame, arg)
+        return -1
+
+    def dispatch_METHOD_LOOKUP(self, frame, decoded, pc, arg):
+        self.op_method_lookup(frame, decoded.caches[pc], arg)
+        return -1
+
+    def dispatch_METHOD_CALL(self, frame, decoded, pc, arg):
+        self.quicken(frame, decoded.sites[pc])
+        self.op_method_call(frame, arg)
+        return -1
+
+    def dispatch_TAIL_METHOD_CALL(self, frame, decoded, pc, arg):
+        self.quicken(frame, decoded.sites[pc])
+        if self.op_tail_method_call(frame, arg):
+            # the frame was reused for a recursive call
+            return 0
+        return -1
+
+    def dispatch_DUP(self, frame, decoded, pc, arg):
+        self.op_dup(frame)
+        return -1
+
+    def dispatch_ASSIGNMENT(self, frame, decoded, pc, arg):
+        self.op_assignment(frame, arg)
+        return -1
+
+    def dispatch_MAKE_FUNCTION(self, frame, decoded, pc, arg):
+        self.op_make_function(frame, arg)
+        return -1
+
+    def dispatch_IMPLICIT_SELF(self, frame, decoded, pc, arg):
+        self.op_implicit_self(frame)
+        return -1
+
+    def dispatch_GET_LOCAL_LOOKUP(self, frame, decoded, pc, arg):
+        if self.resumable_get_local(frame, pc, compile.first_arg(arg)):
+            self.op_method_lookup(frame, decoded.second_caches[pc],
+                                  compile.second_arg(arg))
+        return -1
+
+    def dispatch_LOOKUP_GET_LOCAL(self, frame, decoded, pc, arg):
+        self.op_method_lookup(frame, decoded.caches[pc],
+                              compile.first_arg(arg))
+        self.op_get_local(frame, decoded.second_caches[pc],
+                          compile.second_arg(arg))
+        return -1
+
+    def dispatch_GET_LOCAL_CALL(self, frame, decoded, pc, arg):
+        if self.resumable_get_local(frame, pc, compile.first_arg(arg)):
+            self.quicken(frame, decoded.sites[pc])
+            self.op_method_call(frame, compile.second_arg(arg))
+        return -1
+
+    def dispatch_LOOKUP_INT(self, frame, decoded, pc, arg):
+        self.op_method_lookup(frame, decoded.caches[pc],
+                              compile.first_arg(arg))
+        self.op_int_literal(frame, compile.second_arg(arg))
+        return -1
+
+    def dispatch_INT_CALL(self, frame, decoded, pc, arg):
+        self.op_int_literal(frame, compile.first_arg(arg))
+        self.quicken(frame, decoded.sites[pc])
+        self.op_method_call(frame, compile.second_arg(arg))
+        return -1
+
+    def dispatch_INT_PRIMITIVE(self, frame, decoded, pc, arg):
+        self.op_int_literal(frame, compile.first_arg(arg))
+        self.op_primitive_method_call(frame, compile.second_arg(arg))
+        return -1
+
+    def dispatch_SET_LOCAL_POP(self, frame, decoded, pc, arg):
+        self.op_set_local(frame, arg)
+        frame.pop()
+        return -1
+
+    def dispatch_POP_GET_LOCAL(self, frame, decoded, pc, arg):
+        frame.pop()
+        self.op_get_local(frame, decoded.caches[pc], arg)
+        return -1
+
+    def dispatch_STORE_SLOT_POP(self, frame, decoded, pc, arg):
+        self.op_store_slot(frame, arg)
+        frame.pop()
+        return -1
+
+    # ----------
+
+    def push_frame(self, frame):
+        self.frames.append(frame)
+        if self.debug:
+            level = self.debug_level + len(self.frames) - 1
+            print '(%d) dbg: >>>>>>>>>>>>>>>>>>>>>>>>>>>>' % level
+
+    def pop_frame(self, frame):
+        """ Removes the finished frame and passes its result to the calling
+        frame. Returns True if the outermost frame was removed."""
+        self.frames.pop()
+        if self.debug:
+            level = self.debug_level + len(self.frames)
+            print '(%d) dbg: <<<<<<<<<<<<<<<<<<<<<<<<<<<<' % level
+        if not self.frames:
+            return True
+        if not frame.discard_result:
+            # the result is the only value left on the stack
+            self.frames[-1].push(frame.pop())
+        return False
+
+    def count_pair(self, decoded, pc):
+        """ Counts the execution of the instruction at pc together with the
+        instruction that follows it in the code."""
+        if pc + 1 < len(decoded.opcodes):
+            pair = (decoded.opcodes[pc], decoded.opcodes[pc + 1])
+            self.pair_counts[pair] = self.pair_counts.get(pair, 0) + 1
+
+    def op_assignment(self, frame, arg):
+        name = self.lookup_symbol(frame, arg)
+        value = frame.pop()
+        target = frame.pop()
         target.setvalue(name, value)
-        self.stack.append(value)
+        frame.push(value)
 
-    def op_assignment_append_parrent(self, arg):
-        name = self.lookup_symbol(arg)
-        parent = self.stack.pop()
-        target = self.stack.pop()
+    def op_assignment_append_parrent(self, frame, arg):
+        name = self.lookup_symbol(frame, arg)
+        parent = frame.pop()
+        target = frame.pop()
         target.setvalue(name, parent)
-        target.parents.append(name)
-        self.stack.append(target)
+        target.add_parent(name)
+        frame.push(target)
+
+    def op_dup(self, frame):
+        frame.push(frame.top())
 
-    def op_dup(self):
-        self.stack.append(self.stack[-1])
+    def op_get_local(self, frame, cache, arg):
+        """ Returns True if a method was called."""
+        name = self.lookup_symbol(frame, arg)
+        if frame.context is None:
+            # the name is not a slot, so it can only be found in the parent
+            w_parent = frame.slots[frame.code.parent_slot]
+            return self.push_local(frame, cache.lookup(w_parent, name))
+        context = frame.context
+        return self.call(frame, context, cache.lookup(context, name), [])
 
-    def op_implicit_self(self):
-        self.stack.append(self.context)
+    def op_load_slot(self, frame, cache, arg):
+        """ Returns True if a method was called."""
+        if frame.context is None:
+            w_value = frame.slots[arg]
+            if w_value is None:
+                # not assigned yet, so it is looked up in the parent
+                w_parent = frame.slots[frame.code.parent_slot]
+                w_value = cache.lookup(w_parent, frame.code.slotnames[arg])
+            return self.push_local(frame, w_value)
+        context = frame.context
+        return self.call(frame, context,
+                         cache.lookup(context, frame.code.slotnames[arg]), [])
+
+    def push_local(self, frame, w_value):
+        """ Pushes the value of a local of a frame without a context object.
+        If it is a method, it is called with the context object as the
+        receiver. Returns True if a method was called."""
+        if isinstance(w_value, W_Method):
+            return self.call(frame, frame.get_context(), w_value, [])
+        frame.push(w_value)
+        return False
+
+    def op_store_slot(self, frame, arg):
+        w_value = frame.top()
+        if frame.context is None:
+            frame.slots[arg] = w_value
+        else:
+            frame.context.setvalue(frame.code.slotnames[arg], w_value)
 
-    def op_int_literal(self, arg):
-        i = W_Integer(arg)
-        i.builtins = self.interpreter.builtins
-        self.stack.append(i)
+    def resumable_get_local(self, frame, pc, arg):
+        """ Executes the GET_LOCAL half of the superinstruction at pc. Returns
+        True if its result is on the stack, and False if the frame was
+        suspended to call a method first."""
+        if frame.resuming:
+            frame.resuming = False
+            return True
+        if self.op_get_local(frame, frame.decoded.caches[pc], arg):
+            frame.pc = pc
+            frame.resuming = True
+            return False
+        return True
 
-    def op_jump(self, arg):
-        self.pc += arg
+    def op_set_local(self, frame, arg):
+        name = self.lookup_symbol(frame, arg)
+        frame.get_context().setvalue(name, frame.top())
 
-    def op_jump_if_false(self, arg):
-        acc = self.stack.pop()
+    def op_implicit_self(self, frame):
+        frame.push(frame.get_context())
+
+    def op_int_literal(self, frame, arg):
+        frame.push(self.interpreter.space.newint(arg))
+
+    def op_load_const(self, frame, arg):
+        w_constants = frame.code.get_constants(self.interpreter.space)
+        frame.push(w_constants[arg])
+
+    def op_jump(self, frame, arg):
+        frame.pc = arg
+
+    def op_jump_if_false(self, frame, arg):
+        acc = frame.pop()
         if acc.istrue() is not True:
-            self.op_jump(arg)
-
-    def op_make_function(self, arg):
-        method = W_Method({'__parent__':self.context})
-        method.block = self.lookup_subcode(arg)
-
-        self.stack.append(method)
-
-    def op_make_object(self, arg):
-        name = self.lookup_symbol(arg)
-        obj = W_NormalObject({'__parent__':self.context})
-        self.stack.append(obj)
-
-    def op_make_object_call(self, arg):
-        code = self.lookup_subcode(arg)
-        context = self.stack[-1]
-        self.eval(code, context, self.interpreter)
-
-    def op_method_call(self, arg):
-        args = []
-        for i in xrange(arg):
-            args.insert(0,self.stack.pop())
-        method = self.stack.pop()
-        receiver = self.stack.pop()
+            self.op_jump(frame, arg)
+
+    def op_jump_if_true(self, frame, arg):
+        acc = frame.pop()
+        if acc.istrue() is True:
+            self.op_jump(frame, arg)
+            return True
+        return False
+
+    def op_make_function(self, frame, arg):
+        method = new_method(self.lookup_subcode(frame, arg),
+                            frame.get_context())
+        frame.push(method)
+
+    def op_make_object(self, frame, arg):
+        frame.push(new_object(frame.get_context(),
+                              frame.code.layout_maps[arg]))
+
+    def op_make_object_call(self, frame, arg):
+        code = self.lookup_subcode(frame, arg).get_bytecode()
+        context = frame.top()
+        self.push_frame(Frame(code, context, discard_result=True))
+
+    def op_method_call(self, frame, arg):
+        """ Returns True if a method was called, i.e. a frame was pushed."""
+        args = self.pop_args(frame, arg)
+        method = frame.pop()
+        receiver = frame.pop()
+        return self.call(frame, receiver, method, args)
+
+    def quicken(self, frame, site):
+        """ Quickens the call with one argument on top of the stack (whose
+        QuickeningSite is site, or None if the call has more arguments), if it
+        calls a method that just calls a primitive (see
+        Bytecode.get_wrapped_primitive) with an integer receiver and
+        argument, and the primitive has a quickened instruction. The call is
+        executed normally this time, and by the handler of the quickened
+        instruction from then on. A call that cannot be quickened the first
+        time is never quickened."""
+        if site is None or site.failed:
+            return
+        w_method = frame.peek(1)
+        if not (isinstance(frame.peek(2), W_Integer) and
+                isinstance(frame.peek(0), W_Integer) and
+                isinstance(w_method, W_Method)):
+            site.dequicken()
+            return
+        code = w_method.block
+        primitive = code.get_bytecode().get_wrapped_primitive()
+        if primitive < 0 or quickened_opcodes[primitive] < 0:
+            site.dequicken()
+            return
+        site.quicken(quickened_opcodes[primitive], code)
+
+    def quickened_call_argument(self, frame, decoded, pc, arg):
+        """ Executes the first half of a quickened GET_LOCAL_CALL or INT_CALL,
+        which pushes the argument. Returns False if the frame was suspended
+        to call a method first (see resumable_get_local)."""
+        opcode = decoded.opcodes[pc]
+        if opcode == compile.GET_LOCAL_CALL:
+            return self.resumable_get_local(frame, pc, compile.first_arg(arg))
+        if opcode == compile.INT_CALL:
+            self.op_int_literal(frame, compile.first_arg(arg))
+        return True
+
+    def dequickened_call(self, frame, decoded, pc, arg):
+        """ Executes a quickened call whose guard failed as the call it
+        was quickened from. Returns what the handler of that call returns."""
+        opcode = decoded.opcodes[pc]
+        if opcode == compile.TAIL_METHOD_CALL:
+            if self.op_tail_method_call(frame, arg):
+                return 0
+            return -1
+        if opcode == compile.METHOD_CALL:
+            self.op_method_call(frame, arg)
+        else:
+            self.op_method_call(frame, compile.second_arg(arg))
+        return -1
+
+    def op_tail_method_call(self, frame, arg):
+        """ Returns True if the frame was reused to call its own code."""
+        args = self.pop_args(frame, arg)
+        method = frame.pop()
+        receiver = frame.pop()
+        if (isinstance(method, W_Method) and
+                method.block.get_bytecode() is frame.code):
+            frame.rebind(receiver, args)
+            return True
+        self.call(frame, receiver, method, args)
+        return False
+
+    def pop_args(self, frame, numargs):
+        args = [None] * numargs
+        i = numargs - 1
+        while i >= 0:
+            args[i] = frame.pop()
+            i -= 1
+        return args
+
+    def call(self, frame, receiver, method, args):
+        """ Calls method on receiver if it is a method, otherwise pushes it.
+        Returns True if a method was called, i.e. a frame was pushed."""
         if isinstance(method, W_Method):
-            code = method.block
+            code = method.block.get_bytecode()
+            if code.uses_slots():
+                slots = bind_slots(code, receiver, args)
+                self.push_frame(Frame(code, None, slots=slots))
+                return True
             context = W_NormalObject()
             i = 0
             for a in args:
@@ -137,69 +533,78 @@ class BytecodeInterpreter(object):
                 i += 1
             context.setvalue('self', receiver)
             context.setvalue('__parent__', receiver)
-            res = self.eval(code, context, self.interpreter)
-        else:
-            res = method
-        self.stack.append(res)
-
-    def op_method_lookup(self, arg):
-        name = self.lookup_symbol(arg)
-        self.stack.append(self.stack[-1].getvalue(name))
-
-    def op_primitive_method_call(self, arg):
-        primitive = primitives.primitives_by_name[arg]
-        arity = primitives.all_primitives_arg_count[arg]
-        arguments = []
-        for i in xrange(arity):
-            arguments.append(self.stack.pop())
-        receiver = self.stack.pop()
-        res = primitives.call(primitive, receiver, arguments, self.interpreter.builtins)
-        self.stack.append(res)
-
-    def eval(self, code, context, interpreter):
-        b = BytecodeInterpreter(code, context, interpreter, self.debug_level + 1)
-        b.run()
-        if self.debug:
-            print '(%d) dbg: <<<<<<<<<<<<<<<<<<<<<<<<<<<<' % self.debug_level
-        return b.stack[0]
-
-    def read(self, next=1):
-        if next == 1:
-            c = self.code.code[self.pc]
-            self.pc += 1
-            return c
-        else:
-            c = []
-            for i in xrange(next):
-                c.append(self.code.code[self.pc])
-                self.pc += 1
-            return ''.join(c)
-
-    def lookup_subcode(self, index):
-        return self.code.subbytecodes[index]
-
-    def lookup_symbol(self, index):
-        return self.code.symbols[index]
-
-    def next_instruction(self):
-        return self.read_arg()
-
-    def read_arg(self):
-        v = ord(self.read())
-        if v >= 128:
-            v -= 256
-        return v
-
-    def read_arg4(self):
-        c = self.read(4)
-        highval = ord(c[3])
-        if highval >= 128:
-            highval -= 256
-        return (ord(c[0]) | (ord(c[1]) << 8) | (ord(c[2]) << 16) | (highval << 24))
-
-    def read_smallarg(self):
-        i = self.read_arg()
-        if i == -128:
-            return self.read_arg4()
+            self.push_frame(Frame(code, context))
+            return True
+        frame.push(method)
+        return False
+
+    def op_method_lookup(self, frame, cache, arg):
+        name = self.lookup_symbol(frame, arg)
+        frame.push(cache.lookup(frame.top(), name))
+
+    def op_primitive_method_call(self, frame, arg):
+        space = self.interpreter.space
+        if primitives.all_primitives_arg_count[arg] == 0:
+            receiver = frame.pop()
+            res = primitives.call0(arg, receiver, space)
         else:
-            return i
+            argument = frame.pop()
+            receiver = frame.pop()
+            res = primitives.call1(arg, receiver, argument, space)
+        frame.push(res)
+
+    def lookup_subcode(self, frame, index):
+        return frame.code.subbytecodes[index]
+
+    def lookup_symbol(self, frame, index):
+        return frame.code.symbols[index]
+
+
+def dispatch_invalid(self, frame, decoded, pc, arg):
+    raise NotImplementedError(compile.opcode_names[decoded.opcodes[pc]])
+
+def make_quickened_handler(operation):
+    """ Returns the handler of a quickened instruction, which computes the
+    result of the call from the integer receiver and argument with operation
+    (the function of a primitive). The guard checks that the receiver and
+    the argument are integers and that the method is the one the call was
+    quickened for (i.e. that the integer trait was not changed). If it
+    fails, the call is dequickened."""
+    def dispatch(self, frame, decoded, pc, arg):
+        if not self.quickened_call_argument(frame, decoded, pc, arg):
+            return -1
+        site = decoded.sites[pc]
+        w_argument = frame.peek(0)
+        w_method = frame.peek(1)
+        w_receiver = frame.peek(2)
+        if (isinstance(w_receiver, W_Integer) and
+                isinstance(w_argument, W_Integer) and
+                isinstance(w_method, W_Method) and
+                w_method.block is site.code):
+            frame.pop()
+            frame.pop()
+            frame.pop()
+            frame.push(self.interpreter.space.newint(
+                operation(w_receiver.value, w_argument.value)))
+            return -1
+        site.dequicken()
+        return self.dequickened_call(frame, decoded, pc, arg)
+    return dispatch
+
+# the quickened opcode of every primitive (or -1)
+quickened_opcodes = [-1] * len(primitives.primitives_by_name)
+for _opcode, _name in compile.quickened_primitives.items():
+    quickened_opcodes[primitives.primitives_by_name.index(_name)] = _opcode
+
+# the handler of every opcode, indexed by the opcode, so that dispatching takes
+# the same time for all opcodes
+handlers = [dispatch_invalid] * 256
+for _opcode in range(len(compile.opcode_names)):
+    _name = compile.opcode_names[_opcode]
+    if _name is not None and 'dispatch_' + _name in BytecodeInterpreter.__dict__:
+        handlers[_opcode] = BytecodeInterpreter.__dict__['dispatch_' + _name]
+# the quickened instructions compute their result with the primitive directly
+for _opcode, _name in compile.quickened_primitives.items():
+    _index = primitives.primitives_by_name.index(_name)
+    handlers[_opcode] = make_quickened_handler(
+        primitives.binary_primitives[_index])
@@ -0,0 +1,237 @@
+""" A cache of compiled bytecode on disk.
+
+The bytecode compiled from a script is written to a .slfc file, either next
+to the script (foo.slf is cached in foo.slfc) or, if a cache directory is
+given, in that directory under a name made from the md5 digest of the source
+and the instruction set version. A cache file is only used if it was written
+for the same source text and the same instruction set, and if the bytecode in
+it passes the verifier (see verifier.py). It is read with mmap.
+
+A cache file consists of a header and the serialized Bytecode tree:
+
+    MAGIC
+    compile.INSTRUCTION_SET_VERSION    (ARG4)
+    md5 digest of the source           (32 hex digits)
+    the Bytecode of the script
+
+where a Bytecode is serialized as
+
+    name                               (STRING)
+    numargs                            (ARG4)
+    stackdepth                         (ARG4)
+    code                               (STRING)
+    number of symbols                  (ARG4)
+    symbols                            (STRING each)
+    number of slotnames                (ARG4)
+    slotnames                          (STRING each)
+    number of constants                (ARG4)
+    constants                          (ARG8 each)
+    number of layouts                  (ARG4)
+    layouts                            (number of names (ARG4) and STRING
+                                        each)
+    number of subbytecodes             (ARG4)
+    subbytecodes                       (Bytecode each)
+
+A STRING is its length as ARG4 followed by its characters. ARG4 is the
+encoding of the compiler (see compile.py). An ARG8 is the low half of a 64
+bit integer as ARG4 followed by its high half (the integer literals in the
+constant pool do not necessarily fit in 32 bits).
+"""
+import os
+from pypy.rlib import rmmap
+from pypy.rlib.rmd5 import RMD5
+from pypy.rlib.streamio import open_file_as_stream, StreamError
+
+import compile
+import verifier
+
+MAGIC = 'SLFC'
+
+class CacheError(Exception):
+    pass
+
+def source_digest(source):
+    return RMD5(source).hexdigest()
+
+def cache_path(fname, source, cache_dir=None):
+    """ Returns the name of the cache file of the script fname."""
+    if cache_dir is None:
+        return fname + 'c'
+    name = '%s-%d.slfc' % (source_digest(source),
+                           compile.INSTRUCTION_SET_VERSION)
+    return os.path.join(cache_dir, name)
+
+# ---------- writing ----------
+
+def write4(result, value):
+    result.extend(compile.encode4(value))
+
+def write8(result, value):
+    write4(result, value & 0xFFFFFFFF)
+    write4(result, value >> 32)
+
+def write_string(result, s):
+    write4(result, len(s))
+    result.append(s)
+
+def write_bytecode(result, bytecode):
+    write_string(result, bytecode.name)
+    write4(result, bytecode.numargs)
+    write4(result, bytecode.stackdepth)
+    write_string(result, bytecode.code)
+    write4(result, len(bytecode.symbols))
+    for symbol in bytecode.symbols:
+        write_string(result, symbol)
+    write4(result, len(bytecode.slotnames))
+    for slotname in bytecode.slotnames:
+        write_string(result, slotname)
+    write4(result, len(bytecode.constants))
+    for constant in bytecode.constants:
+        write8(result, constant)
+    write4(result, len(bytecode.layouts))
+    for layout in bytecode.layouts:
+        write4(result, len(layout))
+        for name in layout:
+            write_string(result, name)
+    write4(result, len(bytecode.subbytecodes))
+    for subbytecode in bytecode.subbytecodes:
+        # bodies that were not run yet are compiled for the cache
+        write_bytecode(result, subbytecode.get_bytecode())
+
+def dumps(bytecode, source):
+    """ Serializes bytecode, compiled from source, to a string."""
+    result = [MAGIC]
+    write4(result, compile.INSTRUCTION_SET_VERSION)
+    result.append(source_digest(source))
+    write_bytecode(result, bytecode)
+    return ''.join(result)
+
+def store(fname, source, bytecode, cache_dir=None):
+    """ Writes the cache file of the script fname. Errors are ignored, the
+    cache is then simply not used."""
+    path = cache_path(fname, source, cache_dir)
+    # the file is renamed in place when complete, so that concurrent runs
+    # never see a partially written file
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        stream = open_file_as_stream(tmppath, 'w', 1024)
+        try:
+            stream.write(dumps(bytecode, source))
+        finally:
+            stream.close()
+        os.rename(tmppath, path)
+    except (OSError, StreamError):
+        pass
+
+# ---------- reading ----------
+
+class Reader(object):
+    def __init__(self, data, size):
+        # data is an rmmap.MMap
+        self.data = data
+        self.size = size
+        self.pos = 0
+
+    def read(self, length):
+        if length < 0 or self.pos + length > self.size:
+            raise CacheError('truncated cache file')
+        result = self.data.getslice(self.pos, length)
+        self.pos += length
+        return result
+
+    def read4(self):
+        return compile.read4(self.read(4), 0)
+
+    def read8(self):
+        low = self.read4() & 0xFFFFFFFF
+        return low | (self.read4() << 32)
+
+    def read_count(self):
+        count = self.read4()
+        # every element takes at least four bytes
+        if count < 0 or count > (self.size - self.pos) / 4:
+            raise CacheError('invalid length')
+        return count
+
+    def read_string(self):
+        return self.read(self.read4())
+
+    def read_bytecode(self):
+        name = self.read_string()
+        numargs = self.read4()
+        stackdepth = self.read4()
+        code = self.read_string()
+        # the lists of a Bytecode are never resized, so they are allocated
+        # with their final size
+        symbols = [''] * self.read_count()
+        for i in range(len(symbols)):
+            symbols[i] = self.read_string()
+        slotnames = [''] * self.read_count()
+        for i in range(len(slotnames)):
+            slotnames[i] = self.read_string()
+        constants = [0] * self.read_count()
+        for i in range(len(constants)):
+            constants[i] = self.read8()
+        layouts = [None] * self.read_count()
+        for i in range(len(layouts)):
+            layout = [''] * self.read_count()
+            for j in range(len(layout)):
+                layout[j] = self.read_string()
+            # new objects store their __parent__ at index 0 of their map,
+            # and every name gets its own index (see objmodel.layout_map)
+            if len(layout) == 0 or layout[0] != '__parent__':
+                raise CacheError('invalid layout')
+            for j in range(1, len(layout)):
+                if layout[j] in layout[:j]:
+                    raise CacheError('invalid layout')
+            layouts[i] = layout
+        subbytecodes = [None] * self.read_count()
+        for i in range(len(subbytecodes)):
+            subbytecodes[i] = self.read_bytecode()
+        if numargs < 0 or numargs > len(symbols):
+            raise CacheError('invalid number of arguments')
+        if slotnames:
+            for symbol in symbols[:numargs] + ['self', '__parent__']:
+                if symbol not in slotnames:
+                    raise CacheError('missing slot')
+        return compile.Bytecode(code, name, symbols, subbytecodes,
+                                numargs, stackdepth, slotnames, constants,
+                                layouts)
+
+    def read_header(self, source):
+        """ Returns True if the cache was written for source and the current
+        instruction set."""
+        return (self.read(len(MAGIC)) == MAGIC and
+                self.read4() == compile.INSTRUCTION_SET_VERSION and
+                self.read(32) == source_digest(source))
+
+def load(fname, source, cache_dir=None):
+    """ Returns the cached Bytecode of the script fname with the given source,
+    or None if there is no valid cache file."""
+    path = cache_path(fname, source, cache_dir)
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        return None
+    try:
+        try:
+            data = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+        except (rmmap.RMMapError, OSError):
+            return None
+    finally:
+        os.close(fd)
+    try:
+        reader = Reader(data, data.size)
+        try:
+            if not reader.read_header(source):
+                return None
+            bytecode = reader.read_bytecode()
+            if reader.pos != reader.size:
+                return None
+            # the file may have been damaged or edited
+            verifier.verify(bytecode)
+            return bytecode
+        except (CacheError, verifier.VerifyError):
+            return None
+    finally:
+        data.close()
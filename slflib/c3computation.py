@@ -1,7 +1,8 @@
 def compute_C3_mro(w_obj):
     order_w = []
     parents_w = w_obj.getparents()
-    orderlists = [w_base.get_mro()
+    # the lists are consumed below, so copy them (they may be cached)
+    orderlists = [w_base.get_mro()[:]
             for w_base in parents_w]
     orderlists.append([w_obj] + parents_w)
     while orderlists:
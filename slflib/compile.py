@@ -1,21 +1,26 @@
 """This file contains the bytecode-compiler.
 
-An instruction can have one or no arguments. There are two different ways how
-an argument is encoded:
+An instruction can have one or no arguments. The code is a sequence of code
+units of two bytes, the opcode and one byte of the argument (0 for
+instructions without an argument). An argument <ARG> is an integer that is
+stored zigzag encoded (0, -1, 1, -2, 2, ... are stored as 0, 1, 2, 3, 4, ...,
+see zigzag), so that small negative numbers are small as well. If it does not
+fit into one byte, the instruction is preceded by up to three units
 
-    ARG4 encodes an argument in 4 bytes, in a little-endian manner
+    EXTENDED_ARG <byte>
 
-    SMALLARG encodes an integer i differently based on its size:
-        if -127 <= i <= 127 the integers is encoded as one byte
-        otherwise it is encoded as 5 bytes:
-            1 marker byte equal to -128 to signify that the large form is used
-            4 bytes to encode the integer as with ARG4
+that hold the higher bytes of the argument, the most significant one first.
 
 The instruction set contains the following instructions:
 
-    INT_LITERAL <SMALLARG>
+    INT_LITERAL <ARG>
     Pushes an integer literal on the stack. The argument is the value of the
-    integer.
+    integer. Only used for integers that fit into one code unit.
+
+    LOAD_CONST <ARG>
+    Pushes an integer literal from the constant pool of the bytecode on the
+    stack. The argument is an index into the constants list of the bytecode
+    object.
 
     IMPLICIT_SELF
     Pushes the implicit self on the stack.
@@ -26,23 +31,28 @@ The instruction set contains the following instructions:
     DUP
     Duplicates the top element of the stack.
 
-    JUMP <ARG4>
-    Unconditionally jump to a different point in the program. The offset of the
-    program counter to the target is given by the argument.
+    JUMP <ARG>
+    Unconditionally jump to a different point in the program. The argument is
+    the index of the code unit of the target (the first EXTENDED_ARG unit of
+    the target instruction, if it has any).
 
-    JUMP_IF_FALSE <ARG4>
+    JUMP_IF_FALSE <ARG>
     Pops an object from the stack and jump to a different point in the program
-    if that object is false. The offset of the program counter to the target is
-    given by the argument.
+    if that object is false. The target is given by the argument, as for
+    JUMP.
 
-    ASSIGNMENT <SMALLARG>
+    JUMP_IF_TRUE <ARG>
+    Like JUMP_IF_FALSE, but jumps if the object is true. This bytecode is only
+    emitted by the peephole optimizer, for loops with the test at the bottom.
+
+    ASSIGNMENT <ARG>
     Assigns the first object on the stack to the second object on the stack.
     The objects are popped from the stack, and then the assigned object
     (i.e. the `expression') is pushed again.  The attribute name is given by
     the argument, which is an index into the symbols list of the bytecode
     object.
 
-    PRIMITIVE_METHOD_CALL <SMALLARG>
+    PRIMITIVE_METHOD_CALL <ARG>
     Call a primitive method. The argument is an index into a list of all
     primitives, which must be defined in the "primitive" module. The arguments
     are found on the stack and are popped by this bytecode; the result is
@@ -50,52 +60,131 @@ The instruction set contains the following instructions:
     the "primitive" module needs to expose a global dictionary
     "primitives_by_name", which maps primitive name to a primitive number.
 
-    METHOD_LOOKUP <SMALLARG>
+    METHOD_LOOKUP <ARG>
     Looks up a method in the object at the top of the stack. The method name
     is given by the argument, which is an index into the symbols list of the
     bytecode object. The method is pushed on the stack (and the original
     object is not removed).
 
-    METHOD_CALL <SMALLARG>
+    METHOD_CALL <ARG>
     Calls a method. The first n (where n is the argument of the bytecode) are
     the arguments to the method, in reverse order. The next object on the
     stack is the method. The final object is the receiver. All these objects
     are popped from the stack. The result of the method call is pushed.
 
-    MAKE_FUNCTION <SMALLARG>
+    MAKE_FUNCTION <ARG>
     Creates a new W_Method object and pushes it on the stack. The bytecode of
     the method can be found in the subbytecodes list of the current bytecode
     object; the index is given by the argument.
 
-    MAKE_OBJECT <SMALLARG>
-    Create a new (empty) object and pushes it on the stack. The argument (which
-    can be ignored for now) is the index in symbols of the name of the object.
+    MAKE_OBJECT <ARG>
+    Create a new object (that only has a __parent__) and pushes it on the
+    stack. The argument is the index in the layouts list of the bytecode
+    object of the attributes the object is predicted to get.
 
-    ASSIGNMENT_APPEND_PARENT <SMALLARG>
+    ASSIGNMENT_APPEND_PARENT <ARG>
     Adds a new parent to an object. This bytecode is only used during object
     creation. It works like the ASSIGNMENT bytecode, but (1) it also adds the
     name to the list of parent attributes of the object, and (2) it leaves
     on the stack the assigned-to object (the `lvalue'), not the assigned
     object (the `expression').
 
-    MAKE_OBJECT_CALL <SMALLARG>
+    MAKE_OBJECT_CALL <ARG>
     Execute the body of a newly created object. The object is on the top of the
     stack and is left there. The bytecode of the body can be found in the
     subbytecodes list of the current bytecode object, the index is given by the
     argument.
 
-    GET_LOCAL <SMALLARG>
+    GET_LOCAL <ARG>
     This is an optimization for the common case of sending a method without
     arguments to the implicit self. This bytecode is equivalent to:
         IMPLICIT_SELF
-        METHOD_LOOKUP <SMALLARG>
+        METHOD_LOOKUP <ARG>
         METHOD_CALL 0
 
-    SET_LOCAL <SMALLARG>
+    SET_LOCAL <ARG>
     This is an optimization for the common case of writing a slot to the
     implicit self. This bytecode is equivalent to:
         IMPLICIT_SELF
-        ASSIGNMENT <SMALLARG>
+        ASSIGNMENT <ARG>
+
+    LOAD_SLOT <ARG>
+    Like GET_LOCAL, for a name that is stored in a slot of the frame (see
+    below). The argument is the index of the slot.
+
+    STORE_SLOT <ARG>
+    Like SET_LOCAL, for a name that is stored in a slot of the frame. The
+    argument is the index of the slot.
+
+    TAIL_METHOD_CALL <ARG>
+    Like METHOD_CALL, for a call whose result is the result of the method
+    that contains it. If the called method is that method, its frame is
+    reused: the arguments are bound to its slots and the execution continues
+    at the start of the code.
+
+The arguments of a method, self, __parent__ and the names the method assigns
+to are stored in slots of the frame instead of the context object (see
+Bytecode.slotnames). The context object is only created when the method uses
+it as an object, e.g. as the receiver of a method call or as the parent of a
+new object or method, at which point the slots are copied into it. From then
+on LOAD_SLOT and STORE_SLOT access the context object. Methods that need the
+context object on every path through their code are compiled without slots
+(see escape.py).
+
+The following superinstructions are fused from pairs of the instructions
+above. The pairs were chosen from the opcode pairs executed most frequently by
+the programs in benchmarks/ (see bench.py --pairs). The pairs with GET_LOCAL
+were measured before methods kept their locals in slots; they are now mostly
+executed by code without slots (the main program, the bodies of objects and
+methods whose context escapes). INT_PRIMITIVE is the most frequent pair
+measured with slots. The other frequent pairs contain LOAD_SLOT, which can
+call a method (see push_local in the interpreter), and are not fused. The
+compiler fuses every
+pair whose second instruction is not a jump target, after the peephole
+optimizer has run (see fuse_superinstructions). A <PAIRARG>
+is an ARG that packs two 16 bit arguments (see pack_args); the first half
+is the argument of the first instruction.
+
+    GET_LOCAL_LOOKUP <PAIRARG>
+    GET_LOCAL followed by METHOD_LOOKUP.
+
+    LOOKUP_GET_LOCAL <PAIRARG>
+    METHOD_LOOKUP followed by GET_LOCAL.
+
+    GET_LOCAL_CALL <PAIRARG>
+    GET_LOCAL followed by METHOD_CALL.
+
+    LOOKUP_INT <PAIRARG>
+    METHOD_LOOKUP followed by INT_LITERAL.
+
+    INT_CALL <PAIRARG>
+    INT_LITERAL followed by METHOD_CALL.
+
+    SET_LOCAL_POP <ARG>
+    SET_LOCAL followed by POP.
+
+    STORE_SLOT_POP <ARG>
+    STORE_SLOT followed by POP.
+
+    POP_GET_LOCAL <ARG>
+    POP followed by GET_LOCAL.
+
+    INT_PRIMITIVE <PAIRARG>
+    INT_LITERAL followed by PRIMITIVE_METHOD_CALL.
+
+The following instructions are never emitted by the compiler. The
+interpreter quickens a call with one argument (METHOD_CALL, TAIL_METHOD_CALL
+or GET_LOCAL_CALL and INT_CALL, which first push the argument) into one of
+them when it calls a method of the integer trait with an integer receiver and
+argument (see the BytecodeInterpreter). The quickened instruction is recorded
+in the QuickeningSite of the call, the code itself is not changed, and the
+interpreter dispatches on it instead of on the call from then on. It does
+what the call does, but computes the result directly, as long as the receiver
+and the argument are integers and the method is still the one that just
+calls the primitive (see Bytecode.get_wrapped_primitive). Otherwise the call
+is dequickened and executed as a normal call:
+
+    INT_ADD, INT_SUB, INT_MUL, INT_DIV, INT_MOD
 
 Note that there is no "return" bytecode. When the end of the bytecode is
 reached, the top of the stack is returned (and the stack should have only one
@@ -103,8 +192,11 @@ element on it).
 """
 import sys
 from pypy.rlib.objectmodel import specialize
+from pypy.rlib import jit
 
 import simpleast
+from inlinecache import InlineCache
+import objmodel
 
 # ---------- bytecodes ----------
 
@@ -119,45 +211,232 @@ ASSIGNMENT_APPEND_PARENT = 10 # index of parentname
 MAKE_OBJECT_CALL = 11         # bytecode literal index
 JUMP_IF_FALSE = 12            # offset
 JUMP = 13                     # offset
+JUMP_IF_TRUE = 14             # offset
 GET_LOCAL = 15                # index of attrname (optimization)
 SET_LOCAL = 16                # index of attrname (optimization)
+LOAD_SLOT = 24                # index of slot
+STORE_SLOT = 25               # index of slot
+TAIL_METHOD_CALL = 27         # number of arguments
+LOAD_CONST = 28               # index of constant
+
+# superinstructions
+GET_LOCAL_LOOKUP = 17         # attrname, method name
+LOOKUP_GET_LOCAL = 18         # method name, attrname
+GET_LOCAL_CALL = 19           # attrname, number of arguments
+LOOKUP_INT = 20               # method name, integer value
+INT_CALL = 21                 # integer value, number of arguments
+SET_LOCAL_POP = 22            # index of attrname
+POP_GET_LOCAL = 23            # index of attrname
+STORE_SLOT_POP = 26           # index of slot
+INT_PRIMITIVE = 29            # integer value, number of the primitive
+
+EXTENDED_ARG = 31             # higher byte of the argument of the next unit
 
 IMPLICIT_SELF = 32            # (no argument)
 POP = 33                      # (no argument)
 DUP = 34                      # (no argument)
 
+# quickened instructions, never encoded
+INT_ADD = 35                  # (no argument)
+INT_SUB = 36                  # (no argument)
+INT_MUL = 37                  # (no argument)
+INT_DIV = 38                  # (no argument)
+INT_MOD = 39                  # (no argument)
+
 opcode_names = [None] * 256
 for key, value in globals().items():
     if key.strip("_").isupper():
         opcode_names[value] = key
 
+# the version of the instruction set, which is stored with compiled bytecode
+# (see bytecodecache.py). It has to be increased whenever the encoding or the
+# meaning of the instructions changes, including the numbering of the
+# primitives.
+INSTRUCTION_SET_VERSION = 9
 
 
 def hasarg(opcode):
     """ Helper function to determine whether an opcode has an argument."""
     return opcode < 32
 
+def isquickened(opcode):
+    """ Helper function to determine whether an opcode is only created by
+    quickening."""
+    return INT_ADD <= opcode <= INT_MOD
+
 def isjump(opcode):
     """ Helper function to determine whether an opcode is a jump."""
-    return opcode == JUMP_IF_FALSE or opcode == JUMP
+    return (opcode == JUMP_IF_FALSE or opcode == JUMP or
+            opcode == JUMP_IF_TRUE)
+
+
+# maps pairs of opcodes to the superinstruction that replaces them
+superinstructions = {
+    (GET_LOCAL, METHOD_LOOKUP): GET_LOCAL_LOOKUP,
+    (METHOD_LOOKUP, GET_LOCAL): LOOKUP_GET_LOCAL,
+    (GET_LOCAL, METHOD_CALL): GET_LOCAL_CALL,
+    (METHOD_LOOKUP, INT_LITERAL): LOOKUP_INT,
+    (INT_LITERAL, METHOD_CALL): INT_CALL,
+    (SET_LOCAL, POP): SET_LOCAL_POP,
+    (POP, GET_LOCAL): POP_GET_LOCAL,
+    (STORE_SLOT, POP): STORE_SLOT_POP,
+    (INT_LITERAL, PRIMITIVE_METHOD_CALL): INT_PRIMITIVE,
+}
 
+# maps the quickened instructions to the names of the primitives they call
+quickened_primitives = {
+    INT_ADD: '$int_add',
+    INT_SUB: '$int_sub',
+    INT_MUL: '$int_mul',
+    INT_DIV: '$int_div',
+    INT_MOD: '$int_mod',
+}
 
-class Bytecode(object):
+def fits16(value):
+    return -0x8000 <= value < 0x8000
+
+def pack_args(first, second):
+    """ Packs the arguments of the two halves of a superinstruction into one
+    argument. Both arguments must fit into 16 bits."""
+    assert fits16(first) and fits16(second)
+    return (first << 16) | (second & 0xFFFF)
+
+def first_arg(packed):
+    return packed >> 16
+
+def second_arg(packed):
+    second = packed & 0xFFFF
+    if second >= 0x8000:
+        second -= 0x10000
+    return second
+
+def fuse_superinstructions(opcodes, args):
+    """ Returns the opcodes and arguments of the instructions given by
+    opcodes and args (with jumps to instruction indices), with pairs of
+    instructions replaced by superinstructions. The second instruction of a
+    fused pair must not be a jump target."""
+    is_target = [False] * (len(opcodes) + 1)
+    for i in range(len(opcodes)):
+        if isjump(opcodes[i]):
+            is_target[args[i]] = True
+    resultopcodes = []
+    resultargs = []
+    # maps the index of every instruction to its index in the result
+    indices = [0] * (len(opcodes) + 1)
+    i = 0
+    while i < len(opcodes):
+        indices[i] = len(resultopcodes)
+        opcode = opcodes[i]
+        arg = args[i]
+        fused = -1
+        if i + 1 < len(opcodes) and not is_target[i + 1]:
+            fused = superinstructions.get((opcode, opcodes[i + 1]), -1)
+        if fused != -1:
+            nextopcode = opcodes[i + 1]
+            nextarg = args[i + 1]
+            if hasarg(opcode) and hasarg(nextopcode):
+                if fits16(arg) and fits16(nextarg):
+                    arg = pack_args(arg, nextarg)
+                else:
+                    fused = -1
+            elif hasarg(nextopcode):
+                arg = nextarg
+        if fused != -1:
+            resultopcodes.append(fused)
+            i += 2
+        else:
+            resultopcodes.append(opcode)
+            i += 1
+        resultargs.append(arg)
+    indices[len(opcodes)] = len(resultopcodes)
+    for i in range(len(resultopcodes)):
+        if isjump(resultopcodes[i]):
+            resultargs[i] = indices[resultargs[i]]
+    return resultopcodes, resultargs
+
+def is_quickenable(opcode, arg):
+    """ Returns whether an instruction is a call with one argument, which can
+    be quickened (the fused calls included)."""
+    if opcode == METHOD_CALL or opcode == TAIL_METHOD_CALL:
+        return arg == 1
+    if opcode == GET_LOCAL_CALL or opcode == INT_CALL:
+        return second_arg(arg) == 1
+    return False
+
+def lookup_count(opcode):
+    """ Returns the number of attribute lookups (and hence inline caches) of
+    an instruction."""
+    if opcode == GET_LOCAL_LOOKUP or opcode == LOOKUP_GET_LOCAL:
+        return 2
+    if (opcode == METHOD_LOOKUP or opcode == GET_LOCAL or
+            opcode == GET_LOCAL_CALL or opcode == LOOKUP_INT or
+            opcode == POP_GET_LOCAL or opcode == LOAD_SLOT):
+        return 1
+    return 0
+
+
+class Code(object):
+    """ Base class of the compiled code of the backends (Bytecode for the
+    stack machine, regcompile.RegisterCode for the register machine)."""
+
+    def copy(self):
+        """ Returns a copy of the code (and of its subcodes) with new inline
+        caches. The methods of the builtins of every interpreter use their
+        own copy (see BuiltinsImage), as the entries of the caches are keyed
+        on the objects of one interpreter."""
+        raise NotImplementedError
+
+
+class StackCode(Code):
+    """ Base class of the code of the stack machine, a Bytecode or a
+    LazyBytecode stub of one. As the code of the methods of the stack machine
+    has its own base class, the translated interpreter (which has no register
+    machine) never calls the methods of regcompile.RegisterCode on it."""
+
+    def get_bytecode(self):
+        """ Returns the Bytecode of the code, compiling it first if it is a
+        LazyBytecode."""
+        raise NotImplementedError
+
+
+class Bytecode(StackCode):
     """ A class representing the bytecode of one piece of code.
 
-    self.code is a string that encodes the bytecode itself.
+    self.code is a string that encodes the bytecode itself (see encode).
 
     self.symbols is a list of strings containing the names that occur in the
     piece of code.
 
+    self.constants is the constant pool, a list of the integer literals of
+    the piece of code that are too large to be encoded in the instructions.
+    The integer objects are created once for each IntegerSpace (see
+    get_constants).
+
     self.subbytecodes is a list of further bytecodes that occur in the piece of
-    code.
+    code. They can be LazyBytecode stubs, which are compiled when they are
+    first run.
+
+    self.slotnames is the list of names that are stored in slots of the frame
+    (empty, unless the code is the body of a method). argument_slots,
+    self_slot and parent_slot are the slots that the arguments, self and
+    __parent__ are stored in when the method is called.
+
+    self.layouts holds a list of attribute names for every MAKE_OBJECT of the
+    piece of code: the __parent__, the parent attributes and the names that
+    the body of the object assigns, in the order of the assignments.
+    self.layout_maps holds the map of every layout (see objmodel.layout_map).
+    The object starts out with that map, so the assignments of its body
+    write to the indexes the map already has (see objmodel.new_object).
     """
-    _immutable_ = True
-    _immutable_fields_ = ["symbols[*]", "subbytecodes[*]"]
+    _immutable_fields_ = ["code", "name", "symbols[*]", "subbytecodes[*]",
+                          "numargs", "stackdepth", "decoded?", "slotnames[*]",
+                          "argument_slots[*]", "self_slot", "parent_slot",
+                          "constants[*]", "w_constants?", "constants_space?",
+                          "layouts[*]", "layout_maps[*]"]
 
     def __init__(self, code, name, symbols,
-                 subbytecodes, numargs, stackdepth):
+                 subbytecodes, numargs, stackdepth, slotnames=None,
+                 constants=None, layouts=None):
         self.code = code
         if name is None:
             name = "?"
@@ -166,28 +445,408 @@ class Bytecode(object):
         self.subbytecodes = subbytecodes
         self.numargs = numargs
         self.stackdepth = stackdepth
+        self.decoded = None
+        # set by verifier.verify
+        self.verified = False
+        if constants is None:
+            constants = []
+        self.constants = constants
+        if layouts is None:
+            layouts = []
+        self.layouts = layouts
+        layout_maps = [None] * len(layouts)
+        for i in range(len(layouts)):
+            layout_maps[i] = objmodel.layout_map(layouts[i])
+        self.layout_maps = layout_maps
+        self.w_constants = None
+        self.constants_space = None
+        if slotnames is None:
+            slotnames = []
+        self.slotnames = slotnames
+        argument_slots = [-1] * numargs
+        self.self_slot = -1
+        self.parent_slot = -1
+        if slotnames:
+            # the arguments are the first symbols
+            for i in range(numargs):
+                argument_slots[i] = slotnames.index(symbols[i])
+            self.self_slot = slotnames.index('self')
+            self.parent_slot = slotnames.index('__parent__')
+        self.argument_slots = argument_slots
+        # computed by get_wrapped_primitive
+        self.wrapped_primitive = -2
+
+    def uses_slots(self):
+        return len(self.slotnames) > 0
+
+    def get_constants(self, space):
+        """ Returns the integer objects of the constant pool, created in the
+        IntegerSpace space. They are kept until the code is run in another
+        space."""
+        if self.constants_space is not space:
+            self.w_constants = [space.newint(value)
+                                for value in self.constants]
+            self.constants_space = space
+        return self.w_constants
+
+    def get_bytecode(self):
+        return self
+
+    def copy(self):
+        subbytecodes = [None] * len(self.subbytecodes)
+        for i in range(len(subbytecodes)):
+            subbytecodes[i] = self.subbytecodes[i].copy()
+        result = Bytecode(self.code, self.name, self.symbols, subbytecodes,
+                          self.numargs, self.stackdepth, self.slotnames,
+                          self.constants, self.layouts)
+        result.verified = self.verified
+        return result
+
+    def get_wrapped_primitive(self):
+        """ Returns the number of the primitive if the code is the body of a
+        method that only calls that primitive on self with its one argument
+        (like the methods of the integer trait), otherwise -1. Calling such a
+        method with an integer receiver and argument is the same as calling
+        the primitive."""
+        wrapped = self.wrapped_primitive
+        if wrapped == -2:
+            wrapped = -1
+            decoded = self.get_decoded()
+            opcodes = decoded.opcodes
+            args = decoded.args
+            if (self.numargs == 1 and self.uses_slots() and
+                    len(opcodes) == 3 and
+                    opcodes[0] == LOAD_SLOT and args[0] == self.self_slot and
+                    opcodes[1] == LOAD_SLOT and
+                    args[1] == self.argument_slots[0] and
+                    opcodes[2] == PRIMITIVE_METHOD_CALL):
+                import primitives
+                if primitives.all_primitives_arg_count[args[2]] == 1:
+                    wrapped = args[2]
+            self.wrapped_primitive = wrapped
+        return wrapped
+
+    def get_decoded(self):
+        """ Returns the decoded form of self.code, building it on first use."""
+        decoded = self.decoded
+        if decoded is None:
+            decoded = decode(self.code)
+            self.decoded = decoded
+        return decoded
 
     def dis(self, pc=-1):
         from disass import disassemble
         disassemble(self, pc=pc)
 
 
+class LazyBytecode(StackCode):
+    """ A stub for the code of a method or object body that is not compiled
+    yet. MAKE_FUNCTION and MAKE_OBJECT_CALL can refer to it like to a
+    Bytecode; it is compiled (and verified) when it is first run, and the
+    Bytecode is kept in self.bytecode.
+
+    A copy of a stub (see Code.copy) compiles through the stub it was copied
+    from, so that the body is compiled only once.
+    """
+    _immutable_fields_ = ["argumentnames[*]", "name", "optimize", "use_slots",
+                          "original", "bytecode?"]
+
+    def __init__(self, ast, argumentnames, name, optimize, use_slots,
+                 original=None):
+        self.ast = ast
+        self.argumentnames = argumentnames
+        self.name = name
+        self.optimize = optimize
+        self.use_slots = use_slots
+        self.original = original
+        self.bytecode = None
+
+    def get_bytecode(self):
+        bytecode = self.bytecode
+        if bytecode is None:
+            bytecode = self.compile()
+            self.bytecode = bytecode
+            # the AST is not needed any more
+            self.ast = None
+        return bytecode
+
+    def compile(self):
+        if self.original is not None:
+            bytecode = self.original.get_bytecode().copy()
+        else:
+            bytecode = compile(self.ast, self.argumentnames, self.name,
+                               self.optimize, self.use_slots, lazy=True)
+        assert isinstance(bytecode, Bytecode)
+        import verifier
+        verifier.verify(bytecode)
+        return bytecode
+
+    def copy(self):
+        if self.bytecode is not None:
+            return self.bytecode.copy()
+        original = self.original
+        if original is None:
+            original = self
+        return LazyBytecode(None, self.argumentnames, self.name, self.optimize,
+                            self.use_slots, original)
+
+
+class DecodedCode(object):
+    """ The decoded form of the string encoding of a Bytecode.
+
+    self.opcodes and self.args are parallel lists holding one entry per
+    instruction. Instructions without an argument have an argument of 0. The
+    arguments of jumps are already resolved to the index of the target
+    instruction (which is len(self.opcodes) for a jump to the end).
+
+    self.positions maps the index of an instruction back to its offset in the
+    string encoding, for the disassembler and debugging output.
+
+    self.caches holds the inline cache of every instruction that looks up an
+    attribute (and None for all other instructions). Superinstructions that
+    do two lookups keep the cache of the second one in self.second_caches.
+
+    self.sites holds the QuickeningSite of every call with one argument (and
+    None for all other instructions).
+    """
+    _immutable_ = True
+    _immutable_fields_ = ["opcodes[*]", "args[*]", "positions[*]", "caches[*]",
+                          "second_caches[*]", "sites[*]"]
+
+    def __init__(self, opcodes, args, positions):
+        self.opcodes = opcodes
+        self.args = args
+        self.positions = positions
+        caches = [None] * len(opcodes)
+        second_caches = [None] * len(opcodes)
+        sites = [None] * len(opcodes)
+        for i in range(len(opcodes)):
+            count = lookup_count(opcodes[i])
+            if count > 0:
+                caches[i] = InlineCache()
+            if count > 1:
+                second_caches[i] = InlineCache()
+            if is_quickenable(opcodes[i], args[i]):
+                sites[i] = QuickeningSite()
+        self.caches = caches
+        self.second_caches = second_caches
+        self.sites = sites
+
+    def get_opcode(self, index):
+        """ Returns the opcode of an instruction, or the quickened opcode of
+        its call if it was quickened."""
+        site = self.sites[index]
+        if site is not None and site.code is not None:
+            return site.opcode
+        return self.opcodes[index]
+
+
+class QuickeningSite(object):
+    """ The quickening state of a call with one argument.
+
+    When the interpreter has quickened the call, opcode is the quickened
+    instruction that replaces it (e.g. INT_ADD) and code is the code of the
+    method that the call was quickened for (otherwise code is None). Calls
+    that could not be quickened when they were first executed, or that failed
+    the guard of their quickened instruction, are marked as failed and never
+    quickened (again). The fields are quasi-immutable, so that traces of the
+    JIT treat them as constants and are invalidated when they change.
+    """
+    _immutable_fields_ = ["opcode?", "code?", "failed?"]
+
+    def __init__(self):
+        self.opcode = -1
+        self.code = None
+        self.failed = False
+
+    def quicken(self, opcode, code):
+        self.opcode = opcode
+        self.code = code
+
+    def dequicken(self):
+        self.opcode = -1
+        self.code = None
+        self.failed = True
+
+
+def encode4(value):
+    return [chr(value & 0xFF),
+            chr((value >> 8) & 0xFF),
+            chr((value >> 16) & 0xFF),
+            chr((value >> 24) & 0xFF)]
+
+def read4(code, pc):
+    highval = ord(code[pc+3])
+    if highval >= 128:
+        highval -= 256
+    return (ord(code[pc]) |
+            (ord(code[pc+1]) << 8) |
+            (ord(code[pc+2]) << 16) |
+            (highval << 24))
+
+def zigzag(value):
+    """ Maps a 32 bit integer to an unsigned integer, small negative integers
+    to small unsigned ones."""
+    if value < 0:
+        return ((-value) << 1) - 1
+    return value << 1
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def argument_units(unsigned):
+    """ Returns the number of code units an argument needs."""
+    units = 1
+    while unsigned >= 256:
+        unsigned >>= 8
+        units += 1
+    return units
+
+def encode(opcodes, args):
+    """ Turns a list of instructions into the string encoding of a Bytecode.
+    The arguments of jumps are the indices of the target instructions (which
+    is len(opcodes) for a jump to the end)."""
+    # the arguments of jumps depend on the positions of their targets, which
+    # depend on the sizes of the arguments before them. The sizes only grow
+    # in every round, so this terminates.
+    sizes = [1] * len(opcodes)
+    for i in range(len(opcodes)):
+        if not isjump(opcodes[i]):
+            sizes[i] = argument_units(zigzag(args[i]))
+    positions = [0] * (len(opcodes) + 1)
+    changed = True
+    while changed:
+        changed = False
+        position = 0
+        for i in range(len(opcodes)):
+            positions[i] = position
+            position += sizes[i]
+        positions[len(opcodes)] = position
+        for i in range(len(opcodes)):
+            if isjump(opcodes[i]):
+                size = argument_units(zigzag(positions[args[i]]))
+                if size > sizes[i]:
+                    sizes[i] = size
+                    changed = True
+    code = []
+    for i in range(len(opcodes)):
+        arg = args[i]
+        if isjump(opcodes[i]):
+            arg = positions[arg]
+        unsigned = zigzag(arg)
+        for j in range(sizes[i] - 1, 0, -1):
+            code.append(chr(EXTENDED_ARG))
+            code.append(chr((unsigned >> (8 * j)) & 0xFF))
+        code.append(chr(opcodes[i]))
+        code.append(chr(unsigned & 0xFF))
+    return ''.join(code)
+
+@jit.dont_look_inside
+def decode(code):
+    """ Turns the string encoding of a piece of bytecode into a DecodedCode."""
+    # the lists are immutable in DecodedCode, so they must not be resized;
+    # they are allocated with the number of instructions
+    count = 0
+    for pc in range(0, len(code), 2):
+        if ord(code[pc]) != EXTENDED_ARG:
+            count += 1
+    opcodes = [0] * count
+    args = [0] * count
+    positions = [0] * count
+    pc = 0
+    i = 0
+    while pc < len(code):
+        positions[i] = pc
+        opcode = ord(code[pc])
+        arg = ord(code[pc + 1])
+        pc += 2
+        while opcode == EXTENDED_ARG:
+            opcode = ord(code[pc])
+            arg = (arg << 8) | ord(code[pc + 1])
+            pc += 2
+        opcodes[i] = opcode
+        args[i] = unzigzag(arg)
+        i += 1
+    # resolve the targets of jumps to instruction indices
+    indices = {}
+    for i in range(len(positions)):
+        indices[positions[i] >> 1] = i
+    indices[len(code) >> 1] = len(positions)
+    for i in range(len(opcodes)):
+        if isjump(opcodes[i]):
+            args[i] = indices[args[i]]
+    return DecodedCode(opcodes, args, positions)
+
+
 # ---------- compiler ----------
 
-def compile(ast, argumentnames=[], name=None):
-    """ Turns an AST into a Bytecode object."""
+def compile(ast, argumentnames=[], name=None, optimize=False,
+            use_slots=False, lazy=False):
+    """ Turns an AST into a Bytecode object. If optimize is true, the code is
+    run through the peephole optimizer. If use_slots is true, the code is the
+    body of a method, whose arguments and local names are stored in slots. If
+    lazy is true, the bodies of the methods and objects in the code are
+    compiled when they are first run (see LazyBytecode)."""
     assert isinstance(ast, simpleast.Program)
-    comp = Compiler()
+    comp = Compiler(optimize, lazy)
     for arg in argumentnames:
         comp.lookup_symbol(arg)
     comp.lookup_symbol("__parent__")
     comp.lookup_symbol("self")
-    comp.compile(ast, True)
+    if use_slots:
+        for arg in argumentnames:
+            comp.add_slot(arg)
+        comp.add_slot("self")
+        comp.add_slot("__parent__")
+        for name in assigned_names(ast):
+            comp.add_slot(name)
+    # the result of the last expression of a method is its result
+    comp.compile(ast, True, tail=use_slots)
+    if use_slots:
+        import escape
+        if escape.analyze_code(comp.opcodes, comp.args) == escape.ALWAYS:
+            # the context object is needed anyway, so there is no point in
+            # keeping the locals in slots
+            comp.remove_slots()
     return comp.make_bytecode(len(argumentnames), name)
 
+def assigned_names(ast, result=None):
+    """ Returns the names that the code of ast assigns to the implicit self
+    (not including the code of nested methods and objects)."""
+    if result is None:
+        result = []
+    if isinstance(ast, simpleast.Program):
+        for statement in ast.statements:
+            assigned_names(statement, result)
+    elif isinstance(ast, simpleast.Assignment):
+        if isinstance(ast.lvalue, simpleast.ImplicitSelf):
+            result.append(ast.attrname)
+    elif isinstance(ast, simpleast.FunctionDefinition):
+        result.append(ast.name)
+    elif isinstance(ast, simpleast.ObjectDefinition):
+        result.append(ast.name)
+    elif isinstance(ast, simpleast.IfStatement):
+        assigned_names(ast.ifblock, result)
+        if ast.elseblock:
+            assigned_names(ast.elseblock, result)
+    elif isinstance(ast, simpleast.WhileStatement):
+        assigned_names(ast.whileblock, result)
+    return result
+
+def object_layout(astnode):
+    """ Returns the names of the attributes that the object created by the
+    ObjectDefinition astnode is predicted to have, in the order in which they
+    are assigned. The object starts out with its __parent__."""
+    layout = ['__parent__']
+    for name in astnode.parentnames + assigned_names(astnode.block):
+        if name not in layout:
+            layout.append(name)
+    return layout
+
 
 stack_effects = {
     INT_LITERAL: 1,
+    LOAD_CONST: 1,
     ASSIGNMENT: -1,
     METHOD_LOOKUP: 1,
     MAKE_FUNCTION: 1,
@@ -196,20 +855,61 @@ stack_effects = {
     MAKE_OBJECT_CALL: 0,
     GET_LOCAL: 1,
     SET_LOCAL: 0,
+    GET_LOCAL_LOOKUP: 2,
+    LOOKUP_GET_LOCAL: 2,
+    LOOKUP_INT: 2,
+    SET_LOCAL_POP: -1,
+    POP_GET_LOCAL: 0,
+    LOAD_SLOT: 1,
+    STORE_SLOT: 0,
+    STORE_SLOT_POP: -1,
     JUMP: 0,
     JUMP_IF_FALSE: -1,
+    JUMP_IF_TRUE: -1,
     IMPLICIT_SELF: 1,
     POP: -1,
     DUP: 1,
 }
 
 
+def get_stack_effect(opcode, arg):
+    """ Returns the stack effect of an instruction."""
+    if opcode == METHOD_CALL or opcode == TAIL_METHOD_CALL:
+        return -arg - 1
+    if opcode == GET_LOCAL_CALL or opcode == INT_CALL:
+        return -second_arg(arg)
+    if opcode == PRIMITIVE_METHOD_CALL:
+        import primitives
+        return -primitives.all_primitives_arg_count[arg]
+    if opcode == INT_PRIMITIVE:
+        import primitives
+        return 1 - primitives.all_primitives_arg_count[second_arg(arg)]
+    return stack_effects[opcode]
+
+def get_stack_peak(opcode, arg):
+    """ Returns how far the stack grows beyond its depth before an
+    instruction while the instruction is executed."""
+    if (opcode == GET_LOCAL_CALL or opcode == INT_CALL or
+            opcode == INT_PRIMITIVE):
+        # the result of the first half is pushed before the call
+        return 1
+    return max(get_stack_effect(opcode, arg), 0)
+
+
 class Compiler(object):
 
-    def __init__(self):
-        self.code = []
+    def __init__(self, optimize=False, lazy=False):
+        self.optimize = optimize
+        self.lazy = lazy
+        # the instructions; the arguments of jumps are instruction indices
+        self.opcodes = []
+        self.args = []
         self.symbols = {}
+        self.constants = []
+        self.layouts = []
+        self.slots = {}
         self.subbytecodes = []
+        self.tail = False
         self.stackdepth = 0
         self.max_stackdepth = 0
 
@@ -217,12 +917,31 @@ class Compiler(object):
         symbols = [None] * len(self.symbols)
         for name, index in self.symbols.items():
             symbols[index] = name
-        result = Bytecode(''.join(self.code),
+        assert self.stackdepth == 1
+        stackdepth = self.max_stackdepth
+        opcodes = self.opcodes
+        args = self.args
+        if self.optimize:
+            import peephole
+            optimizer = peephole.Optimizer(opcodes, args)
+            optimizer.optimize()
+            stackdepth = optimizer.compute_stackdepth()
+            opcodes, args = optimizer.get_code()
+        # the superinstructions are fused last, so that the optimizer only
+        # sees the plain instructions
+        opcodes, args = fuse_superinstructions(opcodes, args)
+        code = encode(opcodes, args)
+        slotnames = [None] * len(self.slots)
+        for name, index in self.slots.items():
+            slotnames[index] = name
+        # the lists of a Bytecode are never resized, so the lists of the
+        # compiler are copied
+        result = Bytecode(code,
                         funcname,
                         symbols,
-                        self.subbytecodes,
-                        numargs, self.max_stackdepth)
-        assert self.stackdepth == 1
+                        self.subbytecodes[:],
+                        numargs, stackdepth, slotnames, self.constants[:],
+                        self.layouts[:])
         return result
 
     def stack_effect(self, num):
@@ -231,21 +950,15 @@ class Compiler(object):
 
     @specialize.argtype(2)
     def emit(self, opcode, arg=None, stackeffect=sys.maxint):
-        self.code.append(chr(opcode))
         if isjump(opcode):
             assert arg is None
-            for c in self.encode4(0):
-                self.code.append(c)
+            self.write(opcode, 0)
         elif hasarg(opcode):
             assert isinstance(arg, int)
-            if -127 <= arg <= 127:
-                self.code.append(chr(arg & 0xFF))
-            else:
-                self.code.append(chr(128))
-                for c in self.encode4(arg):
-                    self.code.append(c)
+            self.write(opcode, arg)
         else:
             assert arg is None
+            self.write(opcode, 0)
 
         if opcode in stack_effects:
             stackeffect = stack_effects[opcode]
@@ -253,33 +966,78 @@ class Compiler(object):
             assert stackeffect != sys.maxint
         self.stack_effect(stackeffect)
 
+    def write(self, opcode, arg):
+        """ Appends an instruction to the code."""
+        self.opcodes.append(opcode)
+        self.args.append(arg)
+
     def get_position(self):
-        return len(self.code)
+        """ Returns the index of the next instruction."""
+        return len(self.opcodes)
 
     def set_target_position(self, oldposition, newtarget):
-        offset = newtarget - (oldposition+5)
-        i = 0
-        for c in self.encode4(offset):
-            self.code[oldposition+1+i] = c
-            i += 1
-
-    def encode4(self, value):
-        return [chr(value & 0xFF),
-                chr((value >> 8) & 0xFF),
-                chr((value >> 16) & 0xFF),
-                chr((value >> 24) & 0xFF)]
+        self.args[oldposition] = newtarget
 
     def lookup_symbol(self, symbol):
         if symbol not in self.symbols:
             self.symbols[symbol] = len(self.symbols)
         return self.symbols[symbol]
 
+    def lookup_constant(self, value):
+        if value not in self.constants:
+            self.constants.append(value)
+        return self.constants.index(value)
+
+    def add_slot(self, name):
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+
+    def remove_slots(self):
+        """ Turns the code emitted so far into code that keeps its locals in
+        the context object, by replacing the instructions that access slots
+        (and tail calls, which need slots)."""
+        slotnames = [None] * len(self.slots)
+        for name, index in self.slots.items():
+            slotnames[index] = name
+        for i in range(len(self.opcodes)):
+            opcode = self.opcodes[i]
+            if opcode == LOAD_SLOT:
+                self.opcodes[i] = GET_LOCAL
+            elif opcode == STORE_SLOT:
+                self.opcodes[i] = SET_LOCAL
+            elif opcode == TAIL_METHOD_CALL:
+                self.opcodes[i] = METHOD_CALL
+                continue
+            else:
+                continue
+            self.args[i] = self.lookup_symbol(slotnames[self.args[i]])
+        self.slots = {}
+
+    def emit_get_local(self, name):
+        if name in self.slots:
+            self.emit(LOAD_SLOT, self.slots[name])
+        else:
+            self.emit(GET_LOCAL, self.lookup_symbol(name))
 
-    def compile(self, ast, needsresult=True):
+    def emit_set_local(self, name):
+        if name in self.slots:
+            self.emit(STORE_SLOT, self.slots[name])
+        else:
+            self.emit(SET_LOCAL, self.lookup_symbol(name))
+
+
+    def compile(self, ast, needsresult=True, tail=False):
+        # tail is true if the result of ast is the result of the method, the
+        # compile_* methods read it before compiling the children of ast
+        self.tail = tail
         return ast.dispatch(self, needsresult)
 
     def compile_IntLiteral(self, astnode, needsresult):
-        self.emit(INT_LITERAL, astnode.value)
+        value = astnode.value
+        if argument_units(zigzag(value)) == 1:
+            self.emit(INT_LITERAL, value)
+        else:
+            self.emit(LOAD_CONST, self.lookup_constant(value))
 
     def compile_ImplicitSelf(self, astnode, needsresult):
         self.emit(IMPLICIT_SELF)
@@ -287,7 +1045,7 @@ class Compiler(object):
     def compile_Assignment(self, astnode, needsresult):
         if isinstance(astnode.lvalue, simpleast.ImplicitSelf):
             self.compile(astnode.expression)
-            self.emit(SET_LOCAL, self.lookup_symbol(astnode.attrname))
+            self.emit_set_local(astnode.attrname)
         else:
             self.compile(astnode.lvalue)
             self.compile(astnode.expression)
@@ -296,21 +1054,25 @@ class Compiler(object):
             self.emit(POP)
 
     def compile_ExprStatement(self, astnode, needsresult):
-        self.compile(astnode.expression)
+        self.compile(astnode.expression, tail=self.tail and needsresult)
         if not needsresult:
             self.emit(POP)
 
     def compile_MethodCall(self, astnode, needsresult):
+        tail = self.tail
         numargs = len(astnode.arguments)
         if (isinstance(astnode.receiver, simpleast.ImplicitSelf) and
                 numargs == 0):
-            self.emit(GET_LOCAL, self.lookup_symbol(astnode.methodname))
+            self.emit_get_local(astnode.methodname)
         else:
             self.compile(astnode.receiver)
             self.emit(METHOD_LOOKUP, self.lookup_symbol(astnode.methodname))
             for arg in astnode.arguments:
                 self.compile(arg)
-            self.emit(METHOD_CALL, numargs, -numargs - 1)
+            if tail:
+                self.emit(TAIL_METHOD_CALL, numargs, -numargs - 1)
+            else:
+                self.emit(METHOD_CALL, numargs, -numargs - 1)
 
     def compile_PrimitiveMethodCall(self, astnode, needsresult):
         import primitives
@@ -327,7 +1089,8 @@ class Compiler(object):
         self.emit(PRIMITIVE_METHOD_CALL, index, -len(astnode.arguments))
 
     def compile_ObjectDefinition(self, astnode, needsresult):
-        self.emit(MAKE_OBJECT, self.lookup_symbol(astnode.name))
+        self.emit(MAKE_OBJECT, len(self.layouts))
+        self.layouts.append(object_layout(astnode))
         #
         for i in range(len(astnode.parentdefinitions)):
             name = astnode.parentnames[i]
@@ -340,47 +1103,57 @@ class Compiler(object):
                 self.compile(astnode.parentdefinitions[i])
                 self.emit(ASSIGNMENT_APPEND_PARENT, self.lookup_symbol(name))
         #
-        bytecode = compile(astnode.block, name=astnode.name)
+        bytecode = self.compile_body(astnode.block, [], astnode.name, False)
         index = len(self.subbytecodes)
         self.subbytecodes.append(bytecode)
         self.emit(MAKE_OBJECT_CALL, index)
-        self.emit(SET_LOCAL, self.lookup_symbol(astnode.name))
+        self.emit_set_local(astnode.name)
         if not needsresult:
             self.emit(POP)
 
+    def compile_body(self, ast, argumentnames, name, use_slots):
+        """ Returns the code of the body of a nested method or object."""
+        if self.lazy:
+            return LazyBytecode(ast, argumentnames, name, self.optimize,
+                                use_slots)
+        return compile(ast, argumentnames, name, self.optimize, use_slots)
+
     def compile_Program(self, astnode, needsresult):
+        tail = self.tail
         for statement in astnode.statements[:-1]:
             self.compile(statement, needsresult=False)
         laststatement = astnode.statements[-1]
-        self.compile(laststatement, needsresult)
+        self.compile(laststatement, needsresult, tail)
 
     def compile_FunctionDefinition(self, astnode, needsresult):
-        bytecode = compile(astnode.block, astnode.arguments, astnode.name)
+        bytecode = self.compile_body(astnode.block, astnode.arguments,
+                                     astnode.name, True)
         index = len(self.subbytecodes)
         self.subbytecodes.append(bytecode)
         self.emit(MAKE_FUNCTION, index)
-        self.emit(SET_LOCAL, self.lookup_symbol(astnode.name))
+        self.emit_set_local(astnode.name)
         if not needsresult:
             self.emit(POP)
 
     def compile_IfStatement(self, astnode, needsresult):
-        # XXX this can compute the needed stack by one too much
+        tail = self.tail
         self.compile(astnode.condition)
         position1 = self.get_position()
         self.emit(JUMP_IF_FALSE)
         #
-        self.compile(astnode.ifblock, needsresult)
+        self.compile(astnode.ifblock, needsresult, tail)
         position2 = self.get_position()
         self.emit(JUMP)
+        # the result of the if block is not on the stack in the else block
+        if needsresult:
+            self.stack_effect(-1)
         #
         self.set_target_position(position1, self.get_position())
         if astnode.elseblock:
-            self.compile(astnode.elseblock, needsresult)
+            self.compile(astnode.elseblock, needsresult, tail)
         else:
             if needsresult:
                 self.emit(IMPLICIT_SELF)
-        if needsresult:
-            self.stack_effect(-1)
         #
         self.set_target_position(position2, self.get_position())
 
@@ -10,47 +10,29 @@ def disassemble(bytecode, indent='', pc=-1):
 
 
 opcode2name = {}
-for name, value in compile.__dict__.items():
-    if name == name.upper() and isinstance(value, int):
-        opcode2name[value] = name
+for value in range(len(compile.opcode_names)):
+    if compile.opcode_names[value] is not None:
+        opcode2name[value] = compile.opcode_names[value]
 
 
 class AbstractDisassembler(object):
     special_methods = {}
 
-    def read4(self, code, pc):
-        highval = ord(code[pc+3])
-        if highval >= 128:
-            highval -= 256
-        return (ord(code[pc]) |
-                (ord(code[pc+1]) << 8) |
-                (ord(code[pc+2]) << 16) |
-                (highval << 24))
-
     def disassemble(self, bytecode, currpc=-1):
         self.currpc = currpc
         self.bytecode = bytecode
-        code = bytecode.code
-        pc = 0
-        while pc < len(code):
+        decoded = compile.decode(bytecode.code)
+        for i in range(len(decoded.opcodes)):
+            pc = decoded.positions[i]
             self.start(pc)
-            opcode = ord(code[pc])
-            pc += 1
+            opcode = decoded.opcodes[i]
+            oparg = decoded.args[i]
             if compile.isjump(opcode):
-                oparg = self.read4(code, pc)
-                pc += 4
-            elif compile.hasarg(opcode):
-                oparg = ord(code[pc])
-                pc += 1
-                if oparg >= 128:
-                    if oparg > 128:
-                        oparg -= 256
-                    else:
-                        oparg = self.read4(code, pc)
-                        pc += 4
-            else:
-                oparg = 0
-            self.pc = pc
+                # the position of the target
+                if oparg < len(decoded.positions):
+                    oparg = decoded.positions[oparg]
+                else:
+                    oparg = len(bytecode.code)
             self.end(opcode, oparg)
             name = opcode2name[opcode]
             try:
@@ -75,7 +57,7 @@ class FindLabelTargets(AbstractDisassembler):
         self.targets = {}
 
     def JUMP_IF_FALSE(self, opcode, oparg):
-        self.targets[self.pc + oparg] = True
+        self.targets[oparg] = True
 
     JUMP = JUMP_IF_FALSE
 
@@ -98,9 +80,10 @@ class Disassembler(AbstractDisassembler):
         print self.indent, '\t', opcode2name[opcode],
 
     def JUMP_IF_FALSE(self, opcode, oparg):
-        print '\t', '-->', self.pc + oparg
+        print '\t', '-->', oparg
 
     JUMP = JUMP_IF_FALSE
+    JUMP_IF_TRUE = JUMP_IF_FALSE
 
     def ASSIGNMENT(self, opcode, oparg):
         print '\t', str(self.bytecode.symbols[oparg])
@@ -109,12 +92,46 @@ class Disassembler(AbstractDisassembler):
     ASSIGNMENT_APPEND_PARENT = ASSIGNMENT
     GET_LOCAL = ASSIGNMENT
     SET_LOCAL = ASSIGNMENT
+    SET_LOCAL_POP = ASSIGNMENT
+    POP_GET_LOCAL = ASSIGNMENT
+
+    def LOAD_SLOT(self, opcode, oparg):
+        print '\t', str(self.bytecode.slotnames[oparg])
+
+    STORE_SLOT = LOAD_SLOT
+    STORE_SLOT_POP = LOAD_SLOT
+
+    def LOAD_CONST(self, opcode, oparg):
+        print '\t', self.bytecode.constants[oparg]
+
+    def MAKE_OBJECT(self, opcode, oparg):
+        print '\t', ' '.join(self.bytecode.layouts[oparg])
+
+    def GET_LOCAL_LOOKUP(self, opcode, oparg):
+        print '\t', str(self.bytecode.symbols[compile.first_arg(oparg)]),
+        print str(self.bytecode.symbols[compile.second_arg(oparg)])
+
+    LOOKUP_GET_LOCAL = GET_LOCAL_LOOKUP
+
+    def GET_LOCAL_CALL(self, opcode, oparg):
+        print '\t', str(self.bytecode.symbols[compile.first_arg(oparg)]),
+        print compile.second_arg(oparg)
+
+    LOOKUP_INT = GET_LOCAL_CALL
+
+    def INT_CALL(self, opcode, oparg):
+        print '\t', compile.first_arg(oparg), compile.second_arg(oparg)
 
     def PRIMITIVE_METHOD_CALL(self, opcode, oparg):
         import primitives
         func = primitives.primitives_by_name[oparg]
         print '\t %s' % func
 
+    def INT_PRIMITIVE(self, opcode, oparg):
+        import primitives
+        func = primitives.primitives_by_name[compile.second_arg(oparg)]
+        print '\t', compile.first_arg(oparg), func
+
     def dummy(self, opcode, oparg):
         if oparg is None:
             print
@@ -126,9 +143,23 @@ class Disassembler(AbstractDisassembler):
         'ASSIGNMENT':ASSIGNMENT,
         'GET_LOCAL': GET_LOCAL,
         'SET_LOCAL':SET_LOCAL,
+        'SET_LOCAL_POP':SET_LOCAL_POP,
+        'POP_GET_LOCAL':POP_GET_LOCAL,
+        'LOAD_SLOT':LOAD_SLOT,
+        'LOAD_CONST':LOAD_CONST,
+        'MAKE_OBJECT':MAKE_OBJECT,
+        'STORE_SLOT':STORE_SLOT,
+        'STORE_SLOT_POP':STORE_SLOT_POP,
+        'GET_LOCAL_LOOKUP':GET_LOCAL_LOOKUP,
+        'LOOKUP_GET_LOCAL':LOOKUP_GET_LOCAL,
+        'GET_LOCAL_CALL':GET_LOCAL_CALL,
+        'LOOKUP_INT':LOOKUP_INT,
+        'INT_CALL':INT_CALL,
         'ASSIGNMENT_APPEND_PARENT':ASSIGNMENT_APPEND_PARENT,
         'METHOD_LOOKUP':METHOD_LOOKUP,
         'PRIMITIVE_METHOD_CALL':PRIMITIVE_METHOD_CALL,
-        'JUMP_IF_FALSE':JUMP_IF_FALSE}
+        'INT_PRIMITIVE':INT_PRIMITIVE,
+        'JUMP_IF_FALSE':JUMP_IF_FALSE,
+        'JUMP_IF_TRUE':JUMP_IF_TRUE}
 
 
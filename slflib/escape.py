@@ -0,0 +1,71 @@
+""" An escape analysis for the context objects of method calls.
+
+The arguments and locals of a method are kept in slots of its frame, and the
+context object is only created when the code needs it as an object (see
+compile.py). The instructions that need it are
+
+    IMPLICIT_SELF    (the context is pushed, e.g. as the receiver of a call)
+    MAKE_FUNCTION    (the context is the parent of the new method)
+    MAKE_OBJECT      (the context is the parent of the new object)
+
+Besides, a GET_LOCAL or LOAD_SLOT creates it when the value it finds is a
+method, which is called with the context as receiver. That can only be
+decided when the code runs.
+
+analyze() follows all paths through the code of a method and tells whether
+the context never escapes (NEVER: only a method found at run time can need
+it), may escape (MAYBE: some paths contain one of the instructions above) or
+always escapes (ALWAYS: every path contains one of them). For the methods in
+the last group, the slots are of no use. The compiler rewrites their code to
+store the locals in the context object, which is then created when the method
+is called.
+"""
+import compile
+
+NEVER = 0
+MAYBE = 1
+ALWAYS = 2
+
+def needs_context(opcode):
+    return (opcode == compile.IMPLICIT_SELF or
+            opcode == compile.MAKE_FUNCTION or
+            opcode == compile.MAKE_OBJECT)
+
+def analyze(bytecode):
+    """ Returns whether the context of the method with the given code
+    escapes (NEVER, MAYBE or ALWAYS)."""
+    decoded = bytecode.get_decoded()
+    return analyze_code(decoded.opcodes, decoded.args)
+
+def analyze_code(opcodes, args):
+    """ Like analyze, for the instructions of a method given as the lists of
+    their opcodes and arguments (with jumps to instruction indices), e.g. the
+    code of the Compiler before it is encoded."""
+    escaping = False
+    for opcode in opcodes:
+        if needs_context(opcode):
+            escaping = True
+    if not escaping:
+        return NEVER
+    # find out whether the end of the code can be reached without passing an
+    # instruction that needs the context
+    reached = [False] * (len(opcodes) + 1)
+    reached[0] = True
+    todo = [0]
+    while todo:
+        index = todo.pop()
+        if index == len(opcodes):
+            return MAYBE
+        opcode = opcodes[index]
+        if needs_context(opcode):
+            continue
+        successors = []
+        if compile.isjump(opcode):
+            successors.append(args[index])
+        if opcode != compile.JUMP:
+            successors.append(index + 1)
+        for successor in successors:
+            if not reached[successor]:
+                reached[successor] = True
+                todo.append(successor)
+    return ALWAYS
@@ -0,0 +1,107 @@
+""" Inline caches for the attribute lookups of METHOD_LOOKUP and GET_LOCAL.
+
+Every such instruction of a decoded bytecode owns an InlineCache. A cache
+starts out empty, becomes monomorphic with its first entry, polymorphic with
+up to MAX_ENTRIES entries and megamorphic after that, at which point it stops
+caching and always does the full lookup.
+
+An entry is keyed on the map (the layout) of the receiver:
+
+    If the attribute was found in the receiver itself, the map alone decides
+    where it is stored, so the entry just remembers the index. This is only
+    done for receivers without explicit parents, whose MRO can be
+    inconsistent. Attributes of the map that the receiver has not assigned
+    yet (see objmodel.new_object) are never cached.
+
+    If the attribute was found in a parent, the entry also remembers the
+    parent of the receiver and the global layout version. The object that
+    holds the attribute is a parent of other objects, so any change of its
+    layout (or the layout of the parents in front of it) replaces the version.
+"""
+from objmodel import W_NormalObject, layout_version, UNASSIGNED
+from pypy.rlib import jit
+
+MAX_ENTRIES = 4
+
+class CacheEntry(object):
+    def __init__(self, map, w_parent, w_holder, index, version):
+        self.map = map
+        self.w_parent = w_parent
+        self.w_holder = w_holder
+        self.index = index
+        self.version = version
+
+class InlineCache(object):
+    def __init__(self):
+        self.entries = []
+        self.megamorphic = False
+
+    def lookup(self, w_receiver, name):
+        if self.megamorphic:
+            return w_receiver.getvalue(name)
+        map = jit.promote(w_receiver.getmap())
+        if map is not None:
+            for entry in self.entries:
+                if entry.map is not map:
+                    continue
+                if entry.w_holder is None:
+                    assert isinstance(w_receiver, W_NormalObject)
+                    if w_receiver.parents:
+                        continue
+                    w_value = w_receiver.storage[entry.index]
+                    if w_value is UNASSIGNED:
+                        break
+                    return w_value
+                if (entry.version is layout_version.version and
+                        w_receiver.get_single_parent() is entry.w_parent):
+                    return entry.w_holder.storage[entry.index]
+        return self.fill(w_receiver, map, name)
+
+    def fill(self, w_receiver, map, name):
+        if map is None:
+            return w_receiver.getvalue(name)
+        index = map.getindex(name)
+        if index >= 0:
+            # objects with explicit parents need their MRO computed on every
+            # lookup, as it can be inconsistent
+            assert isinstance(w_receiver, W_NormalObject)
+            # receivers of the same map may have assigned the attribute or
+            # not, and assigning it does not change the map
+            if (w_receiver.parents or
+                    w_receiver.storage[index] is UNASSIGNED):
+                return w_receiver.getvalue(name)
+            self.add_entry(CacheEntry(map, None, None, index, None))
+            return w_receiver.storage[index]
+        w_parent = w_receiver.get_single_parent()
+        if w_parent is None:
+            return w_receiver.getvalue(name)
+        for w_holder in w_parent.get_mro():
+            # from now on, changes of the layout of w_holder replace the
+            # layout version
+            w_holder.mark_as_parent()
+            holdermap = w_holder.getmap()
+            if holdermap is None:
+                break
+            index = holdermap.getindex(name)
+            if index >= 0:
+                if not isinstance(w_holder, W_NormalObject):
+                    break
+                # w_holder is a parent now, so assigning the attribute
+                # replaces the layout version
+                if w_holder.storage[index] is UNASSIGNED:
+                    continue
+                self.add_entry(CacheEntry(map, w_parent, w_holder, index,
+                                          layout_version.version))
+                return w_holder.storage[index]
+        return w_receiver.getvalue(name)
+
+    def add_entry(self, entry):
+        # entries with an outdated version can never match again
+        entries = [e for e in self.entries
+                     if e.version is None or e.version is layout_version.version]
+        if len(entries) >= MAX_ENTRIES:
+            self.entries = []
+            self.megamorphic = True
+            return
+        entries.append(entry)
+        self.entries = entries
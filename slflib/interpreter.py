@@ -1,17 +1,81 @@
-from objmodel import W_Integer, W_NormalObject, W_Method
+from objmodel import W_Integer, W_NormalObject, W_Method, IntegerSpace
+from objmodel import SMALL_INT_MIN, SMALL_INT_MAX
 from simpleparser import parse
 import primitives
 import compile
+import verifier
 from bytecode_interpreter import BytecodeInterpreter
+import regcompile
+from register_interpreter import RegisterInterpreter
+
+class BuiltinsImage(object):
+    """ The builtins, evaluated once by an interpreter of their own.
+
+    Interpreters using the image get a deep copy of the evaluated builtins, so
+    that changes of the builtins made by a program do not affect other
+    interpreters.
+    """
+    def __init__(self, builtins, use_bytecode=True, optimize=True,
+                 backend='stack'):
+        interpreter = Interpreter(builtins, use_bytecode, optimize=optimize,
+                                  use_image=False, backend=backend)
+        self.w_builtins = interpreter.builtins
+
+    def copy_into(self, w_builtins, space):
+        """ Makes w_builtins a copy of the builtins of the image, creating
+        the integers in space."""
+        memo = {self.w_builtins: w_builtins}
+        w_builtins.copy_from(self.w_builtins, memo, space)
+
+# maps (builtins, use_bytecode, optimize, backend) to the BuiltinsImage built
+# for them
+builtins_images = {}
+
+def get_builtins_image(builtins=None, use_bytecode=True, optimize=True,
+                       backend='stack'):
+    """ Returns the BuiltinsImage of the builtins source code, or of the
+    default builtins if builtins is None. Every image is built only once per
+    process; the image of the default builtins is built when slf.py is
+    imported, so the translated slf-c has it prebuilt."""
+    key = (builtins, use_bytecode, optimize, backend)
+    image = builtins_images.get(key, None)
+    if image is None:
+        image = BuiltinsImage(builtins, use_bytecode, optimize, backend)
+        builtins_images[key] = image
+    return image
 
 class Interpreter(object):
-    def __init__(self, builtins = None, use_bytecode = True):
+    _immutable_fields_ = ["builtins", "space"]
+
+    def __init__(self, builtins = None, use_bytecode = True,
+                 small_int_min = SMALL_INT_MIN, small_int_max = SMALL_INT_MAX,
+                 optimize = True, use_image = True, backend = 'stack'):
         self.use_bytecode = use_bytecode
+        self.optimize = optimize
+        # the compiler and interpreter used if use_bytecode is set: 'stack'
+        # (compile.py) or 'register' (regcompile.py)
+        assert backend == 'stack' or backend == 'register'
+        self.backend = backend
         self.builtins = W_NormalObject()
+        self.space = IntegerSpace(self.builtins, small_int_min, small_int_max)
         self.debug = False
+        # maps pairs of adjacent opcodes to the number of times they were
+        # executed, if not None (see bench.py)
+        self.pair_counts = None
+        # if set, the number of executed instructions is counted in
+        # instructions_executed
+        self.count_instructions = False
+        self.instructions_executed = 0
         if not builtins:
-            builtins = self.read_builtins('slflib/builtins.slf')
-        self.eval(parse(builtins), self.builtins)
+            builtins = None
+        if use_image:
+            image = get_builtins_image(builtins, use_bytecode, optimize,
+                                       backend)
+            image.copy_into(self.builtins, self.space)
+        else:
+            if builtins is None:
+                builtins = self.read_builtins('slflib/builtins.slf')
+            self.eval(parse(builtins), self.builtins)
 
     def read_builtins(self, fname):
         from pypy.rlib.streamio import open_file_as_stream
@@ -19,11 +83,25 @@ class Interpreter(object):
 
     def eval(self, ast, w_context):
         if self.use_bytecode:
-            return BytecodeInterpreter(compile.compile(ast), w_context, self).run()
+            return self.run_bytecode(self.compile_program(ast), w_context)
         else:
             method = getattr(self, "eval_" + ast.__class__.__name__)
             return method(ast, w_context)
 
+    def compile_program(self, ast):
+        if self.backend == 'register':
+            return regcompile.compile(ast)
+        # the bodies of methods and objects are compiled when they are run
+        return compile.compile(ast, optimize=self.optimize, lazy=True)
+
+    def run_bytecode(self, code, w_context):
+        if isinstance(code, regcompile.RegisterCode):
+            return RegisterInterpreter(code, w_context, self).run()
+        assert isinstance(code, compile.Bytecode)
+        # the bytecode interpreter relies on the code being valid
+        verifier.verify(code)
+        return BytecodeInterpreter(code, w_context, self).run()
+
     def eval_Program(self, ast, context):
         retr = None
         for s in ast.statements:
@@ -36,9 +114,7 @@ class Interpreter(object):
         receiver.setvalue(ast.attrname, val)
 
     def eval_IntLiteral(self, ast, context):
-        int = W_Integer(ast.value)
-        int.builtins = self.builtins
-        return int
+        return self.space.newint(ast.value)
 
     def eval_IfStatement(self, ast, context):
         condition = self.eval(ast.condition, context)
@@ -75,7 +151,8 @@ class Interpreter(object):
         parents = dict(zip(parent_names, parent_values))
         parents['__parent__'] = context
         obj = W_NormalObject(parents)
-        obj.parents = parent_names
+        for name in parent_names:
+            obj.add_parent(name)
         self.eval(ast.block, obj)
         context.setvalue(ast.name, obj)
         return obj
@@ -86,7 +163,7 @@ class Interpreter(object):
     def eval_PrimitiveMethodCall(self, ast, context):
         receiver = self.eval(ast.receiver, context)
         arguments = map(lambda a: self.eval(a, context), ast.arguments)
-        return primitives.call(ast.methodname, receiver, arguments, self.builtins)
+        return primitives.call(ast.methodname, receiver, arguments, self.space)
 
     def eval_WhileStatement(self, ast, context):
         while self.eval(ast.condition, context).istrue():
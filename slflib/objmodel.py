@@ -1,8 +1,69 @@
+from pypy.rlib import jit
+
+class VersionTag(object):
+    pass
+
+class MROCache(object):
+    """ The global state of the caches of the linearizations of objects.
+
+    An object caches its MRO together with the current version. When the
+    parents of an object change that is part of the MRO of other objects, the
+    version is replaced, which invalidates the caches of all those dependent
+    objects. Changing the parents of other objects only invalidates their
+    own cache.
+
+    The hits and misses are counted. Hits are not counted in JIT-compiled
+    code, so that a cache hit there does not write to the global state.
+    """
+    _immutable_fields_ = ["version?"]
+
+    def __init__(self):
+        self.version = VersionTag()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.version = VersionTag()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+mro_cache = MROCache()
+
+class LayoutVersion(object):
+    """ The global version of the layout of all objects that are parents of
+    other objects. It is replaced whenever one of those objects gains an
+    attribute or changes its parents. Inline caches that found an attribute
+    in a parent of the receiver are only valid for the version they were
+    filled with.
+    """
+    _immutable_fields_ = ["version?"]
+
+    def __init__(self):
+        self.version = VersionTag()
+
+    def invalidate(self):
+        self.version = VersionTag()
+
+layout_version = LayoutVersion()
+
 class W_SimpleObject(object):
     def get_mro(self):
         import c3computation
         return c3computation.compute_C3_mro(self)
 
+    def mark_as_parent(self):
+        pass
+
+    def getmap(self):
+        return None
+
+    def get_single_parent(self):
+        """ Returns the parent p if the MRO of self is [self] + the MRO of p,
+        otherwise None."""
+        return None
+
     def getvalue(self, key):
         for parent in self.get_mro():
             try:
@@ -12,27 +73,61 @@ class W_SimpleObject(object):
         return None
 
     def callable(self):
-        self.get_mro()
         return False
 
     def clone(self):
         pass
 
+    def deepclone(self, memo, space):
+        """ Returns a copy of self and of all objects reachable from it. memo
+        maps the objects copied so far to their copies, integers are created
+        again in space."""
+        return self
+
 class W_Integer(W_SimpleObject):
-    def __init__(self, value):
+    _immutable_fields_ = ["value", "space"]
+
+    def __init__(self, value, space=None):
         self.value = value
-        self.builtins = None
+        self.space = space
 
     def __repr__(self):
         return '<W_Integer@%(id)x(%(value)d)>' % {'value':self.value, 'id':id(self)}
 
+    def get_trait(self):
+        if self.space is None:
+            return None
+        return self.space.get_trait()
+
     def getparents(self):
-        if self.builtins:
-            inttrait = self.builtins.getvalue('inttrait')
-            if inttrait:
-                return [inttrait]
+        w_trait = self.get_trait()
+        if w_trait is not None:
+            return [w_trait]
         return []
 
+    def get_mro(self):
+        w_trait = self.get_trait()
+        if w_trait is None:
+            return [self]
+        return [self] + w_trait.get_mro()
+
+    def getvalue(self, key):
+        if not key:
+            return self
+        w_trait = self.get_trait()
+        if w_trait is None:
+            return None
+        return w_trait.getvalue(key)
+
+    def getmap(self):
+        return INTEGER_MAP
+
+    def deepclone(self, memo, space):
+        return space.newint(self.value)
+
+    def get_single_parent(self):
+        return self.get_trait()
+
     def getval(self, key):
         if key:
             raise KeyError
@@ -45,45 +140,329 @@ class W_Integer(W_SimpleObject):
     def istrue(self):
         return self.value != 0
 
+def deepclone_value(value, memo, space):
+    if isinstance(value, W_SimpleObject):
+        return value.deepclone(memo, space)
+    # the AST interpreter stores the AST and the argument names of its methods
+    # in the methods
+    return value
+
+# the range of the integers that are preallocated by every IntegerSpace
+SMALL_INT_MIN = -5
+SMALL_INT_MAX = 256
+
+class IntegerSpace(object):
+    """ The integers of one interpreter.
+
+    All integers of an interpreter share its IntegerSpace, which holds the
+    integer trait (the parent of all integers). The trait is looked up in the
+    builtins only until it is found. Integers in the range
+    [small_int_min, small_int_max] are preallocated and shared.
+    """
+    _immutable_fields_ = ["w_builtins", "w_trait?", "small_int_min",
+                          "small_int_max", "small_ints[*]"]
+
+    def __init__(self, w_builtins, small_int_min=SMALL_INT_MIN,
+                 small_int_max=SMALL_INT_MAX):
+        self.w_builtins = w_builtins
+        self.w_trait = None
+        self.small_int_min = small_int_min
+        self.small_int_max = small_int_max
+        small_ints = [None] * (small_int_max - small_int_min + 1)
+        for i in range(len(small_ints)):
+            small_ints[i] = W_Integer(small_int_min + i, self)
+        self.small_ints = small_ints
+
+    def get_trait(self):
+        w_trait = self.w_trait
+        if w_trait is None:
+            w_trait = self.resolve_trait()
+        return w_trait
+
+    def resolve_trait(self):
+        if self.w_builtins is None:
+            return None
+        w_trait = self.w_builtins.getvalue('inttrait')
+        self.w_trait = w_trait
+        return w_trait
+
+    def newint(self, value):
+        if self.small_int_min <= value <= self.small_int_max:
+            return self.small_ints[value - self.small_int_min]
+        return W_Integer(value, self)
+
+class Map(object):
+    """ A map (also called hidden class) describes the layout of the
+    attributes of a W_NormalObject: it maps attribute names to indexes into
+    the storage list of the object.
+
+    Maps are shared between all objects that gained the same attributes in the
+    same order. Adding an attribute follows the cached transition to the next
+    map.
+    """
+    _immutable_fields_ = ["indexes", "transitions"]
+
+    def __init__(self):
+        self.indexes = {}
+        self.transitions = {}
+
+    @jit.elidable
+    def getindex(self, name):
+        return self.indexes.get(name, -1)
+
+    def size(self):
+        return len(self.indexes)
+
+    def add_attribute(self, name):
+        """ Returns the map that results from adding name, or None if the
+        object should not use a map any more."""
+        try:
+            return self.transitions[name]
+        except KeyError:
+            pass
+        if (len(self.transitions) >= MAX_TRANSITIONS or
+                len(self.indexes) >= MAX_ATTRIBUTES):
+            return None
+        newmap = Map()
+        newmap.indexes.update(self.indexes)
+        newmap.indexes[name] = len(self.indexes)
+        self.transitions[name] = newmap
+        return newmap
+
+# objects with more attributes store them in a dict instead; so do objects
+# that would leave a map with more transitions (which would mean that the
+# program creates too many different shapes)
+MAX_ATTRIBUTES = 64
+MAX_TRANSITIONS = 256
+
+EMPTY_MAP = Map()
+# the layout of new methods and objects, which only have their __parent__
+# (see new_method and new_object)
+PARENT_MAP = EMPTY_MAP.add_attribute('__parent__')
+# the layout of all integers
+INTEGER_MAP = Map()
+
+def layout_map(layout):
+    """ Returns the map that results from adding the names of layout to an
+    empty object, in order (see compile.Bytecode.layouts). If the map runs
+    out of attributes or transitions, the map of the names added so far is
+    returned."""
+    map = EMPTY_MAP
+    for name in layout:
+        newmap = map.add_attribute(name)
+        if newmap is None:
+            break
+        map = newmap
+    return map
+
+# what the storage of an object holds for the attributes of its map that were
+# not assigned yet (see new_object); lookups treat them as missing
+UNASSIGNED = W_SimpleObject()
+
 class W_NormalObject(W_SimpleObject):
+    """ An object of the object model. Its attributes are described by a
+    map and stored in self.storage, at the index the map gives them. An
+    object can start out with a map that has attributes it does not have yet
+    (see new_object), their entries are UNASSIGNED. Objects with too many
+    attributes keep them in self.dictvalues instead, and their map is None.
+    """
     name = ''
     def __init__(self, values=None):
-        if values is None:
-            values = {}
-        self.values = values
+        self.map = EMPTY_MAP
+        self.storage = []
+        self.dictvalues = None
         self.parents = []
+        self.mro = None
+        self.mro_version = None
+        self.is_parent = False
+        if values is not None:
+            for key, value in values.items():
+                self.setvalue(key, value)
+
     def __repr__(self):
-        return '<W_NormalObject@%(id)x(%(values)s)>' % {'values':self.values, 'id':id(self)}
+        return '<W_NormalObject@%(id)x(%(values)s)>' % {'values':self.getvalues(), 'id':id(self)}
 
     def clone(self):
-        return self.__class__(dict(self.values))
+        result = self.__class__()
+        result.map = self.map
+        if self.map is None:
+            result.storage = None
+            result.dictvalues = self.dictvalues.copy()
+        else:
+            result.storage = self.storage[:]
+        return result
+
+    def deepclone(self, memo, space):
+        result = memo.get(self, None)
+        if result is None:
+            result = self.empty_copy()
+            memo[self] = result
+            result.copy_from(self, memo, space)
+        return result
+
+    def empty_copy(self):
+        return W_NormalObject()
+
+    def copy_from(self, w_other, memo, space):
+        """ Makes self a deep copy of w_other (see deepclone)."""
+        self.map = w_other.map
+        self.parents = w_other.parents[:]
+        self.mro = None
+        if w_other.map is None:
+            self.storage = None
+            self.dictvalues = {}
+            for key, value in w_other.dictvalues.items():
+                self.dictvalues[key] = deepclone_value(value, memo, space)
+        else:
+            self.storage = [deepclone_value(value, memo, space)
+                            for value in w_other.storage]
 
     def getname(self):
         return self.name
 
+    def get_mro(self):
+        mro = self.mro
+        if mro is not None and self.mro_version is mro_cache.version:
+            if not jit.we_are_jitted():
+                mro_cache.hits += 1
+            return mro
+        mro_cache.misses += 1
+        mro = W_SimpleObject.get_mro(self)
+        for i in range(1, len(mro)):
+            mro[i].mark_as_parent()
+        self.mro = mro
+        self.mro_version = mro_cache.version
+        return mro
+
+    def mark_as_parent(self):
+        self.is_parent = True
+
+    def getmap(self):
+        return self.map
+
+    def get_single_parent(self):
+        if self.parents:
+            return None
+        try:
+            return self.getval('__parent__')
+        except KeyError:
+            return None
+
+    def parents_changed(self):
+        self.mro = None
+        if self.is_parent:
+            mro_cache.invalidate()
+            layout_version.invalidate()
+
+    def add_parent(self, name):
+        self.parents.append(name)
+        self.parents_changed()
+
     def getparents(self):
-        parents = [self.values[p] for p in self.parents]
+        parents = [self.getval(p) for p in self.parents]
         try:
-            parents.append(self.values['__parent__'])
+            parents.append(self.getval('__parent__'))
         except KeyError:
             pass
         return parents
 
+    def getvalues(self):
+        """ Returns a new dict of all attributes (for debugging)."""
+        if self.map is None:
+            return self.dictvalues.copy()
+        values = {}
+        for key, index in self.map.indexes.items():
+            value = self.storage[index]
+            if value is not UNASSIGNED:
+                values[key] = value
+        return values
+
     def getval(self, key):
-        return self.values[key]
+        map = self.map
+        if map is None:
+            return self.dictvalues[key]
+        index = map.getindex(key)
+        if index < 0:
+            raise KeyError(key)
+        value = self.storage[index]
+        if value is UNASSIGNED:
+            raise KeyError(key)
+        return value
 
     def istrue(self):
         return True
 
     def setvalue(self, key, value):
-        self.values[key] = value
+        if key == '__parent__' or key in self.parents:
+            self.parents_changed()
+        map = self.map
+        if map is None:
+            if self.is_parent and key not in self.dictvalues:
+                layout_version.invalidate()
+            self.dictvalues[key] = value
+            return
+        index = map.getindex(key)
+        if index >= 0:
+            # assigning an UNASSIGNED attribute adds it to the object
+            if self.is_parent and self.storage[index] is UNASSIGNED:
+                layout_version.invalidate()
+            self.storage[index] = value
+            return
+        if self.is_parent:
+            layout_version.invalidate()
+        newmap = map.add_attribute(key)
+        if newmap is None:
+            self.dictvalues = self.getvalues()
+            self.dictvalues[key] = value
+            self.map = None
+            self.storage = None
+        else:
+            self.map = newmap
+            self.storage.append(value)
 
 class W_Method(W_NormalObject):
     block = None
 
     def callable(self):
-        self.get_mro()
         return True
 
+    def empty_copy(self):
+        return W_Method()
+
+    def copy_from(self, w_other, memo, space):
+        W_NormalObject.copy_from(self, w_other, memo, space)
+        assert isinstance(w_other, W_Method)
+        # the code is immutable, but its inline caches must not be shared
+        # between interpreters
+        block = w_other.block
+        if block is not None:
+            block = block.copy()
+        self.block = block
+
     def __repr__(self):
-        return '<W_Method@%(id)x(%(values)s)>' % {'values':self.values, 'id':id(self)}
+        return '<W_Method@%(id)x(%(values)s)>' % {'values':self.getvalues(), 'id':id(self)}
+
+def new_object(w_parent, map=PARENT_MAP):
+    """ Returns a new object whose only attribute is __parent__ (what
+    MAKE_OBJECT creates). It starts out with map, the map of the attributes
+    it is predicted to get (see layout_map), instead of being built up from
+    a dict of values. All attributes but the __parent__ are UNASSIGNED, so
+    assigning the predicted ones keeps the map and its indexes."""
+    assert map.getindex('__parent__') == 0
+    w_object = W_NormalObject()
+    w_object.map = map
+    storage = [UNASSIGNED] * map.size()
+    storage[0] = w_parent
+    w_object.storage = storage
+    return w_object
+
+def new_method(block, w_parent):
+    """ Returns a new method with the code block, bound to w_parent (what
+    MAKE_FUNCTION creates). All methods created by one definition share the
+    code and everything derived from it (its decoded instructions and inline
+    caches), a method only holds its __parent__."""
+    w_method = W_Method()
+    w_method.map = PARENT_MAP
+    w_method.storage = [w_parent]
+    w_method.block = block
+    return w_method
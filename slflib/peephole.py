@@ -0,0 +1,318 @@
+""" A peephole optimizer for the code emitted by compile.Compiler.
+
+The optimizer turns the instructions of the compiler into a list of
+Instruction objects, in which jumps refer directly to the instruction they
+jump to, and rewrites that list
+with the following transformations until nothing changes any more:
+
+    - conditional jumps on an integer literal are replaced by an unconditional
+      jump or removed
+    - jumps to unconditional jumps are redirected to the final target
+    - unreachable instructions are removed
+    - jumps to the next instruction are removed
+    - instructions that push a value that is popped right away are removed
+      together with the POP
+
+In addition, while loops are rotated: the unconditional jump back to the
+test at the top of a loop is replaced by a copy of the test followed by a
+JUMP_IF_TRUE to the loop body, so that every iteration executes only one jump.
+
+Afterwards the maximal stack depth is computed by following all paths
+through the code, and the instructions are handed back to the compiler, which
+fuses superinstructions and encodes them (see compile.Compiler.make_bytecode).
+"""
+import compile
+from compile import (INT_LITERAL, LOAD_CONST, IMPLICIT_SELF, DUP, POP, JUMP,
+                     JUMP_IF_FALSE, JUMP_IF_TRUE, isjump)
+
+# the maximal number of instructions of a loop test that are copied
+MAX_ROTATED_TEST = 8
+
+class Instruction(object):
+    def __init__(self, opcode, arg):
+        self.opcode = opcode
+        self.arg = arg
+        # for jumps, the instruction that is jumped to
+        self.target = None
+        self.index = 0
+        self.is_target = False
+
+class Optimizer(object):
+    def __init__(self, opcodes, args):
+        # the arguments of jumps are the indices of their targets
+        instructions = []
+        for i in range(len(opcodes)):
+            instructions.append(Instruction(opcodes[i], args[i]))
+        # stands for the end of the code
+        self.end = Instruction(-1, 0)
+        for instruction in instructions:
+            if isjump(instruction.opcode):
+                if instruction.arg == len(instructions):
+                    instruction.target = self.end
+                else:
+                    instruction.target = instructions[instruction.arg]
+        self.instructions = instructions
+        self.update()
+
+    def update(self):
+        """ Recomputes the index of every instruction and which instructions
+        are jump targets."""
+        instructions = self.instructions
+        for i in range(len(instructions)):
+            instructions[i].index = i
+            instructions[i].is_target = False
+        self.end.index = len(instructions)
+        for instruction in instructions:
+            if instruction.target is not None:
+                instruction.target.is_target = True
+
+    def next_instruction(self, instruction):
+        index = instruction.index + 1
+        if index < len(self.instructions):
+            return self.instructions[index]
+        return self.end
+
+    def remove(self, removed):
+        """ Removes the instructions whose index is flagged in removed. Jumps
+        to removed instructions go to the next remaining instruction."""
+        instructions = self.instructions
+        replacement = self.end
+        replacements = [None] * len(instructions)
+        for i in range(len(instructions) - 1, -1, -1):
+            if not removed[i]:
+                replacement = instructions[i]
+            replacements[i] = replacement
+        result = []
+        for i in range(len(instructions)):
+            instruction = instructions[i]
+            if removed[i]:
+                continue
+            target = instruction.target
+            if target is not None and target is not self.end:
+                instruction.target = replacements[target.index]
+            result.append(instruction)
+        self.instructions = result
+        self.update()
+
+    def optimize(self):
+        self.simplify()
+        if self.rotate_loops():
+            self.simplify()
+
+    def simplify(self):
+        while True:
+            changed = self.fold_constant_branches()
+            changed = self.thread_jumps() or changed
+            changed = self.remove_unreachable() or changed
+            changed = self.remove_jumps_to_next() or changed
+            changed = self.remove_noop_pairs() or changed
+            if not changed:
+                break
+
+    def fold_constant_branches(self):
+        instructions = self.instructions
+        removed = [False] * len(instructions)
+        changed = False
+        for i in range(len(instructions) - 1):
+            literal = instructions[i]
+            jump = instructions[i + 1]
+            if (literal.opcode != INT_LITERAL or removed[i] or
+                    jump.is_target):
+                continue
+            if jump.opcode == JUMP_IF_FALSE:
+                taken = literal.arg == 0
+            elif jump.opcode == JUMP_IF_TRUE:
+                taken = literal.arg != 0
+            else:
+                continue
+            if taken:
+                literal.opcode = JUMP
+                literal.arg = 0
+                literal.target = jump.target
+            else:
+                removed[i] = True
+            removed[i + 1] = True
+            changed = True
+        if changed:
+            self.remove(removed)
+        return changed
+
+    def thread_jumps(self):
+        changed = False
+        for instruction in self.instructions:
+            if instruction.target is None:
+                continue
+            target = instruction.target
+            hops = 0
+            while (target.opcode == JUMP and target is not instruction and
+                    hops < len(self.instructions)):
+                target = target.target
+                hops += 1
+            if target is not instruction.target:
+                instruction.target = target
+                changed = True
+        if changed:
+            self.update()
+        return changed
+
+    def remove_unreachable(self):
+        instructions = self.instructions
+        reachable = [False] * (len(instructions) + 1)
+        todo = [0]
+        while todo:
+            index = todo.pop()
+            if reachable[index]:
+                continue
+            reachable[index] = True
+            if index == len(instructions):
+                continue
+            instruction = instructions[index]
+            if instruction.target is not None:
+                todo.append(instruction.target.index)
+            if instruction.opcode != JUMP:
+                todo.append(index + 1)
+        removed = [not reachable[i] for i in range(len(instructions))]
+        for flag in removed:
+            if flag:
+                self.remove(removed)
+                return True
+        return False
+
+    def remove_jumps_to_next(self):
+        removed = [False] * len(self.instructions)
+        changed = False
+        for instruction in self.instructions:
+            if (instruction.opcode == JUMP and
+                    instruction.target is self.next_instruction(instruction)):
+                removed[instruction.index] = True
+                changed = True
+        if changed:
+            self.remove(removed)
+        return changed
+
+    def remove_noop_pairs(self):
+        instructions = self.instructions
+        removed = [False] * len(instructions)
+        changed = False
+        for i in range(len(instructions) - 1):
+            opcode = instructions[i].opcode
+            pop = instructions[i + 1]
+            if removed[i] or pop.opcode != POP or pop.is_target:
+                continue
+            if (opcode == DUP or opcode == INT_LITERAL or
+                    opcode == LOAD_CONST or opcode == IMPLICIT_SELF):
+                removed[i] = True
+                removed[i + 1] = True
+                changed = True
+        if changed:
+            self.remove(removed)
+        return changed
+
+    def rotate_loops(self):
+        """ Replaces
+                test: <test instructions>
+                      JUMP_IF_FALSE exit
+                body: ...
+                      JUMP test
+                exit:
+            by
+                test: <test instructions>
+                      JUMP_IF_FALSE exit
+                body: ...
+                      <test instructions>
+                      JUMP_IF_TRUE body
+                exit:
+        """
+        changed = False
+        i = 0
+        while i < len(self.instructions):
+            jump = self.instructions[i]
+            i += 1
+            if jump.opcode != JUMP or jump.target.index >= jump.index:
+                continue
+            test = self.find_loop_test(jump)
+            if test is None:
+                continue
+            condjump = self.instructions[jump.target.index + len(test)]
+            # the first copied instruction replaces the jump, so that jumps
+            # to the end of the body still arrive there
+            copies = []
+            for instruction in test:
+                copies.append(Instruction(instruction.opcode, instruction.arg))
+            rotated = Instruction(JUMP_IF_TRUE, 0)
+            rotated.target = self.next_instruction(condjump)
+            copies.append(rotated)
+            jump.opcode = copies[0].opcode
+            jump.arg = copies[0].arg
+            jump.target = copies[0].target
+            self.instructions = (self.instructions[:jump.index + 1] +
+                                 copies[1:] +
+                                 self.instructions[jump.index + 1:])
+            self.update()
+            i = jump.index + len(copies)
+            changed = True
+        return changed
+
+    def find_loop_test(self, jump):
+        """ Returns the test instructions of the loop that ends with jump, or
+        None if the loop cannot be rotated."""
+        instructions = self.instructions
+        start = jump.target.index
+        test = []
+        for index in range(start, min(jump.index, start + MAX_ROTATED_TEST + 1)):
+            instruction = instructions[index]
+            if index > start and instruction.is_target:
+                return None
+            if instruction.opcode == JUMP_IF_FALSE:
+                if (instruction.target is self.next_instruction(jump) and
+                        len(test) > 0):
+                    return test
+                return None
+            if isjump(instruction.opcode):
+                return None
+            test.append(instruction)
+        return None
+
+    def compute_stackdepth(self):
+        """ Returns the maximal depth of the stack. The depth of the stack
+        must be the same on all paths to an instruction, and 1 at the end
+        (unless the end cannot be reached, e.g. after a while loop whose
+        condition is a literal)."""
+        instructions = self.instructions
+        depths = [-1] * (len(instructions) + 1)
+        depths[0] = 0
+        maxdepth = 0
+        todo = [0]
+        while todo:
+            index = todo.pop()
+            if index == len(instructions):
+                continue
+            instruction = instructions[index]
+            depth = depths[index] + compile.get_stack_effect(
+                    instruction.opcode, instruction.arg)
+            assert depth >= 0
+            maxdepth = max(maxdepth, depths[index] + compile.get_stack_peak(
+                    instruction.opcode, instruction.arg))
+            successors = []
+            if instruction.target is not None:
+                successors.append(instruction.target.index)
+            if instruction.opcode != JUMP:
+                successors.append(index + 1)
+            for successor in successors:
+                if depths[successor] == -1:
+                    depths[successor] = depth
+                    todo.append(successor)
+                else:
+                    assert depths[successor] == depth
+        end = depths[len(instructions)]
+        assert end == -1 or end == 1
+        return maxdepth
+
+    def get_code(self):
+        """ Returns the lists of the opcodes and the arguments of the
+        instructions, with jumps to instruction indices."""
+        for instruction in self.instructions:
+            if instruction.target is not None:
+                instruction.arg = instruction.target.index
+        return ([instruction.opcode for instruction in self.instructions],
+                [instruction.arg for instruction in self.instructions])
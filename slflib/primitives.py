@@ -3,9 +3,14 @@ from pypy.rlib.rarithmetic import ovfcheck, ovfcheck_float_to_int
 
 import math
 
-primitives = {}
+# the primitives are numbered in the order in which they are registered.
+# unary_primitives and binary_primitives map the number of a primitive to its
+# function (or None, if the primitive has a different arity). The functions
+# take and return unwrapped integers.
 primitives_by_name = []
 all_primitives_arg_count = []
+unary_primitives = []
+binary_primitives = []
 
 def register(argscount):
     def g(f):
@@ -13,89 +18,103 @@ def register(argscount):
 
         primitives_by_name.append(name)
         all_primitives_arg_count.append(argscount)
-        primitives[name] = f
+        if argscount == 0:
+            unary_primitives.append(f)
+            binary_primitives.append(None)
+        else:
+            assert argscount == 1
+            unary_primitives.append(None)
+            binary_primitives.append(f)
 
         return f
     return g
 
-def call(methodname, receiver, arguments, builtins):
-    method = primitives[methodname]
-    args = []
-
-    args.append(receiver.getvalue('').intvalue())
-
-    for a in arguments:
-        if a:
-            args.append(a.intvalue())
-        else:
-            args.append(0)
-
-    my_int = W_Integer(method(args))
-    my_int.builtins = builtins
-    return my_int
+def unwrap_receiver(receiver):
+    if isinstance(receiver, W_Integer):
+        return receiver.value
+    return receiver.getvalue('').intvalue()
+
+def unwrap_argument(argument):
+    if argument is None:
+        return 0
+    return argument.intvalue()
+
+def call0(index, receiver, space):
+    """ Calls the primitive number index, which takes no arguments."""
+    method = unary_primitives[index]
+    return space.newint(method(unwrap_receiver(receiver)))
+
+def call1(index, receiver, argument, space):
+    """ Calls the primitive number index, which takes one argument."""
+    method = binary_primitives[index]
+    return space.newint(method(unwrap_receiver(receiver),
+                               unwrap_argument(argument)))
+
+def call(methodname, receiver, arguments, space):
+    index = primitives_by_name.index(methodname)
+    if all_primitives_arg_count[index] == 0:
+        return call0(index, receiver, space)
+    return call1(index, receiver, arguments[0], space)
 
 @register(1)
-def bool_nor(args):
-    return int(not(args[0] or args[1]))
+def bool_nor(a, b):
+    return int(not(a or b))
 
 @register(0)
-def bool_gz(args):
-    return int(args[0] > 0)
+def bool_gz(a):
+    return int(a > 0)
 
 @register(1)
-def int_add(args):
+def int_add(a, b):
     try:
-        return ovfcheck(args[0] + args[1])
-    except OverflowError, e:
-        print e
-        raise e
+        return ovfcheck(a + b)
+    except OverflowError:
+        raise
 
 @register(1)
-def int_sub(args):
+def int_sub(a, b):
     try:
-        return ovfcheck(args[0] - args[1])
+        return ovfcheck(a - b)
     except OverflowError:
         raise
 
 @register(1)
-def int_mul(args):
+def int_mul(a, b):
     try:
-        return ovfcheck(args[0] * args[1])
+        return ovfcheck(a * b)
     except OverflowError:
         raise
 
 @register(1)
-def int_div(args):
+def int_div(a, b):
     try:
-        return ovfcheck(args[0] / args[1])
+        return ovfcheck(a / b)
     except OverflowError:
         raise
 
 @register(1)
-def int_mod(args):
+def int_mod(a, b):
     try:
-        return ovfcheck(args[0] % args[1])
+        return ovfcheck(a % b)
     except OverflowError:
         raise
 
 
 @register(0)
-def math_sqrt(args):
+def math_sqrt(a):
     try:
-        return ovfcheck_float_to_int(math.sqrt(args[0]))
+        return ovfcheck_float_to_int(math.sqrt(a))
     except OverflowError:
         raise
 
 @register(1)
-def math_pow(args):
+def math_pow(a, b):
     try:
-        return ovfcheck_float_to_int(math.pow(args[0], args[1]))
+        return ovfcheck_float_to_int(math.pow(a, b))
     except OverflowError:
         raise
 
 @register(0)
-def puts(args):
-    print args[0]
-    return args[0]
-
-
+def puts(a):
+    print a
+    return a
@@ -0,0 +1,406 @@
+"""This file contains the compiler of the register-based backend.
+
+Instead of a stack, every frame has a fixed number of registers. Register 0
+always holds the context (the implicit self), register 1 holds the result of
+the code; the other registers hold temporary values. The operands of an
+instruction name the registers it reads and writes directly, so that no
+instructions are needed to move values around.
+
+The code is a list of integers. Every instruction is its opcode followed by a
+fixed number of operands (see operand_counts). In the following, "r" operands
+are registers, "s" operands indices into the symbols of the code, "c"
+operands indices into the subcodes of the code and "t" operands the index of
+an instruction in the code. A destination register of -1 means that the
+result is not needed.
+
+    LOAD_INT r i
+    Loads the integer i into r.
+
+    MOVE r1 r2
+    Copies the content of r2 into r1.
+
+    GET_ATTR r1 r2 s
+    Looks up the attribute s in the object in r2 and stores it in r1.
+
+    SEND r1 r2 s
+    Looks up the attribute s in the object in r2. If it is a method, it is
+    called without arguments and its result is stored in r1, otherwise the
+    attribute itself is stored in r1. This is what a method call without
+    arguments compiles to.
+
+    CALL r1 r2 r3 r4 n
+    Calls the method in r3 with receiver r2 and the n arguments in the
+    registers r4, r4+1, ..., and stores the result in r1. If r3 does not hold
+    a method, its content is stored in r1.
+
+    SET_ATTR r1 s r2
+    Sets the attribute s of the object in r1 to the content of r2.
+
+    ADD_PARENT r1 s r2
+    Like SET_ATTR, but also adds s to the parent attributes of the object.
+
+    PRIMITIVE r1 p r2 r3
+    Calls the primitive number p with the receiver in r2 and, if the
+    primitive takes an argument, the argument in r3. The result is stored in
+    r1.
+
+    MAKE_FUNCTION r c
+    Creates a new method with the subcode c and stores it in r.
+
+    MAKE_OBJECT r s
+    Creates a new object whose __parent__ is the context and stores it in r.
+    s is the name of the object.
+
+    MAKE_OBJECT_CALL r c
+    Executes the subcode c with the object in r as context.
+
+    JUMP t
+    Continues at instruction t.
+
+    JUMP_IF_FALSE r t
+    Continues at instruction t if the object in r is false.
+
+    RETURN r
+    Finishes the code, its result is the content of r.
+"""
+import simpleast
+from compile import Code
+from inlinecache import InlineCache
+
+# ---------- instructions ----------
+
+LOAD_INT = 1
+MOVE = 2
+GET_ATTR = 3
+SEND = 4
+CALL = 5
+SET_ATTR = 6
+ADD_PARENT = 7
+PRIMITIVE = 8
+MAKE_FUNCTION = 9
+MAKE_OBJECT = 10
+MAKE_OBJECT_CALL = 11
+JUMP = 12
+JUMP_IF_FALSE = 13
+RETURN = 14
+
+opcode_names = [None] * 16
+operand_counts = [0] * 16
+
+def _instruction(opcode, name, operands):
+    opcode_names[opcode] = name
+    operand_counts[opcode] = operands
+
+_instruction(LOAD_INT, 'LOAD_INT', 2)
+_instruction(MOVE, 'MOVE', 2)
+_instruction(GET_ATTR, 'GET_ATTR', 3)
+_instruction(SEND, 'SEND', 3)
+_instruction(CALL, 'CALL', 5)
+_instruction(SET_ATTR, 'SET_ATTR', 3)
+_instruction(ADD_PARENT, 'ADD_PARENT', 3)
+_instruction(PRIMITIVE, 'PRIMITIVE', 4)
+_instruction(MAKE_FUNCTION, 'MAKE_FUNCTION', 2)
+_instruction(MAKE_OBJECT, 'MAKE_OBJECT', 2)
+_instruction(MAKE_OBJECT_CALL, 'MAKE_OBJECT_CALL', 2)
+_instruction(JUMP, 'JUMP', 1)
+_instruction(JUMP_IF_FALSE, 'JUMP_IF_FALSE', 2)
+_instruction(RETURN, 'RETURN', 1)
+
+CONTEXT_REGISTER = 0
+RESULT_REGISTER = 1
+
+
+class RegisterCode(Code):
+    """ The register code of one piece of code.
+
+    self.code is the list of instructions (see the module docstring).
+
+    self.symbols and self.subcodes are the names and the nested code objects
+    that occur in the piece of code; the first self.numargs symbols are the
+    names of the arguments.
+
+    self.numregs is the number of registers a frame of the code needs.
+
+    self.caches holds the inline cache of every GET_ATTR and SEND instruction,
+    indexed by the position of the instruction.
+    """
+    _immutable_ = True
+    _immutable_fields_ = ["code[*]", "name", "symbols[*]", "subcodes[*]",
+                          "numargs", "numregs", "caches[*]"]
+
+    def __init__(self, code, name, symbols, subcodes, numargs, numregs):
+        self.code = code
+        if name is None:
+            name = "?"
+        self.name = name
+        self.symbols = symbols
+        self.subcodes = subcodes
+        self.numargs = numargs
+        self.numregs = numregs
+        caches = [None] * len(code)
+        pc = 0
+        while pc < len(code):
+            opcode = code[pc]
+            if opcode == GET_ATTR or opcode == SEND:
+                caches[pc] = InlineCache()
+            pc += 1 + operand_counts[opcode]
+        self.caches = caches
+
+    def copy(self):
+        subcodes = [None] * len(self.subcodes)
+        for i in range(len(subcodes)):
+            subcode = self.subcodes[i].copy()
+            assert isinstance(subcode, RegisterCode)
+            subcodes[i] = subcode
+        return RegisterCode(self.code, self.name, self.symbols, subcodes,
+                            self.numargs, self.numregs)
+
+    def count_instructions(self):
+        count = 0
+        pc = 0
+        while pc < len(self.code):
+            count += 1
+            pc += 1 + operand_counts[self.code[pc]]
+        return count
+
+    def dis(self):
+        print '\n'.join(disassemble(self))
+
+
+def disassemble(regcode):
+    """ Returns a readable version of the instructions of regcode, one line
+    per instruction."""
+    lines = []
+    code = regcode.code
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        operands = [str(code[pc + 1 + i])
+                    for i in range(operand_counts[opcode])]
+        lines.append('%d %s %s' % (pc, opcode_names[opcode],
+                                   ' '.join(operands)))
+        pc += 1 + operand_counts[opcode]
+    return lines
+
+
+# ---------- compiler ----------
+
+def compile(ast, argumentnames=[], name=None):
+    """ Turns an AST into a RegisterCode object."""
+    assert isinstance(ast, simpleast.Program)
+    comp = RegisterCompiler()
+    for arg in argumentnames:
+        comp.lookup_symbol(arg)
+    comp.lookup_symbol("__parent__")
+    comp.lookup_symbol("self")
+    comp.compile(ast, RESULT_REGISTER)
+    comp.emit(RETURN, RESULT_REGISTER)
+    return comp.make_code(len(argumentnames), name)
+
+
+class RegisterCompiler(object):
+    """ Compiles an AST to register code.
+
+    The compile_* methods take the register that receives the value of the
+    node as argument (or -1 if the value is not needed). Temporaries are
+    allocated like a stack: a node releases the temporaries it allocated
+    once its value has been computed.
+    """
+
+    def __init__(self):
+        self.code = []
+        self.symbols = {}
+        self.subcodes = []
+        self.nexttemp = RESULT_REGISTER + 1
+        self.numregs = RESULT_REGISTER + 1
+
+    def make_code(self, numargs, funcname):
+        symbols = [None] * len(self.symbols)
+        for name, index in self.symbols.items():
+            symbols[index] = name
+        # the lists of a RegisterCode are never resized, so the lists of the
+        # compiler are copied
+        return RegisterCode(self.code[:], funcname, symbols,
+                            self.subcodes[:], numargs, self.numregs)
+
+    def emit(self, opcode, *operands):
+        assert len(operands) == operand_counts[opcode]
+        self.code.append(opcode)
+        # RPython cannot iterate over tuples of more than one element
+        self.code.extend(list(operands))
+
+    def get_position(self):
+        return len(self.code)
+
+    def emit_jump(self, condition=-1):
+        """ Emits a JUMP, or a JUMP_IF_FALSE if a condition register is
+        given, whose target is set later with set_target. Returns the
+        position of the target operand."""
+        if condition < 0:
+            self.emit(JUMP, -1)
+        else:
+            self.emit(JUMP_IF_FALSE, condition, -1)
+        return self.get_position() - 1
+
+    def set_target(self, position, target):
+        self.code[position] = target
+
+    def lookup_symbol(self, symbol):
+        if symbol not in self.symbols:
+            self.symbols[symbol] = len(self.symbols)
+        return self.symbols[symbol]
+
+    def new_temp(self):
+        register = self.nexttemp
+        self.nexttemp += 1
+        self.numregs = max(self.numregs, self.nexttemp)
+        return register
+
+    def new_temps(self, count):
+        """ Allocates count consecutive temporaries and returns the first."""
+        first = self.nexttemp
+        for i in range(count):
+            self.new_temp()
+        return first
+
+    def release_temps(self, mark):
+        self.nexttemp = mark
+
+    def compile(self, ast, target):
+        ast.dispatch(self, target)
+
+    def compile_value(self, ast):
+        """ Compiles ast and returns the register that holds its value. The
+        context is used directly, other values are put into a new temporary,
+        which the caller has to release."""
+        if isinstance(ast, simpleast.ImplicitSelf):
+            return CONTEXT_REGISTER
+        register = self.new_temp()
+        self.compile(ast, register)
+        return register
+
+    def compile_IntLiteral(self, astnode, target):
+        if target >= 0:
+            self.emit(LOAD_INT, target, astnode.value)
+
+    def compile_ImplicitSelf(self, astnode, target):
+        if target >= 0:
+            self.emit(MOVE, target, CONTEXT_REGISTER)
+
+    def compile_Assignment(self, astnode, target):
+        mark = self.nexttemp
+        receiver = self.compile_value(astnode.lvalue)
+        if target >= 0:
+            self.compile(astnode.expression, target)
+            value = target
+        else:
+            value = self.compile_value(astnode.expression)
+        self.emit(SET_ATTR, receiver, self.lookup_symbol(astnode.attrname),
+                  value)
+        self.release_temps(mark)
+
+    def compile_ExprStatement(self, astnode, target):
+        self.compile(astnode.expression, target)
+
+    def compile_MethodCall(self, astnode, target):
+        mark = self.nexttemp
+        receiver = self.compile_value(astnode.receiver)
+        name = self.lookup_symbol(astnode.methodname)
+        numargs = len(astnode.arguments)
+        if numargs == 0:
+            self.emit(SEND, target, receiver, name)
+        else:
+            # as in the stack machine, the method is looked up before the
+            # arguments are evaluated
+            method = self.new_temp()
+            self.emit(GET_ATTR, method, receiver, name)
+            first = self.new_temps(numargs)
+            for i in range(numargs):
+                self.compile(astnode.arguments[i], first + i)
+            self.emit(CALL, target, receiver, method, first, numargs)
+        self.release_temps(mark)
+
+    def compile_PrimitiveMethodCall(self, astnode, target):
+        import primitives
+        try:
+            index = primitives.primitives_by_name.index(astnode.methodname)
+        except ValueError:
+            raise KeyError('primitive not registered', astnode.methodname)
+
+        assert (len(astnode.arguments) ==
+                primitives.all_primitives_arg_count[index])
+        mark = self.nexttemp
+        receiver = self.compile_value(astnode.receiver)
+        argument = -1
+        if astnode.arguments:
+            argument = self.compile_value(astnode.arguments[0])
+        if target < 0:
+            # primitives can have side effects, so they are always called
+            target = self.new_temp()
+        self.emit(PRIMITIVE, target, index, receiver, argument)
+        self.release_temps(mark)
+
+    def compile_ObjectDefinition(self, astnode, target):
+        mark = self.nexttemp
+        obj = target
+        if obj < 0:
+            obj = self.new_temp()
+        self.emit(MAKE_OBJECT, obj, self.lookup_symbol(astnode.name))
+        for i in range(len(astnode.parentdefinitions)):
+            name = astnode.parentnames[i]
+            value = self.compile_value(astnode.parentdefinitions[i])
+            if name == "__parent__":
+                self.emit(SET_ATTR, obj, self.lookup_symbol(name), value)
+            else:
+                self.emit(ADD_PARENT, obj, self.lookup_symbol(name), value)
+        code = compile(astnode.block, name=astnode.name)
+        index = len(self.subcodes)
+        self.subcodes.append(code)
+        self.emit(MAKE_OBJECT_CALL, obj, index)
+        self.emit(SET_ATTR, CONTEXT_REGISTER,
+                  self.lookup_symbol(astnode.name), obj)
+        self.release_temps(mark)
+
+    def compile_Program(self, astnode, target):
+        for statement in astnode.statements[:-1]:
+            self.compile(statement, -1)
+        self.compile(astnode.statements[-1], target)
+
+    def compile_FunctionDefinition(self, astnode, target):
+        mark = self.nexttemp
+        method = target
+        if method < 0:
+            method = self.new_temp()
+        code = compile(astnode.block, astnode.arguments, astnode.name)
+        index = len(self.subcodes)
+        self.subcodes.append(code)
+        self.emit(MAKE_FUNCTION, method, index)
+        self.emit(SET_ATTR, CONTEXT_REGISTER,
+                  self.lookup_symbol(astnode.name), method)
+        self.release_temps(mark)
+
+    def compile_IfStatement(self, astnode, target):
+        mark = self.nexttemp
+        condition = self.compile_value(astnode.condition)
+        self.release_temps(mark)
+        position1 = self.emit_jump(condition)
+        self.compile(astnode.ifblock, target)
+        position2 = self.emit_jump()
+        self.set_target(position1, self.get_position())
+        if astnode.elseblock:
+            self.compile(astnode.elseblock, target)
+        elif target >= 0:
+            self.emit(MOVE, target, CONTEXT_REGISTER)
+        self.set_target(position2, self.get_position())
+
+    def compile_WhileStatement(self, astnode, target):
+        if target >= 0:
+            self.emit(MOVE, target, CONTEXT_REGISTER)
+        start = self.get_position()
+        mark = self.nexttemp
+        condition = self.compile_value(astnode.condition)
+        self.release_temps(mark)
+        position = self.emit_jump(condition)
+        self.compile(astnode.whileblock, target)
+        self.emit(JUMP, start)
+        self.set_target(position, self.get_position())
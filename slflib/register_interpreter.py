@@ -0,0 +1,149 @@
+from objmodel import W_NormalObject, W_Method, new_method, new_object
+from pypy.rlib import jit
+import regcompile
+import primitives
+
+def get_printable_location(pc, code):
+    return '%s #%d %s' % (code.name, pc,
+                          regcompile.opcode_names[code.code[pc]])
+
+jitdriver = jit.JitDriver(greens=['pc', 'code'], reds=['frame', 'self'],
+                          get_printable_location=get_printable_location)
+
+class RegisterFrame(object):
+    """ The activation record of one piece of register code.
+
+    When the frame is finished, its result is stored in the register
+    result_register of the calling frame (unless that is -1).
+    """
+    def __init__(self, code, context, result_register):
+        self.code = code
+        self.pc = 0
+        registers = [None] * code.numregs
+        registers[regcompile.CONTEXT_REGISTER] = context
+        self.registers = registers
+        self.result_register = result_register
+
+class RegisterInterpreter(object):
+    """ Runs the code of the register backend (see regcompile.py)."""
+    _immutable_fields_ = ["interpreter", "count_instructions"]
+
+    def __init__(self, code, context, interpreter):
+        self.code = code
+        self.context = context
+        self.interpreter = interpreter
+        self.frames = []
+        self.count_instructions = interpreter.count_instructions
+
+    def run(self):
+        self.frames.append(RegisterFrame(self.code, self.context, -1))
+        while True:
+            frame = self.frames[-1]
+            code = frame.code
+            pc = frame.pc
+            jitdriver.jit_merge_point(pc=pc, code=code, frame=frame, self=self)
+            instructions = code.code
+            op = instructions[pc]
+            frame.pc = pc + 1 + regcompile.operand_counts[op]
+            if self.count_instructions:
+                self.interpreter.instructions_executed += 1
+            registers = frame.registers
+
+            if op == regcompile.SEND:
+                self.op_send(frame, pc, instructions[pc + 1],
+                             registers[instructions[pc + 2]],
+                             instructions[pc + 3])
+            elif op == regcompile.CALL:
+                first = instructions[pc + 4]
+                args = [registers[first + i]
+                        for i in range(instructions[pc + 5])]
+                self.call(frame, instructions[pc + 1],
+                          registers[instructions[pc + 2]],
+                          registers[instructions[pc + 3]], args)
+            elif op == regcompile.GET_ATTR:
+                name = code.symbols[instructions[pc + 3]]
+                cache = code.caches[pc]
+                registers[instructions[pc + 1]] = cache.lookup(
+                    registers[instructions[pc + 2]], name)
+            elif op == regcompile.LOAD_INT:
+                registers[instructions[pc + 1]] = (
+                    self.interpreter.space.newint(instructions[pc + 2]))
+            elif op == regcompile.MOVE:
+                registers[instructions[pc + 1]] = registers[instructions[pc + 2]]
+            elif op == regcompile.SET_ATTR:
+                w_target = registers[instructions[pc + 1]]
+                w_target.setvalue(code.symbols[instructions[pc + 2]],
+                                  registers[instructions[pc + 3]])
+            elif op == regcompile.PRIMITIVE:
+                self.op_primitive(registers, instructions[pc + 1],
+                                  instructions[pc + 2],
+                                  registers[instructions[pc + 3]],
+                                  instructions[pc + 4])
+            elif op == regcompile.JUMP:
+                target = instructions[pc + 1]
+                frame.pc = target
+                if target < pc:
+                    jitdriver.can_enter_jit(pc=target, code=code, frame=frame,
+                                            self=self)
+            elif op == regcompile.JUMP_IF_FALSE:
+                if registers[instructions[pc + 1]].istrue() is not True:
+                    frame.pc = instructions[pc + 2]
+            elif op == regcompile.RETURN:
+                if self.return_from(frame, registers[instructions[pc + 1]]):
+                    break
+            elif op == regcompile.ADD_PARENT:
+                w_target = registers[instructions[pc + 1]]
+                name = code.symbols[instructions[pc + 2]]
+                w_target.setvalue(name, registers[instructions[pc + 3]])
+                w_target.add_parent(name)
+            elif op == regcompile.MAKE_FUNCTION:
+                registers[instructions[pc + 1]] = new_method(
+                    code.subcodes[instructions[pc + 2]],
+                    registers[regcompile.CONTEXT_REGISTER])
+            elif op == regcompile.MAKE_OBJECT:
+                registers[instructions[pc + 1]] = new_object(
+                    registers[regcompile.CONTEXT_REGISTER])
+            elif op == regcompile.MAKE_OBJECT_CALL:
+                subcode = code.subcodes[instructions[pc + 2]]
+                self.frames.append(RegisterFrame(
+                    subcode, registers[instructions[pc + 1]], -1))
+            else:
+                raise NotImplementedError(regcompile.opcode_names[op])
+        return self.context
+
+    def return_from(self, frame, w_result):
+        """ Removes the finished frame and stores its result in the calling
+        frame. Returns True if the outermost frame was removed."""
+        self.frames.pop()
+        if not self.frames:
+            return True
+        if frame.result_register >= 0:
+            self.frames[-1].registers[frame.result_register] = w_result
+        return False
+
+    def op_send(self, frame, pc, target, w_receiver, index):
+        name = frame.code.symbols[index]
+        w_method = frame.code.caches[pc].lookup(w_receiver, name)
+        self.call(frame, target, w_receiver, w_method, [])
+
+    def call(self, frame, target, w_receiver, w_method, args):
+        if isinstance(w_method, W_Method):
+            code = w_method.block
+            assert isinstance(code, regcompile.RegisterCode)
+            context = W_NormalObject()
+            for i in range(len(args)):
+                context.setvalue(code.symbols[i], args[i])
+            context.setvalue('self', w_receiver)
+            context.setvalue('__parent__', w_receiver)
+            self.frames.append(RegisterFrame(code, context, target))
+        elif target >= 0:
+            frame.registers[target] = w_method
+
+    def op_primitive(self, registers, target, index, w_receiver, argument):
+        space = self.interpreter.space
+        if argument < 0:
+            res = primitives.call0(index, w_receiver, space)
+        else:
+            res = primitives.call1(index, w_receiver, registers[argument],
+                                   space)
+        registers[target] = res
@@ -0,0 +1,242 @@
+""" A verifier for Bytecode objects.
+
+The bytecode interpreter does not check the code it runs: arguments are used
+as indices into the symbols, slots and subbytecodes without bounds checks,
+and the value stack of a frame is preallocated with the size of
+Bytecode.stackdepth. Code that does not come straight from the compiler (e.g.
+from a cache file, see bytecodecache.py) could therefore crash the
+interpreter, so every Bytecode is verified once before it is run. The
+verifier checks
+
+    - that the code consists of complete instructions with valid opcodes
+      (quickened opcodes are only created by the interpreter)
+    - that the symbol, slot, constant, subbytecode and primitive indices are
+      in range
+    - that jumps go to the start of an instruction (or to the end)
+    - that no instruction pops from an empty stack, that the depth of the
+      stack is the same on all paths to an instruction, that it is 1 at the
+      end of the code (if the end can be reached at all, which it cannot
+      after an endless loop) and that its maximum is Bytecode.stackdepth (a
+      larger stackdepth would make the interpreter allocate stacks that are
+      too large)
+
+and recursively verifies the subbytecodes (except for LazyBytecode stubs,
+which verify the code they compile).
+"""
+import compile
+import primitives
+
+class VerifyError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+def verify(bytecode):
+    """ Raises VerifyError if bytecode (or one of its subbytecodes) is
+    invalid. Code that was verified once is not verified again."""
+    if bytecode.verified:
+        return
+    for subbytecode in bytecode.subbytecodes:
+        # stubs are verified when they are compiled
+        if isinstance(subbytecode, compile.Bytecode):
+            verify(subbytecode)
+    Verifier(bytecode).verify()
+    bytecode.verified = True
+
+def uses_symbol(opcode):
+    """ Returns 1 if the argument of the opcode is a symbol index, 2 if both
+    halves of its PAIRARG are and 3 if only the first half is."""
+    if (opcode == compile.ASSIGNMENT or opcode == compile.METHOD_LOOKUP or
+            opcode == compile.ASSIGNMENT_APPEND_PARENT or
+            opcode == compile.GET_LOCAL or opcode == compile.SET_LOCAL or
+            opcode == compile.SET_LOCAL_POP or
+            opcode == compile.POP_GET_LOCAL):
+        return 1
+    if (opcode == compile.GET_LOCAL_LOOKUP or
+            opcode == compile.LOOKUP_GET_LOCAL):
+        return 2
+    if opcode == compile.GET_LOCAL_CALL or opcode == compile.LOOKUP_INT:
+        return 3
+    return 0
+
+def stack_inputs(opcode, arg):
+    """ Returns the number of values an instruction expects on the stack."""
+    if opcode == compile.METHOD_CALL or opcode == compile.TAIL_METHOD_CALL:
+        return arg + 2
+    if opcode == compile.GET_LOCAL_CALL or opcode == compile.INT_CALL:
+        # the first half pushes the last argument
+        return compile.second_arg(arg) + 1
+    if opcode == compile.PRIMITIVE_METHOD_CALL:
+        return primitives.all_primitives_arg_count[arg] + 1
+    if opcode == compile.INT_PRIMITIVE:
+        # the first half pushes the last argument (or the receiver)
+        arg = compile.second_arg(arg)
+        return primitives.all_primitives_arg_count[arg]
+    if (opcode == compile.ASSIGNMENT or
+            opcode == compile.ASSIGNMENT_APPEND_PARENT):
+        return 2
+    if (opcode == compile.METHOD_LOOKUP or opcode == compile.MAKE_OBJECT_CALL or
+            opcode == compile.JUMP_IF_FALSE or opcode == compile.JUMP_IF_TRUE or
+            opcode == compile.SET_LOCAL or opcode == compile.STORE_SLOT or
+            opcode == compile.LOOKUP_GET_LOCAL or
+            opcode == compile.LOOKUP_INT or opcode == compile.SET_LOCAL_POP or
+            opcode == compile.POP_GET_LOCAL or
+            opcode == compile.STORE_SLOT_POP or opcode == compile.POP or
+            opcode == compile.DUP):
+        return 1
+    return 0
+
+class Verifier(object):
+    def __init__(self, bytecode):
+        self.bytecode = bytecode
+        # the decoded instructions; jump arguments are code unit indices
+        self.opcodes = []
+        self.args = []
+        self.positions = []
+
+    def error(self, message, index=-1):
+        if 0 <= index < len(self.positions):
+            message = '%s at position %d' % (message, self.positions[index])
+        raise VerifyError('%s: %s' % (self.bytecode.name, message))
+
+    def verify(self):
+        bytecode = self.bytecode
+        if bytecode.numargs < 0 or bytecode.numargs > len(bytecode.symbols):
+            self.error('invalid number of arguments')
+        self.decode()
+        self.resolve_jumps()
+        for i in range(len(self.opcodes)):
+            self.check_arguments(i)
+        self.check_stack()
+
+    def decode(self):
+        code = self.bytecode.code
+        if len(code) % 2 != 0:
+            self.error('truncated instruction')
+        pc = 0
+        while pc < len(code):
+            self.positions.append(pc)
+            opcode = ord(code[pc])
+            arg = ord(code[pc + 1])
+            pc += 2
+            extended = 0
+            while opcode == compile.EXTENDED_ARG:
+                extended += 1
+                if extended > 3 or pc >= len(code):
+                    self.error('invalid EXTENDED_ARG', len(self.opcodes))
+                opcode = ord(code[pc])
+                arg = (arg << 8) | ord(code[pc + 1])
+                pc += 2
+            if (compile.opcode_names[opcode] is None or
+                    compile.isquickened(opcode)):
+                self.error('invalid opcode %d' % opcode, len(self.opcodes))
+            if not compile.hasarg(opcode) and arg != 0:
+                self.error('argument of %s' % compile.opcode_names[opcode],
+                           len(self.opcodes))
+            self.opcodes.append(opcode)
+            self.args.append(compile.unzigzag(arg))
+
+    def resolve_jumps(self):
+        """ Turns the jump arguments into instruction indices."""
+        indices = {}
+        for i in range(len(self.positions)):
+            indices[self.positions[i] >> 1] = i
+        indices[len(self.bytecode.code) >> 1] = len(self.positions)
+        for i in range(len(self.opcodes)):
+            if compile.isjump(self.opcodes[i]):
+                target = indices.get(self.args[i], -1)
+                if target == -1:
+                    self.error('jump into the middle of an instruction', i)
+                self.args[i] = target
+
+    def check_index(self, index, length, what, i):
+        if index < 0 or index >= length:
+            self.error('invalid %s index %d' % (what, index), i)
+
+    def check_arguments(self, i):
+        bytecode = self.bytecode
+        opcode = self.opcodes[i]
+        arg = self.args[i]
+        symbols = uses_symbol(opcode)
+        if symbols == 1:
+            self.check_index(arg, len(bytecode.symbols), 'symbol', i)
+        elif symbols == 2:
+            self.check_index(compile.first_arg(arg), len(bytecode.symbols),
+                             'symbol', i)
+            self.check_index(compile.second_arg(arg), len(bytecode.symbols),
+                             'symbol', i)
+        elif symbols == 3:
+            self.check_index(compile.first_arg(arg), len(bytecode.symbols),
+                             'symbol', i)
+        if (opcode == compile.LOAD_SLOT or opcode == compile.STORE_SLOT or
+                opcode == compile.STORE_SLOT_POP):
+            self.check_index(arg, len(bytecode.slotnames), 'slot', i)
+        elif opcode == compile.LOAD_CONST:
+            self.check_index(arg, len(bytecode.constants), 'constant', i)
+        elif opcode == compile.MAKE_OBJECT:
+            self.check_index(arg, len(bytecode.layouts), 'layout', i)
+        elif (opcode == compile.MAKE_FUNCTION or
+                opcode == compile.MAKE_OBJECT_CALL):
+            self.check_index(arg, len(bytecode.subbytecodes), 'subbytecode', i)
+        elif opcode == compile.PRIMITIVE_METHOD_CALL:
+            self.check_index(arg, len(primitives.all_primitives_arg_count),
+                             'primitive', i)
+        elif opcode == compile.INT_PRIMITIVE:
+            self.check_index(compile.second_arg(arg),
+                             len(primitives.all_primitives_arg_count),
+                             'primitive', i)
+        elif opcode == compile.METHOD_CALL:
+            if arg < 0:
+                self.error('negative number of arguments', i)
+        elif opcode == compile.TAIL_METHOD_CALL:
+            if arg < 0:
+                self.error('negative number of arguments', i)
+            # the frame is reused, which needs slots
+            if not bytecode.uses_slots():
+                self.error('tail call outside of a method', i)
+        elif opcode == compile.GET_LOCAL_CALL or opcode == compile.INT_CALL:
+            if compile.second_arg(arg) < 0:
+                self.error('negative number of arguments', i)
+
+    def check_stack(self):
+        opcodes = self.opcodes
+        depths = [-1] * (len(opcodes) + 1)
+        depths[0] = 0
+        maxpeak = 0
+        todo = [0]
+        while todo:
+            index = todo.pop()
+            if index == len(opcodes):
+                continue
+            opcode = opcodes[index]
+            arg = self.args[index]
+            depth = depths[index]
+            if depth < stack_inputs(opcode, arg):
+                self.error('stack underflow', index)
+            peak = depth + compile.get_stack_peak(opcode, arg)
+            if peak > self.bytecode.stackdepth:
+                self.error('stack overflow', index)
+            maxpeak = max(maxpeak, peak)
+            newdepth = depth + compile.get_stack_effect(opcode, arg)
+            if opcode == compile.TAIL_METHOD_CALL and newdepth != 1:
+                # the frame is reused with an empty stack
+                self.error('tail call with values on the stack', index)
+            successors = []
+            if compile.isjump(opcode):
+                successors.append(arg)
+            if opcode != compile.JUMP:
+                successors.append(index + 1)
+            for successor in successors:
+                if depths[successor] == -1:
+                    depths[successor] = newdepth
+                    todo.append(successor)
+                elif depths[successor] != newdepth:
+                    self.error('inconsistent stack depth', successor)
+        end = depths[len(opcodes)]
+        if end != -1 and end != 1:
+            self.error('stack depth at the end is not 1')
+        if self.bytecode.stackdepth > maxpeak:
+            self.error('stack depth %d larger than needed' %
+                       self.bytecode.stackdepth)
@@ -84,3 +84,48 @@ x = sumupto(100)
     w_module = interpreter.make_module()
     interpreter.eval(ast, w_module)
     assert w_module.getvalue("x").value == 5050
+
+def test_builtins_image():
+    from interpreter import get_builtins_image
+    builtincode = """
+object inttrait:
+    x = 1
+def f:
+    inttrait x
+"""
+    interpreter1 = Interpreter(builtincode)
+    interpreter2 = Interpreter(builtincode)
+    # the builtins are evaluated only once
+    assert get_builtins_image(builtincode) is get_builtins_image(builtincode)
+    w_module1 = interpreter1.make_module()
+    w_module2 = interpreter2.make_module()
+    # but every interpreter has its own copy
+    assert interpreter1.builtins is not interpreter2.builtins
+    interpreter1.eval(parse("""
+inttrait x = 2
+y = f
+"""), w_module1)
+    interpreter2.eval(parse("""
+y = f
+z = 5 x
+"""), w_module2)
+    assert w_module1.getvalue("y").value == 2
+    assert w_module2.getvalue("y").value == 1
+    assert w_module2.getvalue("z").value == 1
+    # the methods of the copy belong to the copy
+    w_inttrait = interpreter2.builtins.getvalue("inttrait")
+    assert w_inttrait.getvalue("__parent__") is interpreter2.builtins
+    assert w_inttrait is interpreter2.space.get_trait()
+
+def test_builtins_image_inline_caches():
+    # the inline caches of the builtins are not shared between interpreters,
+    # whose objects differ
+    for i in range(6):
+        interpreter = Interpreter()
+        w_module = interpreter.make_module()
+        interpreter.eval(parse("x = math isprime(97)"), w_module)
+        assert w_module.getvalue("x").istrue()
+        w_isprime = interpreter.builtins.getvalue("math").getvalue("isprime")
+        decoded = w_isprime.block.get_bytecode().get_decoded()
+        for cache in decoded.caches + decoded.second_caches:
+            assert cache is None or not cache.megamorphic
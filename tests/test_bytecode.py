@@ -196,3 +196,640 @@ b = x next next next next next next next a
     assert w_module.getvalue("a").value == 1
     assert w_module.getvalue("b").value == 2
 
+
+def test_decoded_code():
+    import compile
+    ast = parse("""
+x = 10000
+while x:
+    x = x $int_add(-1)
+""")
+    code = compile.compile(ast)
+    decoded = code.get_decoded()
+    assert code.get_decoded() is decoded
+    assert len(decoded.opcodes) == len(decoded.args) == len(decoded.positions)
+    # the literal does not fit into one code unit, it is in the constant pool
+    assert decoded.opcodes[0] == compile.LOAD_CONST
+    assert code.constants[decoded.args[0]] == 10000
+    # jump arguments are resolved to instruction indices
+    jumps = [i for i in range(len(decoded.opcodes))
+                if compile.isjump(decoded.opcodes[i])]
+    jump_if_false, jump = jumps
+    assert decoded.args[jump_if_false] == len(decoded.opcodes)
+    # the loop starts after INT_LITERAL, SET_LOCAL_POP and IMPLICIT_SELF
+    assert decoded.args[jump] == 3
+
+def test_deep_recursion():
+    # calls do not nest calls of the host interpreter, so the recursion depth
+    # is not limited by the recursion limit of Python
+    ast = parse("""
+object counter:
+    def count(n):
+        if n:
+            counter count(n $int_add(-1)) $int_add(1)
+        else:
+            0
+x = counter count(5000)
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 5000
+
+def test_small_int_range():
+    ast = parse("""
+x = 3
+y = 3
+z = 2 $int_add(1)
+a = 300
+b = 299 $int_add(1)
+""")
+    interpreter = Interpreter(empty_builtins, small_int_min=0, small_int_max=10)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x") is w_module.getvalue("y")
+    assert w_module.getvalue("x") is w_module.getvalue("z")
+    assert w_module.getvalue("a") is not w_module.getvalue("b")
+
+def test_peephole_rotates_loops():
+    import compile
+    ast = parse("""
+i = 0
+while i $int_sub(10):
+    i = i $int_add(1)
+i
+""")
+    code = compile.compile(ast, optimize=True)
+    decoded = code.get_decoded()
+    jumps = [i for i in range(len(decoded.opcodes))
+                if compile.isjump(decoded.opcodes[i])]
+    # the test is repeated at the end of the loop body, so an iteration
+    # executes only a single jump
+    jump_if_false, jump_if_true = jumps
+    assert decoded.opcodes[jump_if_false] == compile.JUMP_IF_FALSE
+    assert decoded.opcodes[jump_if_true] == compile.JUMP_IF_TRUE
+    assert decoded.args[jump_if_true] == jump_if_false + 1
+    assert decoded.args[jump_if_false] == jump_if_true + 1
+    assert code.stackdepth == compile.compile(ast).stackdepth
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("i").value == 10
+
+def test_peephole_constant_condition():
+    import compile
+    ast = parse("""
+if 0:
+    x = 1
+else:
+    x = 2
+""")
+    code = compile.compile(ast, optimize=True)
+    decoded = code.get_decoded()
+    for opcode in decoded.opcodes:
+        assert not compile.isjump(opcode)
+    assert decoded.opcodes[0] == compile.INT_LITERAL
+    assert decoded.args[0] == 2
+
+    interpreter = Interpreter(empty_builtins, optimize=False)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 2
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 2
+
+def test_peephole_noop_pairs_before_superinstructions():
+    import compile
+    ast = parse("""
+x = 1
+2
+x
+""")
+    code = compile.compile(ast, optimize=True)
+    decoded = code.get_decoded()
+    # the literal and its POP are removed before POP and GET_LOCAL could
+    # be fused
+    assert decoded.opcodes == [compile.INT_LITERAL, compile.SET_LOCAL_POP,
+                               compile.GET_LOCAL]
+    opcodes = compile.compile(ast).get_decoded().opcodes
+    assert compile.POP_GET_LOCAL in opcodes
+
+def test_peephole_endless_loop():
+    # the end of the code cannot be reached once the condition of the loop
+    # is folded
+    source = """
+i = 3
+while 1:
+    i = i $int_sub(1)
+    1 $int_div(i)
+"""
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    py.test.raises(ZeroDivisionError, interpreter.eval, parse(source),
+                   w_module)
+    assert w_module.getvalue("i").value == 0
+    # the same loop in a method, which is compiled when it is first called
+    interpreter.eval(parse("""
+def f(i):
+    while 1:
+        i = i $int_sub(1)
+        1 $int_div(i)
+"""), w_module)
+    py.test.raises(ZeroDivisionError, interpreter.eval, parse("f(3)"),
+                   w_module)
+
+def test_superinstructions():
+    import compile
+    ast = parse("""
+object o:
+    def add(a):
+        a $int_add(1)
+x = 4
+y = o add(x)
+z = o add(70000)
+w = o add(1)
+""")
+    code = compile.compile(ast)
+    opcodes = code.get_decoded().opcodes
+    assert compile.SET_LOCAL_POP in opcodes
+    assert compile.GET_LOCAL_LOOKUP in opcodes
+    assert compile.GET_LOCAL_CALL in opcodes
+    # 70000 does not fit into half of the argument
+    assert compile.METHOD_CALL in opcodes
+    assert compile.INT_CALL in opcodes
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("y").value == 5
+    assert w_module.getvalue("z").value == 70001
+    assert w_module.getvalue("w").value == 2
+
+def test_int_primitive():
+    import compile
+    import verifier
+    ast = parse("""
+x = 3
+y = x $int_mul(4) $int_sub(2)
+z = 5 $bool_gz
+""")
+    code = compile.compile(ast, optimize=True)
+    verifier.verify(code)
+    opcodes = code.get_decoded().opcodes
+    assert opcodes.count(compile.INT_PRIMITIVE) == 3
+    assert compile.PRIMITIVE_METHOD_CALL not in opcodes
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("y").value == 10
+    assert w_module.getvalue("z").value == 1
+
+def test_superinstruction_resumes_after_call():
+    # the GET_LOCAL half of GET_LOCAL_LOOKUP calls the method five here, add
+    # is looked up in its result
+    ast = parse("""
+def five:
+    5
+x = five add(2)
+""")
+    interpreter = Interpreter("""
+object inttrait:
+    def add(i):
+        self $int_add(i)
+""")
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 7
+
+def test_pack_args():
+    import compile
+    for first, second in [(0, 0), (1, 2), (-1, 5), (300, -300),
+                          (-0x8000, 0x7fff)]:
+        packed = compile.pack_args(first, second)
+        assert compile.first_arg(packed) == first
+        assert compile.second_arg(packed) == second
+
+def test_slots():
+    import compile
+    ast = parse("""
+object o:
+    def sum(n):
+        i = 0
+        s = 0
+        while i $int_sub(n):
+            i = i $int_add(1)
+            s = s $int_add(i)
+        s
+x = o sum(10)
+""")
+    code = compile.compile(ast)
+    method = code.subbytecodes[0].subbytecodes[0]
+    assert method.slotnames == ['n', 'self', '__parent__', 'i', 's']
+    assert method.argument_slots == [0]
+    opcodes = method.get_decoded().opcodes
+    assert compile.LOAD_SLOT in opcodes
+    assert compile.STORE_SLOT_POP in opcodes
+    assert compile.GET_LOCAL not in opcodes
+    assert compile.SET_LOCAL not in opcodes
+    # code outside of methods has no slots
+    assert code.slotnames == []
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 55
+
+def test_slots_context_materialized():
+    # the nested object needs the context of the method as its parent, the
+    # slots written before are copied into it
+    ast = parse("""
+object o:
+    def f(a):
+        b = a $int_add(1)
+        if a:
+            object p:
+                c = 3
+        b = b $int_add(p c)
+        p b
+x = o f(1)
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 5
+
+def test_slots_unassigned_local_found_in_parent():
+    ast = parse("""
+object o:
+    v = 41
+    def f:
+        v = v $int_add(1)
+        v
+x = o f
+y = o v
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 42
+    assert w_module.getvalue("y").value == 41
+
+def test_stackdepth_exact():
+    import compile
+    ast = parse("""
+if 1:
+    2
+else:
+    3
+""")
+    assert compile.compile(ast).stackdepth == 1
+    assert compile.compile(ast, optimize=True).stackdepth == 1
+    # the argument of GET_LOCAL_CALL is pushed while receiver and method are
+    # still on the stack
+    ast = parse("""
+o add(a)
+""")
+    code = compile.compile(ast, optimize=True)
+    assert compile.GET_LOCAL_CALL in code.get_decoded().opcodes
+    assert code.stackdepth == 3
+    assert compile.compile(ast).stackdepth == 3
+
+def test_tail_calls():
+    import compile
+    ast = parse("""
+object counter:
+    def count(n, acc):
+        if n:
+            self count(n $int_add(-1), acc $int_add(1))
+        else:
+            acc
+x = counter count(20000, 0)
+""")
+    code = compile.compile(ast)
+    method = code.subbytecodes[0].subbytecodes[0]
+    opcodes = method.get_decoded().opcodes
+    assert compile.TAIL_METHOD_CALL in opcodes
+    assert compile.METHOD_CALL not in opcodes
+    # calls that are not in tail position are not marked
+    assert compile.TAIL_METHOD_CALL not in code.get_decoded().opcodes
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 20000
+
+def test_wordcode():
+    import compile
+    assert [compile.unzigzag(compile.zigzag(i))
+                for i in range(-300, 300)] == range(-300, 300)
+    for value in [0, 1, -1, 255, -128, 127, 128, 70000, -70000,
+                  2 ** 31 - 1, -2 ** 31]:
+        code = compile.encode([compile.INT_LITERAL], [value])
+        assert len(code) % 2 == 0
+        decoded = compile.decode(code)
+        assert decoded.opcodes == [compile.INT_LITERAL]
+        assert decoded.args == [value]
+    # small arguments take one unit, larger ones EXTENDED_ARG prefixes
+    assert len(compile.encode([compile.INT_LITERAL], [-5])) == 2
+    assert len(compile.encode([compile.INT_LITERAL], [1000])) == 4
+    # a jump over many instructions, whose target needs a wider argument
+    opcodes = [compile.JUMP] + [compile.POP] * 300 + [compile.DUP]
+    args = [301] + [0] * 301
+    decoded = compile.decode(compile.encode(opcodes, args))
+    assert decoded.opcodes == opcodes
+    assert decoded.args == args
+    assert decoded.positions[1] == 4
+
+def test_constant_pool():
+    import compile
+    ast = parse("""
+object o:
+    def f(i):
+        i $int_add(1000)
+x = 0
+while x $int_sub(3000):
+    x = o f(x)
+y = -1000
+""")
+    code = compile.compile(ast)
+    assert code.constants == [3000, -1000]
+    assert code.subbytecodes[0].subbytecodes[0].constants == [1000]
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 3000
+    assert w_module.getvalue("y").value == -1000
+    # the integers of the pool are created once for every interpreter and
+    # know its integer trait
+    space = interpreter.space
+    w_constants = code.get_constants(space)
+    assert code.get_constants(space) is w_constants
+    assert w_constants[0].space is space
+    other = Interpreter(empty_builtins)
+    assert code.get_constants(other.space)[0].space is other.space
+
+def quickened_opcodes(decoded):
+    return [decoded.get_opcode(i) for i in range(len(decoded.opcodes))]
+
+def test_quickening():
+    import compile
+    builtins = """
+object inttrait:
+    def add(i):
+        self $int_add(i)
+    def plus(i):
+        self $int_add(i)
+"""
+    ast = parse("""
+object o:
+    def count(n):
+        i = 0
+        while i $int_sub(n):
+            i = i add(1)
+        i
+    def inc(i):
+        i add(1)
+object p:
+    def add(i):
+        i $int_add(10)
+x = o count(100)
+y = o inc(5)
+z = o inc(p)
+""")
+    interpreter = Interpreter(builtins)
+    w_module = interpreter.make_module()
+    code = interpreter.compile_program(ast)
+    interpreter.run_bytecode(code, w_module)
+    assert w_module.getvalue("x").value == 100
+    assert w_module.getvalue("y").value == 6
+    assert w_module.getvalue("z").value == 11
+    o = code.subbytecodes[0].get_bytecode()
+    count = o.subbytecodes[0].get_bytecode().get_decoded()
+    assert compile.INT_ADD in quickened_opcodes(count)
+    assert compile.METHOD_CALL not in quickened_opcodes(count)
+    # the code itself is not changed
+    assert compile.METHOD_CALL in count.opcodes
+    # the tail call in inc was quickened, and dequickened by the call with a
+    # receiver that is not an integer
+    inc = o.subbytecodes[1].get_bytecode().get_decoded()
+    assert compile.INT_ADD not in quickened_opcodes(inc)
+    assert [site.failed for site in inc.sites if site is not None] == [True]
+    # a call that cannot be quickened when it is first executed is marked as
+    # failed and not quickened later
+    interpreter.eval(parse("""
+def next(i):
+    i add(1)
+a = next(p)
+b = next(2)
+"""), w_module)
+    assert w_module.getvalue("a").value == 11
+    assert w_module.getvalue("b").value == 3
+    next = w_module.getvalue("next").block.get_bytecode().get_decoded()
+    assert compile.INT_ADD not in quickened_opcodes(next)
+    assert [site.failed for site in next.sites if site is not None] == [True]
+
+    # changing the integer trait dequickens the loop
+    w_trait = interpreter.space.get_trait()
+    w_trait.setvalue("add", w_trait.getvalue("plus"))
+    interpreter.eval(parse("x = o count(3)"), w_module)
+    assert w_module.getvalue("x").value == 3
+    assert compile.INT_ADD not in quickened_opcodes(count)
+
+def test_quickening_fused_calls():
+    import compile
+    builtins = """
+object inttrait:
+    def add(i):
+        self $int_add(i)
+    def mul(i):
+        self $int_mul(i)
+"""
+    ast = parse("""
+x = 0
+y = 1
+while x $int_sub(10):
+    x = x add(1)
+    y = y mul(x)
+    z = x add(1)
+""")
+    interpreter = Interpreter(builtins)
+    w_module = interpreter.make_module()
+    code = interpreter.compile_program(ast)
+    decoded = code.get_decoded()
+    # the calls at module level are fused with the loading of the argument
+    assert compile.INT_CALL in decoded.opcodes
+    assert compile.GET_LOCAL_CALL in decoded.opcodes
+    interpreter.run_bytecode(code, w_module)
+    assert w_module.getvalue("x").value == 10
+    assert w_module.getvalue("y").value == 3628800
+    assert w_module.getvalue("z").value == 11
+    opcodes = quickened_opcodes(decoded)
+    assert compile.INT_ADD in opcodes
+    assert compile.INT_MUL in opcodes
+    assert compile.INT_CALL not in opcodes
+    assert compile.GET_LOCAL_CALL not in opcodes
+    # the quickened instructions are executed from then on
+    interpreter.eval(parse("x = 0\ny = 1"), w_module)
+    interpreter.run_bytecode(code, w_module)
+    assert w_module.getvalue("y").value == 3628800
+    assert quickened_opcodes(decoded) == opcodes
+
+def test_lazy_compilation():
+    import compile
+    ast = parse("""
+object o:
+    def f(a):
+        a $int_add(1)
+    def g(a):
+        def h:
+            a
+        h
+x = o f(1)
+x = o f(x)
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    code = interpreter.compile_program(ast)
+    stub = code.subbytecodes[0]
+    assert isinstance(stub, compile.LazyBytecode)
+    assert stub.bytecode is None
+    interpreter.run_bytecode(code, w_module)
+    assert w_module.getvalue("x").value == 3
+    # the object body was run, and compiled with stubs for its methods
+    body = stub.bytecode
+    assert body.verified
+    f, g = body.subbytecodes
+    assert f.bytecode is not None and f.bytecode.verified
+    assert f.ast is None
+    # g was never called
+    assert g.bytecode is None
+    f_bytecode = f.bytecode
+    interpreter.eval(parse("x = o f(x)"), w_module)
+    assert w_module.getvalue("x").value == 4
+    assert f.get_bytecode() is f_bytecode
+
+    # a copy of a stub compiles through the stub it was copied from
+    g_copy = g.copy()
+    assert g_copy.get_bytecode() is not g.get_bytecode()
+    assert g_copy.get_bytecode().code == g.get_bytecode().code
+    assert isinstance(g.bytecode.subbytecodes[0], compile.LazyBytecode)
+
+def test_repeated_definitions_share_layouts():
+    from objmodel import PARENT_MAP
+    ast = parse("""
+def make(n):
+    object o:
+        x = n
+        def get:
+            x
+    o
+a = make(1)
+b = make(2)
+fa = a get
+fb = b get
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    w_a = w_module.getvalue("a")
+    w_b = w_module.getvalue("b")
+    assert w_a.getvalue("x").value == 1
+    assert w_b.getvalue("x").value == 2
+    # the objects of one definition end up with the same map
+    assert w_a.map is w_b.map
+    w_get_a = w_a.getvalue("get")
+    w_get_b = w_b.getvalue("get")
+    # the methods are different objects that share their code, a method
+    # only holds its __parent__
+    assert w_get_a is not w_get_b
+    assert w_get_a.block is w_get_b.block
+    assert w_get_a.map is PARENT_MAP
+    assert w_get_a.getvalue("__parent__") is w_a
+    assert w_module.getvalue("fa").value == 1
+    assert w_module.getvalue("fb").value == 2
+
+def test_object_layouts():
+    import compile
+    from objmodel import MAX_ATTRIBUTES
+    ast = parse("""
+object o(p=1):
+    a = 2
+    def f:
+        a
+    if a:
+        b = 3
+    else:
+        c = 4
+    a = 5
+    object inner:
+        d = 6
+""")
+    code = compile.compile(ast)
+    assert code.layouts == [['__parent__', 'p', 'a', 'f', 'b', 'c', 'inner']]
+    body = code.subbytecodes[0]
+    assert body.layouts == [['__parent__', 'd']]
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.run_bytecode(code, w_module)
+    w_o = w_module.getvalue("o")
+    # the object started out with the map of the whole layout
+    assert w_o.map is code.layout_maps[0]
+    assert len(w_o.storage) == 7
+    assert w_o.map.getindex('a') == 2
+    assert w_o.getvalue("a").value == 5
+    assert w_o.getvalue("b").value == 3
+    # c was predicted, but not assigned
+    assert w_o.map.getindex('c') == 5
+    assert w_o.getvalue("c") is None
+    assert "c" not in w_o.getvalues()
+    assert w_o.getvalue("inner").getvalue("d").value == 6
+    # names that were not predicted still work
+    interpreter.eval(parse("o x = 7\no y = 8"), w_module)
+    assert w_o.getvalue("x").value == 7
+    assert w_o.getvalue("y").value == 8
+    assert len(w_o.storage) == 9
+    for i in range(MAX_ATTRIBUTES):
+        interpreter.eval(parse("o z%d = %d" % (i, i)), w_module)
+    assert w_o.map is None
+    assert w_o.getvalue("z1").value == 1
+    assert w_o.getvalue("a").value == 5
+
+def test_unassigned_layout_attributes():
+    # the objects of the definition share the map of the layout, whether or
+    # not they assign c; lookups of c go to the parent until it is assigned
+    ast = parse("""
+c = 1
+def make(n):
+    object o:
+        if n:
+            c = 2
+        def get:
+            c
+    o
+a = make(0)
+b = make(1)
+x = a get
+y = b get
+z = a get
+object k(__parent__=a):
+    1
+w = k c
+""")
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    w_a = w_module.getvalue("a")
+    w_b = w_module.getvalue("b")
+    assert w_a.map is w_b.map
+    assert w_module.getvalue("x").value == 1
+    assert w_module.getvalue("y").value == 2
+    assert w_module.getvalue("z").value == 1
+    assert w_module.getvalue("w").value == 1
+    interpreter.eval(parse("a c = 3\nx = a get\nw = k c"), w_module)
+    assert w_a.map is w_b.map
+    assert w_module.getvalue("x").value == 3
+    assert w_module.getvalue("w").value == 3
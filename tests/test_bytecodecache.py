@@ -0,0 +1,133 @@
+import py
+
+from simpleparser import parse
+from interpreter import Interpreter
+import bytecodecache
+import compile
+
+empty_builtins = """
+1
+"""
+
+source = """
+object o:
+    def add(a):
+        a $int_add(1)
+i = -1000
+i = 0
+while i $int_sub(10):
+    i = o add(i)
+x = i
+"""
+
+def assert_same_bytecode(bytecode1, bytecode2):
+    assert bytecode1.code == bytecode2.code
+    assert bytecode1.name == bytecode2.name
+    assert bytecode1.symbols == bytecode2.symbols
+    assert bytecode1.slotnames == bytecode2.slotnames
+    assert bytecode1.constants == bytecode2.constants
+    assert bytecode1.layouts == bytecode2.layouts
+    assert bytecode1.numargs == bytecode2.numargs
+    assert bytecode1.stackdepth == bytecode2.stackdepth
+    assert len(bytecode1.subbytecodes) == len(bytecode2.subbytecodes)
+    for i in range(len(bytecode1.subbytecodes)):
+        assert_same_bytecode(bytecode1.subbytecodes[i].get_bytecode(),
+                             bytecode2.subbytecodes[i].get_bytecode())
+
+def test_roundtrip(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    bytecode = compile.compile(parse(source), optimize=True)
+    assert bytecodecache.load(fname, source) is None
+    bytecodecache.store(fname, source, bytecode)
+    assert tmpdir.join('test.slfc').check()
+    loaded = bytecodecache.load(fname, source)
+    assert_same_bytecode(bytecode, loaded)
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.run_bytecode(loaded, w_module)
+    assert w_module.getvalue("x").value == 10
+
+def test_lazy_bodies_are_compiled_for_the_cache(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    bytecode = compile.compile(parse(source), optimize=True, lazy=True)
+    bytecodecache.store(fname, source, bytecode)
+    loaded = bytecodecache.load(fname, source)
+    assert isinstance(loaded.subbytecodes[0], compile.Bytecode)
+    assert_same_bytecode(bytecode, loaded)
+
+def test_invalid_cache(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('test.slf'))
+    bytecode = compile.compile(parse(source))
+    bytecodecache.store(fname, source, bytecode)
+    # a different source
+    assert bytecodecache.load(fname, source + "y = 1\n") is None
+    # a different instruction set
+    monkeypatch.setattr(compile, 'INSTRUCTION_SET_VERSION',
+                        compile.INSTRUCTION_SET_VERSION + 1)
+    assert bytecodecache.load(fname, source) is None
+    monkeypatch.undo()
+    assert bytecodecache.load(fname, source) is not None
+    # a truncated file
+    data = tmpdir.join('test.slfc').read('rb')
+    tmpdir.join('test.slfc').write(data[:-3], 'wb')
+    assert bytecodecache.load(fname, source) is None
+
+def test_invalid_layouts(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    source = """
+object o:
+    a = 1
+    b = 2
+"""
+    bytecode = compile.compile(parse(source))
+    assert bytecode.layouts == [['__parent__', 'a', 'b']]
+    data = bytecodecache.dumps(bytecode, source)
+    def string(s):
+        return ''.join(compile.encode4(len(s))) + s
+    layout = string('__parent__') + string('a') + string('b')
+    assert data.count(layout) == 1
+    # a name that occurs twice
+    damaged = data.replace(layout, string('__parent__') + string('a') +
+                                   string('a'))
+    tmpdir.join('test.slfc').write(damaged, 'wb')
+    assert bytecodecache.load(fname, source) is None
+    # a layout that does not start with the __parent__
+    damaged = data.replace(layout, string('a') + string('__parent__') +
+                                   string('b'))
+    tmpdir.join('test.slfc').write(damaged, 'wb')
+    assert bytecodecache.load(fname, source) is None
+    tmpdir.join('test.slfc').write(data, 'wb')
+    assert_same_bytecode(bytecode, bytecodecache.load(fname, source))
+
+def test_cache_dir(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    cache_dir = tmpdir.mkdir('cache')
+    bytecode = compile.compile(parse(source))
+    bytecodecache.store(fname, source, bytecode, str(cache_dir))
+    assert not tmpdir.join('test.slfc').check()
+    name = '%s-%d.slfc' % (bytecodecache.source_digest(source),
+                           compile.INSTRUCTION_SET_VERSION)
+    assert cache_dir.join(name).check()
+    loaded = bytecodecache.load(fname, source, str(cache_dir))
+    assert_same_bytecode(bytecode, loaded)
+
+def test_roundtrip_large_constants(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    source = """
+x = 10000000000
+y = -10000000000
+z = 2147483648
+"""
+    bytecode = compile.compile(parse(source), optimize=True)
+    assert 10000000000 in bytecode.constants
+    bytecodecache.store(fname, source, bytecode)
+    loaded = bytecodecache.load(fname, source)
+    assert_same_bytecode(bytecode, loaded)
+
+    interpreter = Interpreter(empty_builtins)
+    w_module = interpreter.make_module()
+    interpreter.run_bytecode(loaded, w_module)
+    assert w_module.getvalue("x").value == 10000000000
+    assert w_module.getvalue("y").value == -10000000000
+    assert w_module.getvalue("z").value == 2147483648
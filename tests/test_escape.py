@@ -0,0 +1,85 @@
+from simpleparser import parse
+from interpreter import Interpreter
+import compile
+import escape
+
+def method_code(source):
+    code = compile.compile(parse(source))
+    return code.subbytecodes[0]
+
+def test_never_escapes():
+    code = method_code("""
+def f(a):
+    b = a $int_add(1)
+    b
+""")
+    assert escape.analyze(code) == escape.NEVER
+    assert code.uses_slots()
+
+def test_may_escape():
+    code = method_code("""
+def f(a):
+    if a:
+        g(a)
+    else:
+        a
+""")
+    assert escape.analyze(code) == escape.MAYBE
+    assert code.uses_slots()
+
+def test_always_escapes():
+    # the method is compiled without slots, as it needs its context object
+    # on every path
+    code = method_code("""
+def f(a):
+    if a:
+        g(a)
+    else:
+        def h:
+            a
+    a
+""")
+    assert escape.analyze(code) == escape.ALWAYS
+    assert not code.uses_slots()
+    assert compile.LOAD_SLOT not in code.get_decoded().opcodes
+
+def test_always_escapes_result():
+    ast = parse("""
+object o:
+    def f(a):
+        object p:
+            b = 2
+        p b $int_add(a)
+x = o f(1)
+""")
+    interpreter = Interpreter("""
+1
+""")
+    w_module = interpreter.make_module()
+    interpreter.eval(ast, w_module)
+    assert w_module.getvalue("x").value == 3
+
+def test_always_escapes_compiled_once(monkeypatch):
+    # a method that needs its context is not compiled again without slots,
+    # so nested methods are compiled once
+    compilers = []
+    Compiler = compile.Compiler
+    class CountingCompiler(Compiler):
+        def __init__(self, optimize=False, lazy=False):
+            Compiler.__init__(self, optimize, lazy)
+            compilers.append(self)
+    monkeypatch.setattr(compile, "Compiler", CountingCompiler)
+    depth = 12
+    lines = []
+    for i in range(depth):
+        lines.append("    " * i + "def f%d(a):" % i)
+    lines.append("    " * depth + "a")
+    code = compile.compile(parse("\n".join(lines)))
+    assert len(compilers) == depth + 1
+    for i in range(depth):
+        code = code.subbytecodes[0]
+        if i < depth - 1:
+            assert escape.analyze(code) == escape.ALWAYS
+            assert not code.uses_slots()
+        else:
+            assert code.uses_slots()
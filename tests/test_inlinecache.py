@@ -0,0 +1,55 @@
+from objmodel import W_Integer, W_NormalObject
+from inlinecache import InlineCache, MAX_ENTRIES
+
+
+def test_own_attribute():
+    cache = InlineCache()
+    w1 = W_NormalObject({'a': W_Integer(1)})
+    w2 = W_NormalObject({'a': W_Integer(2)})
+    assert cache.lookup(w1, 'a').value == 1
+    assert len(cache.entries) == 1
+    # the second object has the same map, so the entry is reused
+    assert cache.lookup(w2, 'a').value == 2
+    assert len(cache.entries) == 1
+    w2.setvalue('a', W_Integer(3))
+    assert cache.lookup(w2, 'a').value == 3
+
+def test_parent_attribute():
+    cache = InlineCache()
+    w_parent = W_NormalObject({'a': W_Integer(1)})
+    w1 = W_NormalObject({'__parent__': w_parent})
+    w2 = W_NormalObject({'__parent__': w_parent})
+    assert cache.lookup(w1, 'a').value == 1
+    assert cache.lookup(w2, 'a').value == 1
+    assert len(cache.entries) == 1
+    # writing to the parent is seen through the cache
+    w_parent.setvalue('a', W_Integer(2))
+    assert cache.lookup(w1, 'a').value == 2
+    # a different parent does not match the entry
+    w_other = W_NormalObject({'a': W_Integer(5)})
+    w3 = W_NormalObject({'__parent__': w_other})
+    assert cache.lookup(w3, 'a').value == 5
+    assert len(cache.entries) == 2
+
+def test_shadowing_invalidates():
+    cache = InlineCache()
+    w_grandparent = W_NormalObject({'a': W_Integer(1)})
+    w_parent = W_NormalObject({'__parent__': w_grandparent})
+    w1 = W_NormalObject({'__parent__': w_parent})
+    assert cache.lookup(w1, 'a').value == 1
+    w_parent.setvalue('a', W_Integer(2))
+    assert cache.lookup(w1, 'a').value == 2
+    # the receiver itself gets a new map
+    w1.setvalue('a', W_Integer(3))
+    assert cache.lookup(w1, 'a').value == 3
+
+def test_megamorphic():
+    cache = InlineCache()
+    for i in range(MAX_ENTRIES + 1):
+        w = W_NormalObject()
+        w.setvalue('x%d' % i, W_Integer(i))
+        w.setvalue('a', W_Integer(i))
+        assert cache.lookup(w, 'a').value == i
+    assert cache.megamorphic
+    assert cache.entries == []
+    assert cache.lookup(w, 'a').value == MAX_ENTRIES
@@ -42,6 +42,31 @@ def test_clone_not_deep():
     b2 = a2.getvalue('b')
     assert b1 is b2
 
+def test_deepclone():
+    from objmodel import W_Method, IntegerSpace
+    from simpleparser import parse
+    import compile
+    space = IntegerSpace(None)
+    a1 = W_NormalObject({'x': W_Integer(6)})
+    m1 = W_Method({'__parent__': a1})
+    m1.block = compile.compile(parse("def f(a):\n    a"))
+    a1.setvalue('m', m1)
+    a1.setvalue('self', a1)
+    a2 = a1.deepclone({}, space)
+    assert a2 is not a1
+    assert a2.getvalue('self') is a2
+    assert a2.getvalue('x').value == 6
+    assert a2.getvalue('x').space is space
+    m2 = a2.getvalue('m')
+    assert isinstance(m2, W_Method)
+    assert m2 is not m1
+    # the code is copied, so that the copy has its own inline caches
+    assert m2.block is not m1.block
+    assert m2.block.code == m1.block.code
+    assert m2.block.subbytecodes[0] is not m1.block.subbytecodes[0]
+    assert m2.block.get_decoded() is not m1.block.get_decoded()
+    assert m2.getvalue('__parent__') is a2
+
 def test_getvalue_from_parent():
     o = W_NormalObject({'foo': W_Integer(42)})
     bar = W_NormalObject({'__parent__': o})
@@ -53,3 +78,83 @@ def test_callable():
     assert W_Integer(42).callable() == False
     assert W_Method().callable() == True
 
+
+def test_maps_are_shared():
+    w1 = W_NormalObject()
+    w1.setvalue('a', W_Integer(1))
+    w1.setvalue('b', W_Integer(2))
+    w2 = W_NormalObject()
+    w2.setvalue('a', W_Integer(3))
+    w2.setvalue('b', W_Integer(4))
+    assert w1.map is w2.map
+    assert w1.map.getindex('b') == 1
+    assert w2.getvalue('b').value == 4
+    # overwriting an attribute keeps the map
+    w2.setvalue('a', W_Integer(5))
+    assert w1.map is w2.map
+    # a different order of attributes gives a different map
+    w3 = W_NormalObject()
+    w3.setvalue('b', W_Integer(2))
+    w3.setvalue('a', W_Integer(1))
+    assert w3.map is not w1.map
+
+def test_dict_fallback():
+    from objmodel import MAX_ATTRIBUTES
+    w1 = W_NormalObject()
+    for i in range(MAX_ATTRIBUTES + 1):
+        w1.setvalue('a%d' % i, W_Integer(i))
+    assert w1.map is None
+    for i in range(MAX_ATTRIBUTES + 1):
+        assert w1.getvalue('a%d' % i).value == i
+    w2 = w1.clone()
+    w2.setvalue('a0', W_Integer(99))
+    assert w1.getvalue('a0').value == 0
+    assert w2.getvalue('a0').value == 99
+
+def test_mro_cache():
+    from objmodel import mro_cache
+    a = W_NormalObject({'x': W_Integer(1)})
+    b = W_NormalObject({'x': W_Integer(2)})
+    c = W_NormalObject({'__parent__': a})
+    d = W_NormalObject({'__parent__': c})
+    mro_cache.reset_stats()
+    assert d.getvalue('x').value == 1
+    misses = mro_cache.misses
+    assert misses > 0
+    hits = mro_cache.hits
+    mro = d.get_mro()
+    assert d.getvalue('x').value == 1
+    assert mro_cache.misses == misses
+    assert mro_cache.hits > hits
+    assert d.get_mro() is mro
+    # changing the parent of c invalidates the cached MRO of d, too
+    c.setvalue('__parent__', b)
+    assert d.get_mro() == [d, c, b]
+    assert d.getvalue('x').value == 2
+
+def test_mro_cache_parent_slots():
+    a = W_NormalObject({'x': W_Integer(1)})
+    b = W_NormalObject({'x': W_Integer(2)})
+    c = W_NormalObject()
+    c.setvalue('p', a)
+    c.add_parent('p')
+    d = W_NormalObject({'__parent__': c})
+    assert d.getvalue('x').value == 1
+    # writing to a slot that is listed in the parents changes the MRO
+    c.setvalue('p', b)
+    assert d.getvalue('x').value == 2
+
+def test_integer_space():
+    from objmodel import IntegerSpace
+    trait = W_NormalObject({'x': W_Integer(1)})
+    builtins = W_NormalObject({'inttrait': trait})
+    space = IntegerSpace(builtins, -1, 10)
+    w1 = space.newint(5)
+    assert space.newint(5) is w1
+    assert space.newint(11) is not space.newint(11)
+    assert space.newint(-2).value == -2
+    assert w1.getparents() == [trait]
+    assert space.w_trait is trait
+    assert w1.getvalue('x').value == 1
+    assert w1.getvalue('') is w1
+    assert w1.get_mro() == [w1, trait]
@@ -29,3 +29,17 @@ y = f(100)
     interpreter.eval(ast, w_module)
     assert w_module.getvalue("y").value == 5050
 
+
+def test_call_by_index():
+    import primitives
+    from objmodel import IntegerSpace
+    space = IntegerSpace(None)
+    add = primitives.primitives_by_name.index('$int_add')
+    gz = primitives.primitives_by_name.index('$bool_gz')
+    assert primitives.binary_primitives[add](20, 22) == 42
+    assert primitives.unary_primitives[add] is None
+    assert primitives.call1(add, space.newint(20), space.newint(22), space).value == 42
+    assert primitives.call0(gz, space.newint(-3), space).value == 0
+    # the receiver can also be an object that returns an integer for ''
+    w_obj = W_NormalObject({'__parent__': space.newint(5)})
+    assert primitives.call0(gz, w_obj, space).value == 1
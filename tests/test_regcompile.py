@@ -0,0 +1,116 @@
+import py
+
+from simpleparser import parse
+from interpreter import Interpreter
+import regcompile
+
+empty_builtins = """
+1
+"""
+
+def run(source, builtins=empty_builtins):
+    interpreter = Interpreter(builtins, backend='register')
+    w_module = interpreter.make_module()
+    interpreter.eval(parse(source), w_module)
+    return w_module
+
+def test_assignment_uses_registers():
+    code = regcompile.compile(parse("""
+x = 1
+y = x
+"""))
+    assert regcompile.disassemble(code) == [
+        '0 LOAD_INT 2 1',
+        '3 SET_ATTR 0 2 2',
+        '7 SEND 1 0 2',
+        '11 SET_ATTR 0 3 1',
+        '15 RETURN 1']
+    assert code.numregs == 3
+    assert code.count_instructions() == 5
+
+def test_primitive_and_if():
+    w_module = run("""
+x = 1 $int_add(2)
+if x $int_sub(3):
+    y = 1
+else:
+    y = 2
+""")
+    assert w_module.getvalue("x").value == 3
+    assert w_module.getvalue("y").value == 2
+
+def test_method_call_args():
+    w_module = run("""
+object o:
+    z = 10
+    def f(a, b):
+        a $int_add(b) $int_add(z)
+x = o f(1, 2)
+def g(a):
+    a
+y = g(5)
+""")
+    assert w_module.getvalue("x").value == 13
+    assert w_module.getvalue("y").value == 5
+
+def test_while_and_parents():
+    w_module = run("""
+object a:
+    def f:
+        1
+object b(p=a):
+    def g:
+        f $int_add(1)
+i = 0
+r = 0
+while i $int_sub(10):
+    i = i $int_add(1)
+    r = r $int_add(b g)
+""")
+    assert w_module.getvalue("i").value == 10
+    assert w_module.getvalue("r").value == 20
+
+def test_same_results_as_stack_backend():
+    source = """
+x = 0
+n = 50
+while n:
+    if math isprime(n):
+        x = x add(n)
+    n = n sub(1)
+"""
+    results = []
+    for backend in ['stack', 'register']:
+        interpreter = Interpreter(backend=backend)
+        w_module = interpreter.make_module()
+        interpreter.eval(parse(source), w_module)
+        results.append(w_module.getvalue("x").value)
+    assert results[0] == results[1] == 328
+
+def test_count_instructions():
+    interpreter = Interpreter(empty_builtins, backend='register')
+    interpreter.count_instructions = True
+    w_module = interpreter.make_module()
+    interpreter.eval(parse("""
+x = 1
+"""), w_module)
+    # LOAD_INT, SET_ATTR, RETURN
+    assert interpreter.instructions_executed == 3
+
+def test_translate_register_backend(monkeypatch):
+    # the register interpreter is not used by slf.py, so its translation is
+    # checked here
+    from pypy.translator.interactive import Translation
+    import interpreter
+    # only the image of the register backend is prebuilt, not the images
+    # that other tests built
+    monkeypatch.setattr(interpreter, 'builtins_images', {})
+    interpreter.get_builtins_image(backend='register')
+    def entry_point(argv):
+        interpreter = Interpreter(backend='register')
+        w_module = interpreter.make_module()
+        interpreter.eval(parse(argv[1]), w_module)
+        return 0
+    t = Translation(entry_point, [[str]])
+    t.annotate()
+    t.rtype()
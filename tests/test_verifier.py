@@ -0,0 +1,103 @@
+import py
+
+from simpleparser import parse
+import bytecodecache
+import compile
+import verifier
+
+source = """
+object o:
+    def add(a):
+        if a:
+            self add(a $int_sub(1))
+        else:
+            a
+i = 0
+while i $int_sub(10):
+    i = o add(i) $int_add(1)
+x = i
+"""
+
+def make_bytecode(code, symbols=['x'], stackdepth=1, subbytecodes=[]):
+    return compile.Bytecode(''.join(code), 'test', symbols, subbytecodes,
+                            0, stackdepth)
+
+def unit(opcode, arg=0):
+    return chr(opcode) + chr(compile.zigzag(arg))
+
+def assert_invalid(bytecode, message):
+    e = py.test.raises(verifier.VerifyError, verifier.verify, bytecode)
+    assert message in e.value.message
+    assert not bytecode.verified
+
+def test_compiled_code():
+    for optimize in [False, True]:
+        bytecode = compile.compile(parse(source), optimize=optimize)
+        verifier.verify(bytecode)
+        assert bytecode.verified
+        assert bytecode.subbytecodes[0].subbytecodes[0].verified
+
+def test_builtins():
+    import os
+    fname = os.path.join(os.path.dirname(compile.__file__), 'builtins.slf')
+    bytecode = compile.compile(parse(open(fname).read()), optimize=True)
+    verifier.verify(bytecode)
+
+def test_invalid_code():
+    i = compile.INT_LITERAL
+    extended = compile.EXTENDED_ARG
+    assert_invalid(make_bytecode([unit(1)]), 'invalid opcode')
+    assert_invalid(make_bytecode([chr(i)]), 'truncated')
+    assert_invalid(make_bytecode([unit(extended, 1)]), 'invalid EXTENDED_ARG')
+    assert_invalid(make_bytecode([unit(extended)] * 4 + [unit(i)]),
+                   'invalid EXTENDED_ARG')
+    assert_invalid(make_bytecode([unit(compile.POP, 1)]), 'argument of POP')
+    assert_invalid(make_bytecode([unit(i, 1), unit(compile.GET_LOCAL, 1)],
+                                 stackdepth=2), 'invalid symbol index 1')
+    assert_invalid(make_bytecode([unit(compile.MAKE_FUNCTION)]),
+                   'invalid subbytecode index 0')
+    assert_invalid(make_bytecode([unit(compile.LOAD_SLOT)]),
+                   'invalid slot index 0')
+    assert_invalid(make_bytecode([unit(compile.MAKE_OBJECT)]),
+                   'invalid layout index 0')
+    # a jump to the INT_LITERAL after the EXTENDED_ARG that belongs to it
+    assert_invalid(make_bytecode([unit(compile.JUMP, 2), unit(extended, 1),
+                                  unit(i, 0)]),
+                   'jump into the middle of an instruction')
+
+def test_invalid_stack():
+    i = compile.INT_LITERAL
+    assert_invalid(make_bytecode([unit(compile.POP)]), 'stack underflow')
+    assert_invalid(make_bytecode([unit(i, 1), unit(i, 2)]), 'stack overflow')
+    assert_invalid(make_bytecode([unit(i, 1), unit(i, 2)], stackdepth=2),
+                   'at the end')
+    # e.g. from a damaged cache file, the frame would preallocate a huge
+    # stack
+    assert_invalid(make_bytecode([unit(i, 1)], stackdepth=1 << 30),
+                   'larger than needed')
+    # JUMP_IF_FALSE pops the value, so the depth differs at the target
+    assert_invalid(make_bytecode([unit(i, 1), unit(i, 1),
+                                  unit(compile.JUMP_IF_FALSE, 4),
+                                  unit(i, 2), unit(compile.POP)],
+                                 stackdepth=3),
+                   'inconsistent stack depth')
+    # the end of an endless loop cannot be reached
+    bytecode = make_bytecode([unit(i, 1), unit(compile.POP),
+                              unit(compile.JUMP, 0)])
+    verifier.verify(bytecode)
+    assert bytecode.verified
+    assert_invalid(make_bytecode([unit(compile.IMPLICIT_SELF),
+                                  unit(compile.IMPLICIT_SELF),
+                                  unit(compile.TAIL_METHOD_CALL, 0)],
+                                 stackdepth=2),
+                   'tail call outside of a method')
+
+def test_damaged_cache_file(tmpdir):
+    fname = str(tmpdir.join('test.slf'))
+    bytecode = compile.compile(parse(source), optimize=True)
+    data = bytecodecache.dumps(bytecode, source)
+    # make the code of the main program pop from an empty stack
+    position = data.index(bytecode.code)
+    data = data[:position] + chr(compile.POP) + data[position + 1:]
+    tmpdir.join('test.slfc').write(data, mode='wb')
+    assert bytecodecache.load(fname, source) is None